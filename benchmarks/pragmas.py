@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Compare the REST and admin test workloads with and without the sqlite
+"performance" pragma preset:
+
+    python benchmarks/pragmas.py [iterations]
+
+Each profile runs in a fresh interpreter, as the test app configures its
+database when it is imported.
+"""
+import importlib
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROFILES = {
+    'default': {},
+    'performance': {'pragmas': 'performance'},
+    'performance-pool': {'pragmas': 'performance', 'pool': True},
+}
+
+
+def run_profile(profile, iterations):
+    from flask_peewee.tests.test_config import Configuration
+    Configuration.DATABASE = dict(
+        Configuration.DATABASE,
+        name='bench.db',
+        **PROFILES[profile])
+
+    loader = unittest.TestLoader()
+    timings = []
+    # the rest tests rely on tables created by the admin tests
+    for name in ('admin', 'rest'):
+        module = importlib.import_module('flask_peewee.tests.%s' % name)
+        start = time.time()
+        for i in range(iterations):
+            suite = loader.loadTestsFromModule(module)
+            result = unittest.TestResult()
+            suite.run(result)
+            if not result.wasSuccessful():
+                raise RuntimeError('%s failed: %s' % (
+                    name, result.errors + result.failures))
+        timings.append((name, time.time() - start))
+
+    for name, duration in timings:
+        print('%-16s %-6s %8.3fs' % (profile, name, duration))
+
+
+def main(iterations):
+    for profile in sorted(PROFILES):
+        subprocess.check_call([
+            sys.executable, __file__, str(iterations), profile])
+    for filename in ('bench.db', 'bench.db-wal', 'bench.db-shm'):
+        if os.path.exists(filename):
+            os.unlink(filename)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    if len(sys.argv) > 2:
+        run_profile(sys.argv[2], iterations)
+    else:
+        main(iterations)
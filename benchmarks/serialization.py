@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of serializing model instances field by field, as
+``get_dictionary_from_model()`` and ``Serializer.clean_data()`` do, with the
+compiled serialization plans of ``Serializer.serialize_object()``:
+
+    python benchmarks/serialization.py [rows]
+
+The instances are built in memory, so only the serialization is timed.
+"""
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peewee import *
+
+from flask_peewee.serializer import Serializer
+from flask_peewee.utils import get_dictionary_from_model
+
+
+database = SqliteDatabase(':memory:')
+
+class User(Model):
+    username = CharField()
+    email = CharField()
+    join_date = DateTimeField()
+    active = BooleanField()
+
+    class Meta:
+        database = database
+
+class Message(Model):
+    user = ForeignKeyField(User)
+    content = TextField()
+    pub_date = DateTimeField()
+    pub_day = DateField()
+    score = FloatField()
+
+    class Meta:
+        database = database
+
+# the "fields" and "exclude" a RestResource would pass, with and without the
+# related resource of the user
+PROFILES = [
+    ('flat', {Message: Message._meta.sorted_field_names}, {}),
+    ('nested', {
+        Message: Message._meta.sorted_field_names,
+        User: ['id', 'username', 'join_date', 'active'],
+    }, {}),
+    ('exclude', {Message: Message._meta.sorted_field_names}, {Message: ['content']}),
+]
+
+
+def get_objects(rows):
+    now = datetime.datetime(2020, 1, 1)
+    users = [
+        User(id=i, username='user-%d' % i, email='%d@example.com' % i,
+             join_date=now, active=True)
+        for i in range(1, 101)]
+    return [
+        Message(id=i, user=users[i % 100], content='message %d' % i,
+                pub_date=now + datetime.timedelta(seconds=i),
+                pub_day=now.date(), score=i / 3.0)
+        for i in range(1, rows + 1)]
+
+
+def serialize_dictionaries(objects, fields, exclude):
+    serializer = Serializer()
+    return [
+        serializer.clean_data(get_dictionary_from_model(obj, fields, exclude))
+        for obj in objects]
+
+
+def serialize_plans(objects, fields, exclude):
+    serializer = Serializer()
+    return [serializer.serialize_object(obj, fields, exclude) for obj in objects]
+
+
+def main(rows):
+    objects = get_objects(rows)
+    for name, fields, exclude in PROFILES:
+        timings = []
+        results = []
+        for serialize in (serialize_dictionaries, serialize_plans):
+            start = time.time()
+            results.append(serialize(objects, fields, exclude))
+            timings.append(time.time() - start)
+
+        if results[0] != results[1]:
+            raise RuntimeError('%s: the serializations differ' % name)
+        for label, duration in zip(('dictionary', 'plan'), timings):
+            print('%-8s %-10s %8.3fs %10.0f rows/s' % (name, label, duration, rows / duration))
+        print('%-8s speedup    %8.2fx' % (name, timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
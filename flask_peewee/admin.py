@@ -15,7 +15,9 @@ from flask import redirect
 from flask import render_template
 from flask import request
 from flask import session
+from flask import stream_with_context
 from flask import url_for
+from flask_peewee.budget import query_budget
 from flask_peewee.filters import FilterForm
 from flask_peewee.filters import FilterMapping
 from flask_peewee.filters import FilterModelConverter
@@ -23,8 +25,10 @@ from flask_peewee.forms import BaseModelConverter
 from flask_peewee.forms import ChosenAjaxSelectWidget
 from flask_peewee.forms import LimitedModelSelectField
 from flask_peewee.serializer import Serializer
+from flask_peewee.streaming import stream
 from flask_peewee.utils import PaginatedQuery
 from flask_peewee.utils import get_next
+from flask_peewee.utils import get_read_query
 from flask_peewee.utils import path_to_models
 from flask_peewee.utils import slugify
 from peewee import BooleanField
@@ -96,6 +100,13 @@ class ModelAdmin(object):
     paginate_by = 20
     filter_paginate_by = 15
 
+    # paginate the index by cursors rather than page numbers, which keeps
+    # deep pages fast on large tables, see PaginatedQuery
+    keyset_pagination = False
+
+    # how the pages are counted, exactly by default -- see counting.py
+    count_strategy = None
+
     # columns to display in the list index - can be field names or callables on
     # a model instance, though in the latter case they will not be sortable
     columns = None
@@ -121,6 +132,10 @@ class ModelAdmin(object):
     delete_collect_objects = True
     delete_recursive = True
 
+    # seconds the queries of each request may take, see the database's
+    # "query_budget" option
+    query_budget = None
+
     filter_mapping = FilterMapping
     filter_converter = AdminFilterModelConverter
 
@@ -258,7 +273,11 @@ class ModelAdmin(object):
         filter_form, query, cleaned, field_tree = self.process_filters(query)
 
         # create a paginated query out of our filtered results
-        pq = PaginatedQuery(query, self.paginate_by)
+        pq = PaginatedQuery(
+            query,
+            self.paginate_by,
+            self.keyset_pagination,
+            self.count_strategy)
 
         return render_template(self.templates['index'],
             model_admin=self,
@@ -385,7 +404,7 @@ class ModelAdmin(object):
         return accum
 
     def export(self):
-        query = self.get_query()
+        query = get_read_query(self.get_query())
 
         ordering = request.args.get('ordering') or ''
         query = self.apply_ordering(query, ordering)
@@ -434,11 +453,11 @@ class ModelAdmin(object):
             if query_string:
                 query = query.where(rel_field ** ('%%%s%%' % query_string))
 
-            pq = PaginatedQuery(query, self.filter_paginate_by)
+            pq = PaginatedQuery(query, self.filter_paginate_by, count_strategy=self.count_strategy)
             current_page = pq.get_page()
             if current_page > 1:
                 prev_page = current_page - 1
-            if current_page < pq.get_pages():
+            if pq.has_next():
                 next_page = current_page + 1
 
             data = []
@@ -512,11 +531,13 @@ class AdminTemplateHelper(object):
     def fix_underscores(self, s):
         return s.replace('_', ' ').title()
 
-    def update_querystring(self, querystring, key, val):
+    def update_querystring(self, querystring, key, val, *remove):
         if not querystring:
             return '%s=%s' % (key, val)
         else:
-            querystring = re.sub('%s(?:[^&]+)?&?' % key, '', querystring.decode('utf8')).rstrip('&')
+            querystring = querystring.decode('utf8')
+            for name in (key,) + remove:
+                querystring = re.sub('%s(?:[^&]+)?&?' % name, '', querystring).rstrip('&')
             return ('%s&%s=%s' % (querystring, key, val)).lstrip('&')
 
     def get_verbose_name(self, model, column_name):
@@ -663,10 +684,13 @@ class Admin(object):
             admin_name = model_admin.get_admin_name()
             for url, callback in model_admin.get_urls():
                 full_url = '/%s%s' % (admin_name, url)
+                view = self.auth_required(callback)
+                if model_admin.query_budget is not None:
+                    view = query_budget(model_admin.query_budget)(view)
                 self.blueprint.add_url_rule(
                     full_url,
                     '%s_%s' % (admin_name, callback.__name__),
-                    self.auth_required(callback),
+                    view,
                     methods=['GET', 'POST'],
                 )
 
@@ -738,15 +762,14 @@ class Export(object):
             field_dict[field.model_class].append(field.name)
 
         def generate():
-            i = prepared_query.count()
             yield '[\n'
-            for obj in prepared_query:
-                i -= 1
-                yield json.dumps(serializer.serialize_object(obj, field_dict))
-                if i > 0:
+            for i, obj in enumerate(stream(prepared_query)):
+                if i:
                     yield ',\n'
+                yield json.dumps(serializer.serialize_object(obj, field_dict))
             yield '\n]'
         headers = Headers()
         headers.add('Content-Type', 'application/javascript')
         headers.add('Content-Disposition', 'attachment; filename=%s' % filename)
-        return Response(generate(), mimetype='text/javascript', headers=headers, direct_passthrough=True)
+        # keep the request, and its connection, open until the export is sent
+        return Response(stream_with_context(generate()), mimetype='text/javascript', headers=headers, direct_passthrough=True)
@@ -0,0 +1,214 @@
+"""
+Per-request query time budgets for the flask-peewee database wrapper.
+
+A slow filter can keep a request -- and the worker and connection serving it
+-- busy for minutes.  With a budget, the queries of each request must finish
+within the given number of seconds of the request starting, otherwise the
+request is answered with a ``503``:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'query_budget': 5,  # seconds, or None for per-view budgets only
+    }
+
+Each statement may only use what is left of the budget.  The database enforces
+this itself where it can: SQLite is interrupted by a progress handler, while
+Postgres and MySQL are given a statement timeout.  Views with needs of their
+own can have a different budget:
+
+    @app.route('/report/')
+    @query_budget(30)
+    def report():
+        ...
+"""
+import functools
+import math
+import time
+import weakref
+
+from flask import g
+from flask import has_request_context
+from peewee import MySQLDatabase
+from peewee import OperationalError
+from peewee import PostgresqlDatabase
+from peewee import SqliteDatabase
+
+from flask_peewee.concurrency import concurrency_for
+
+
+class QueryBudgetExceeded(OperationalError):
+    pass
+
+
+class QueryBudget(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = time.time() + seconds
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def exhausted(self):
+        return self.remaining() <= 0
+
+
+def get_query_budget():
+    if has_request_context():
+        return g.get('query_budget')
+
+def start_query_budget(seconds):
+    g.query_budget = QueryBudget(seconds)
+
+def query_budget(seconds):
+    """
+    Decorator giving a view a query budget of its own.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def inner(*args, **kwargs):
+            start_query_budget(seconds)
+            return view(*args, **kwargs)
+        return inner
+    return decorator
+
+
+class BudgetCursor(object):
+    """
+    Wraps a DB-API cursor, reporting rows which could not be fetched in time
+    as an exceeded budget.
+    """
+    def __init__(self, cursor, budget):
+        self._cursor = cursor
+        self._budget = budget
+
+    def _fetch(self, method, *args):
+        try:
+            return method(*args)
+        except Exception:
+            if self._budget.exhausted():
+                raise QueryBudgetExceeded(
+                    'Query time budget of %s seconds exceeded.' % self._budget.seconds)
+            raise
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class QueryBudgetDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which stops statements running past the
+    query budget of the current request.
+    """
+    # how many SQLite virtual machine instructions run between checks
+    progress_interval = 1000
+
+    # statement timeouts are rounded up to this many seconds, so that they
+    # don't change -- and need setting again -- with every statement
+    timeout_resolution = 0.25
+
+    def __init__(self, database, **kwargs):
+        self._budget_local = concurrency_for(self).local()
+        # the timeout set on each open connection, in milliseconds, or None
+        # while it isn't known
+        self._statement_timeouts = weakref.WeakKeyDictionary()
+        self._untracked_timeouts = False
+        super(QueryBudgetDatabase, self).__init__(database, **kwargs)
+
+    def initialize_connection(self, conn):
+        super(QueryBudgetDatabase, self).initialize_connection(conn)
+        if isinstance(self, SqliteDatabase):
+            conn.set_progress_handler(self._interrupt, self.progress_interval)
+
+    def _interrupt(self):
+        deadline = getattr(self._budget_local, 'deadline', None)
+        return deadline is not None and time.time() > deadline
+
+    def get_statement_timeout_sql(self):
+        if isinstance(self, PostgresqlDatabase):
+            return 'SET statement_timeout = %d'
+        elif isinstance(self, MySQLDatabase):
+            return 'SET SESSION max_execution_time = %d'
+
+    def get_statement_timeout(self, remaining):
+        resolution = self.timeout_resolution
+        return int(math.ceil(remaining / resolution) * resolution * 1000)
+
+    def set_statement_timeout(self, conn, timeout):
+        """
+        Limit the statements of ``conn`` to ``timeout`` milliseconds, where 0
+        lifts the limit.
+        """
+        sql = self.get_statement_timeout_sql()
+        if sql is None:
+            return
+        try:
+            current = self._statement_timeouts.get(conn, 0)
+        except TypeError:
+            # connections which can't be weakly referenced are set every time
+            conn.cursor().execute(sql % timeout)
+            self._untracked_timeouts = True
+            return
+        if current != timeout:
+            conn.cursor().execute(sql % timeout)
+            self._statement_timeouts[conn] = timeout
+
+    def forget_statement_timeout(self, conn):
+        # rolling back undoes a SET made in the transaction on Postgres, so
+        # the timeout is set again before the next statement
+        try:
+            if conn in self._statement_timeouts:
+                self._statement_timeouts[conn] = None
+        except TypeError:
+            pass
+
+    def rollback(self):
+        self.forget_statement_timeout(self.get_conn())
+        return super(QueryBudgetDatabase, self).rollback()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        try:
+            return self._execute_sql(sql, params, require_commit)
+        finally:
+            if sql[:8].upper() == 'ROLLBACK':
+                # rolled back to a savepoint
+                self.forget_statement_timeout(self.get_conn())
+
+    def _execute_sql(self, sql, params, require_commit):
+        budget = get_query_budget()
+        if budget is None:
+            self._budget_local.deadline = None
+            if self._statement_timeouts or self._untracked_timeouts:
+                self.set_statement_timeout(self.get_conn(), 0)
+            return super(QueryBudgetDatabase, self).execute_sql(
+                sql, params, require_commit)
+
+        remaining = budget.remaining()
+        if remaining <= 0:
+            raise QueryBudgetExceeded(
+                'Query time budget of %s seconds exceeded.' % budget.seconds)
+
+        # kept until the next statement, so that fetching rows is limited too
+        self._budget_local.deadline = budget.deadline
+        self.set_statement_timeout(self.get_conn(), self.get_statement_timeout(remaining))
+        try:
+            cursor = super(QueryBudgetDatabase, self).execute_sql(
+                sql, params, require_commit)
+        except Exception:
+            if budget.exhausted():
+                raise QueryBudgetExceeded(
+                    'Query time budget of %s seconds exceeded.' % budget.seconds)
+            raise
+        return BudgetCursor(cursor, budget)
@@ -0,0 +1,271 @@
+"""
+Caching of generated SQL for repeated query shapes.
+
+List endpoints build the same SELECT over and over, differing only in the
+values being filtered on.  With the SQL cache enabled, each query is reduced
+to a key describing its structure and the generated SQL string is stored
+under that key, so subsequent queries with the same shape only need to
+collect their parameters:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'sql_cache': True,
+        'sql_cache_size': 256,
+    }
+
+Reusing the identical SQL string also lets drivers which keep a statement
+cache, such as ``sqlite3``, reuse the already prepared statement.
+"""
+import threading
+from collections import OrderedDict
+
+from peewee import CompoundSelect
+from peewee import Field
+from peewee import ForeignKeyField
+from peewee import Model
+from peewee import ModelAlias
+from peewee import Node
+from peewee import SqliteDatabase
+
+
+class Uncacheable(Exception):
+    pass
+
+
+# marks a shape whose parameters could not be reproduced without compiling
+UNCACHEABLE = object()
+
+
+class SQLCache(object):
+    """
+    Thread-safe LRU mapping of query shape to generated SQL.
+    """
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                sql = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = sql
+            if sql is UNCACHEABLE:
+                self.bypasses += 1
+            else:
+                self.hits += 1
+            return sql
+
+    def set(self, key, sql):
+        with self._lock:
+            self._data[key] = sql
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+            }
+
+
+class ShapeWalker(object):
+    """
+    Walks a query the same way ``QueryCompiler.generate_select`` does, but
+    rather than generating SQL it produces a hashable key describing the shape
+    of the query, along with the parameters the compiler would have produced.
+    """
+    def __init__(self):
+        self.params = []
+
+    def walk_select(self, query):
+        if isinstance(query, CompoundSelect):
+            raise Uncacheable
+        if query._from is not None or query._windows is not None:
+            raise Uncacheable
+        if query._distinct not in (True, False):
+            raise Uncacheable
+
+        return (
+            query.model_class,
+            query._distinct,
+            self.walk_list(query._select),
+            self.walk_joins(query._joins),
+            self.walk(query._where),
+            self.walk_list(query._group_by or ()),
+            self.walk(query._having),
+            self.walk_list(query._order_by or ()),
+            query._limit,
+            query._offset,
+            query._for_update,
+        )
+
+    def walk_joins(self, joins):
+        # the order joins are generated in is hard to reproduce, so only
+        # joins without parameters are accepted
+        accum = []
+        for src in sorted(joins, key=lambda m: m.__name__):
+            if not (isinstance(src, type) and issubclass(src, Model)):
+                raise Uncacheable
+            for join in joins[src]:
+                if isinstance(join.dest, Node) or isinstance(join.dest, ModelAlias):
+                    raise Uncacheable
+                if isinstance(join.on, Node):
+                    params = self.params
+                    self.params = []
+                    on = self.walk(join.on)
+                    if self.params:
+                        raise Uncacheable
+                    self.params = params
+                else:
+                    on = join.on
+                accum.append((src, join.dest, join.join_type, on))
+        return tuple(accum)
+
+    def walk_list(self, nodes, conv=None):
+        return tuple([self.walk(node, conv) for node in nodes])
+
+    def walk(self, node, conv=None):
+        if node is None:
+            return None
+
+        node_type = getattr(node, '_node_type', None)
+        if node_type is not None:
+            walker = getattr(self, 'walk_%s' % node_type, None)
+            if walker is None:
+                raise Uncacheable
+            key, params, unknown = walker(node, conv)
+        elif isinstance(node, (list, tuple)):
+            key = ('list', self.walk_list(node, conv))
+            params, unknown = [], False
+        elif isinstance(node, Model):
+            key = 'instance'
+            if isinstance(conv, ForeignKeyField) and \
+                    not isinstance(conv.to_field, ForeignKeyField):
+                params = [conv.to_field.db_value(getattr(node, conv.to_field.name))]
+            else:
+                params = [node._get_pk_value()]
+            unknown = False
+        elif isinstance(node, type) and issubclass(node, Model):
+            key, params, unknown = ('model', node), [], False
+        elif isinstance(node, ModelAlias):
+            raise Uncacheable
+        else:
+            key, params, unknown = '?', [node], True
+
+        if unknown and conv and params:
+            params = [conv.db_value(p) for p in params]
+        self.params.extend(params)
+
+        if isinstance(node, Node):
+            return (key, node._negated, node._alias, node._ordering)
+        return key
+
+    def walk_expression(self, node, conv):
+        if isinstance(node.lhs, Field):
+            conv = node.lhs
+        lhs = self.walk(node.lhs, conv)
+        rhs = self.walk(node.rhs, conv)
+        return ('expression', node.op, node.flat, lhs, rhs), [], False
+
+    def walk_param(self, node, conv):
+        if node.conv:
+            params = [node.conv(node.value)]
+        else:
+            params = [node.value]
+        return ('param', node._node_type), params, node._node_type == 'param'
+
+    walk_passthrough = walk_param
+
+    def walk_func(self, node, conv):
+        conv = node._coerce and conv or None
+        args = self.walk_list(node.arguments, conv)
+        return ('func', node.name, args), [], False
+
+    def walk_clause(self, node, conv):
+        nodes = self.walk_list(node.nodes, conv)
+        return ('clause', type(node), node.glue, node.parens, nodes), [], False
+
+    def walk_entity(self, node, conv):
+        return ('entity', node.path), [], False
+
+    def walk_field(self, node, conv):
+        if isinstance(node.model_class, ModelAlias):
+            raise Uncacheable
+        return ('field', node.model_class, node.name), [], False
+
+    def walk_sql(self, node, conv):
+        return ('sql', node.value), list(node.params), False
+
+    def walk_strip_parens(self, node, conv):
+        return ('strip_parens', self.walk(node.node, conv)), [], False
+
+
+class CachingQueryCompiler(object):
+    """
+    Mixin for a ``peewee.QueryCompiler`` which consults the database's SQL
+    cache before generating a top-level SELECT.
+    """
+    sql_cache = None
+
+    def generate_select(self, query, alias_map=None):
+        if self.sql_cache is None or alias_map is not None:
+            return super(CachingQueryCompiler, self).generate_select(query, alias_map)
+
+        walker = ShapeWalker()
+        try:
+            key = walker.walk_select(query)
+        except Uncacheable:
+            return super(CachingQueryCompiler, self).generate_select(query)
+
+        sql = self.sql_cache.get(key)
+        if sql is UNCACHEABLE:
+            return super(CachingQueryCompiler, self).generate_select(query)
+        elif sql is not None:
+            return sql, walker.params
+
+        sql, params = super(CachingQueryCompiler, self).generate_select(query)
+        if params == walker.params:
+            self.sql_cache.set(key, sql)
+        else:
+            self.sql_cache.set(key, UNCACHEABLE)
+        return sql, params
+
+
+class SQLCacheDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which caches the SQL generated for SELECT
+    queries, keyed by the shape of the query.
+    """
+    def __init__(self, database, sql_cache=True, sql_cache_size=256, **kwargs):
+        self.sql_cache = SQLCache(sql_cache_size)
+        self.compiler_class = type(
+            self.compiler_class.__name__,
+            (CachingQueryCompiler, self.compiler_class),
+            {})
+
+        if isinstance(self, SqliteDatabase):
+            # let sqlite3 keep a prepared statement for every cached query
+            kwargs.setdefault('cached_statements', sql_cache_size)
+
+        super(SQLCacheDatabase, self).__init__(database, **kwargs)
+
+    def compiler(self):
+        compiler = super(SQLCacheDatabase, self).compiler()
+        compiler.sql_cache = self.sql_cache
+        return compiler
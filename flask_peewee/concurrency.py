@@ -0,0 +1,220 @@
+"""
+Cooperative concurrency for the flask-peewee database wrapper.
+
+peewee keeps the connection of each thread in a thread local, so greenlets or
+asyncio tasks sharing a thread would also share a connection.  With the
+``concurrency`` option, connection state is kept per greenlet or task instead,
+and waiting for a pooled connection yields to the others:
+
+    DATABASE = {
+        'name': 'my_app',
+        'engine': 'peewee.PostgresqlDatabase',
+        'concurrency': 'greenlet',  # or "asyncio"
+        'pool': True,
+        'max_connections': 8,
+        'checkout_timeout': 10,
+    }
+
+The ``"greenlet"`` mode requires gevent, but not monkey-patching.
+"""
+import threading
+import weakref
+
+from peewee import _BaseConnectionLocal
+from peewee import _ConnectionLocal
+
+from flask_peewee.exceptions import ImproperlyConfigured
+
+try:
+    from asyncio import current_task as _current_task
+except ImportError:
+    try:
+        from asyncio import Task
+        _current_task = Task.current_task
+    except ImportError:
+        _current_task = None
+
+
+class _State(object):
+    pass
+
+
+class TaskLocal(object):
+    """
+    Like ``threading.local``, keeping a separate set of attributes for every
+    greenlet or task identified by ``get_ident``.
+    """
+    state_class = _State
+
+    def __init__(self, get_ident):
+        object.__setattr__(self, '_get_ident', get_ident)
+        # state is dropped with the greenlet or task it belongs to
+        object.__setattr__(self, '_states', weakref.WeakKeyDictionary())
+
+    def _get_state(self):
+        ident = self._get_ident()
+        state = self._states.get(ident)
+        if state is None:
+            state = self._states[ident] = self.state_class()
+        return state
+
+    def __getattr__(self, name):
+        return getattr(self._get_state(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_state(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get_state(), name)
+
+
+class TaskConnectionLocal(TaskLocal):
+    state_class = _BaseConnectionLocal
+
+
+class ThreadConcurrency(object):
+    """
+    The primitives used to keep and coordinate per-thread database state.
+    """
+    name = 'thread'
+
+    def get_ident(self):
+        return threading.current_thread()
+
+    def lock(self):
+        return threading.Lock()
+
+    def event(self):
+        return threading.Event()
+
+    def local(self):
+        return threading.local()
+
+    def connection_local(self):
+        return _ConnectionLocal()
+
+
+class GreenletConcurrency(ThreadConcurrency):
+    name = 'greenlet'
+
+    def __init__(self):
+        try:
+            import gevent.event
+            import gevent.lock
+            from greenlet import getcurrent
+        except ImportError:
+            raise ImproperlyConfigured('The "greenlet" concurrency mode requires gevent')
+        self._event = gevent.event.Event
+        self._lock = gevent.lock.Semaphore
+        self.get_ident = getcurrent
+
+    def lock(self):
+        return self._lock()
+
+    def event(self):
+        return self._event()
+
+    def local(self):
+        return TaskLocal(self.get_ident)
+
+    def connection_local(self):
+        return TaskConnectionLocal(self.get_ident)
+
+
+class AsyncioConcurrency(ThreadConcurrency):
+    """
+    Database calls block the event loop, so a task can't wait for another to
+    return its connection: ``event()`` returns ``None`` and an exhausted pool
+    raises immediately.
+    """
+    name = 'asyncio'
+
+    def __init__(self):
+        if _current_task is None:
+            raise ImproperlyConfigured('The "asyncio" concurrency mode requires asyncio')
+
+    def get_ident(self):
+        try:
+            task = _current_task()
+        except RuntimeError:
+            task = None
+        # outside of a task, fall back to the thread
+        return task if task is not None else threading.current_thread()
+
+    def event(self):
+        return None
+
+    def local(self):
+        return TaskLocal(self.get_ident)
+
+    def connection_local(self):
+        return TaskConnectionLocal(self.get_ident)
+
+
+CONCURRENCY = {
+    'thread': ThreadConcurrency,
+    'greenlet': GreenletConcurrency,
+    'asyncio': AsyncioConcurrency,
+}
+
+THREADS = ThreadConcurrency()
+
+
+def get_concurrency(name):
+    try:
+        return CONCURRENCY[name]()
+    except KeyError:
+        raise ImproperlyConfigured('Unknown concurrency mode: "%s"' % name)
+
+
+def concurrency_for(database):
+    return getattr(database, 'concurrency', THREADS)
+
+
+def get_connection_local(database):
+    """
+    Return the object holding the connection state of a ``peewee.Database``,
+    which peewee 2.8.1 and later keep in ``_local`` and earlier versions in a
+    name-mangled ``__local``.
+    """
+    local = getattr(database, '_local', None)
+    if local is None:
+        local = database._Database__local
+    return local
+
+
+def set_connection_local(database, local):
+    if hasattr(database, '_Database__local'):
+        database._Database__local = local
+    else:
+        database._local = local
+
+
+def get_exception_wrapper(database):
+    """
+    Return the context manager translating driver errors into peewee's, which
+    peewee 2.10 keeps in ``exception_wrapper`` and earlier versions create by
+    calling it.
+    """
+    wrapper = database.exception_wrapper
+    if callable(wrapper):
+        wrapper = wrapper()
+    return wrapper
+
+
+class CooperativeDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which keeps its connection state per
+    greenlet or asyncio task, as selected by ``concurrency``.
+    """
+    def __init__(self, database, concurrency='greenlet', threadlocals=True, **kwargs):
+        # set first, so that the other mixins can create their state with it
+        self.concurrency = get_concurrency(concurrency)
+        super(CooperativeDatabase, self).__init__(
+            database,
+            threadlocals=threadlocals,
+            **kwargs)
+
+        if threadlocals:
+            set_connection_local(self, self.concurrency.connection_local())
+        self._conn_lock = self.concurrency.lock()
@@ -0,0 +1,164 @@
+"""
+Handling of write contention for SQLite databases.
+
+SQLite allows a single writer at a time, and a connection which cannot get
+the write lock fails with "database is locked".  Statements failing this way
+can be retried with a jittered exponential backoff:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'busy_retries': 5,
+        'busy_backoff': 0.01,     # first delay, doubling on each attempt
+        'busy_max_backoff': 0.5,  # upper bound for a single delay
+    }
+
+When many threads of one process write, ``single_writer`` makes them take
+turns in Python instead of competing for SQLite's lock, while reads stay
+concurrent.  It works best with the write-ahead log, e.g. with the
+``"performance"`` pragmas:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'pragmas': 'performance',
+        'single_writer': True,
+    }
+"""
+import logging
+import random
+import re
+import time
+
+from peewee import OperationalError
+
+from flask_peewee.concurrency import concurrency_for
+from flask_peewee.utils import is_write_query
+
+
+logger = logging.getLogger('flask_peewee.contention')
+
+_busy_error = re.compile(r'database (?:table |schema )?is (?:locked|busy)')
+
+def is_busy_error(exc):
+    return isinstance(exc, OperationalError) and bool(_busy_error.search(str(exc)))
+
+
+def is_begin_query(sql):
+    return sql.lstrip()[:5].upper() == 'BEGIN'
+
+def is_write_lock_query(sql):
+    if is_write_query(sql):
+        return True
+    sql = sql.lstrip()[:15].upper()
+    return sql.startswith(('BEGIN IMMEDIATE', 'BEGIN EXCLUSIVE'))
+
+
+class BusyRetryDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which retries statements that fail because
+    the database is locked.
+
+    Only statements which begin a transaction or run outside of one are
+    retried; within a transaction the lock may be held up by this very
+    connection, so the error is raised and the transaction should be retried
+    as a whole.
+    """
+    def __init__(self, database, busy_retries=5, busy_backoff=0.01,
+                 busy_max_backoff=0.5, **kwargs):
+        self.busy_retries = busy_retries
+        self.busy_backoff = busy_backoff
+        self.busy_max_backoff = busy_max_backoff
+        super(BusyRetryDatabase, self).__init__(database, **kwargs)
+
+    def get_busy_delay(self, attempt):
+        # "full jitter", so that writers which collided don't collide again
+        return random.uniform(0, min(
+            self.busy_max_backoff,
+            self.busy_backoff * (2 ** attempt)))
+
+    def can_retry(self, sql):
+        if is_begin_query(sql):
+            return True
+        return self.transaction_depth() == 0 and self.get_autocommit()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        attempt = 0
+        while True:
+            try:
+                return super(BusyRetryDatabase, self).execute_sql(
+                    sql, params, require_commit)
+            except OperationalError as exc:
+                if attempt >= self.busy_retries or not is_busy_error(exc) or \
+                        not self.can_retry(sql):
+                    raise
+            delay = self.get_busy_delay(attempt)
+            attempt += 1
+            logger.debug('Database busy, retrying in %.3fs (%s of %s).',
+                         delay, attempt, self.busy_retries)
+            time.sleep(delay)
+
+
+class SingleWriterDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which allows one thread at a time to
+    write.  A thread takes the write lock before its first write statement
+    and holds it until the write is committed or rolled back, so a
+    transaction keeps it across all of its statements.
+    """
+    def __init__(self, database, single_writer=True, **kwargs):
+        concurrency = concurrency_for(self)
+        self._write_lock = concurrency.lock()
+        self._writer = concurrency.local()
+        super(SingleWriterDatabase, self).__init__(database, **kwargs)
+
+    def holds_write_lock(self):
+        return getattr(self._writer, 'held', False)
+
+    def acquire_write_lock(self):
+        if not self.holds_write_lock():
+            self._write_lock.acquire()
+            self._writer.held = True
+
+    def release_write_lock(self):
+        if self.holds_write_lock():
+            self._writer.held = False
+            self._write_lock.release()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if not is_write_lock_query(sql):
+            return super(SingleWriterDatabase, self).execute_sql(
+                sql, params, require_commit)
+
+        self.acquire_write_lock()
+        try:
+            cursor = super(SingleWriterDatabase, self).execute_sql(
+                sql, params, require_commit)
+        except:
+            if is_begin_query(sql) or (
+                    self.transaction_depth() == 0 and self.get_autocommit()):
+                self.release_write_lock()
+            raise
+        if not require_commit and not is_begin_query(sql) and \
+                self.transaction_depth() == 0 and self.get_autocommit():
+            # executed in autocommit mode without an explicit commit
+            self.release_write_lock()
+        return cursor
+
+    def commit(self):
+        try:
+            return super(SingleWriterDatabase, self).commit()
+        finally:
+            self.release_write_lock()
+
+    def rollback(self):
+        try:
+            return super(SingleWriterDatabase, self).rollback()
+        finally:
+            self.release_write_lock()
+
+    def close(self):
+        try:
+            return super(SingleWriterDatabase, self).close()
+        finally:
+            self.release_write_lock()
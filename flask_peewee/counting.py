@@ -0,0 +1,208 @@
+"""
+Strategies for counting the rows of a paginated query.
+
+Page links need the number of rows the query matches, and on large tables a
+``COUNT(*)`` costs more than fetching the page itself.  ``PaginatedQuery``,
+and the ``RestResource`` and ``ModelAdmin`` through their ``count_strategy``,
+can count in one of several ways:
+
+    from flask_peewee.counting import CachedCount, CappedCount
+
+    class MessageAdmin(ModelAdmin):
+        # "10,000+" rather than an exact count, remembered for a minute
+        count_strategy = CachedCount(CappedCount(10000), ttl=60)
+
+Counts which aren't exact are reported as such, and the pagination then finds
+out whether there is a next page by looking for its first row.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import MySQLDatabase
+from peewee import PostgresqlDatabase
+from peewee import SQL
+from peewee import SqliteDatabase
+from peewee import fn
+
+from flask_peewee.tenants import get_tenant_namespace
+
+
+class CountStrategy(object):
+    """
+    Counts the rows of a query, returning the count and whether it is exact.
+    """
+    def paginate(self, query, page, paginate_by):
+        """
+        Return the query for one page of ``query``.
+        """
+        return query.paginate(page, paginate_by)
+
+    def count(self, query, page_query):
+        raise NotImplementedError
+
+
+class ExactCount(CountStrategy):
+    """
+    Runs a ``COUNT(*)`` of the whole query.
+    """
+    def count(self, query, page_query):
+        return query.count(), True
+
+
+class CappedCount(CountStrategy):
+    """
+    Counts no further than ``cap`` rows -- or than the end of the requested
+    page, if that lies beyond -- reporting larger counts as inexact.
+    """
+    def __init__(self, cap=10000):
+        self.cap = cap
+
+    def count(self, query, page_query):
+        limit = max(self.cap, (page_query._offset or 0) + (page_query._limit or 0))
+        sql, params = query.order_by().limit(limit + 1).sql()
+        cursor = query.database.execute_sql(
+            'SELECT COUNT(1) FROM (%s) AS wrapped_select' % sql,
+            params,
+            query.require_commit)
+        count = cursor.fetchone()[0]
+        if count > limit:
+            return limit, False
+        return count, True
+
+
+class EstimatedCount(CountStrategy):
+    """
+    Takes the number of rows the query planner expects, from Postgres' and
+    MySQL's ``EXPLAIN`` or SQLite's ``sqlite_stat1`` table (written by
+    ``ANALYZE``).  Queries whose estimate is below ``exact_below`` rows, and
+    filtered SQLite queries, are counted exactly.
+    """
+    def __init__(self, exact_below=1000, fallback=None):
+        self.exact_below = exact_below
+        self.fallback = fallback or ExactCount()
+
+    def estimate(self, query):
+        """
+        Return the planner's estimate of the rows matched by ``query``, or
+        ``None`` if there is none.
+        """
+        database = query.database
+        sql, params = query.order_by().sql()
+
+        if isinstance(database, PostgresqlDatabase):
+            cursor = database.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+
+        elif isinstance(database, MySQLDatabase):
+            cursor = database.execute_sql('EXPLAIN ' + sql, params)
+            columns = [column[0].lower() for column in cursor.description]
+            row = dict(zip(columns, cursor.fetchone()))
+            return int((row.get('rows') or 0) * float(row.get('filtered') or 100) / 100)
+
+        elif isinstance(database, SqliteDatabase):
+            # the statistics only know the size of whole tables
+            if query._where is not None or any(query._joins.values()) or query._group_by or \
+                    query._having is not None or query._distinct:
+                return None
+            cursor = database.execute_sql(
+                'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+                ('table', 'sqlite_stat1'))
+            if cursor.fetchone() is None:
+                return None
+            # each row of a table starts with the number of rows it has
+            cursor = database.execute_sql(
+                'SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1',
+                (query.model_class._meta.db_table,))
+            row = cursor.fetchone()
+            if row is not None:
+                return int(row[0].split()[0])
+
+    def count(self, query, page_query):
+        estimate = self.estimate(query)
+        if estimate is None or estimate < self.exact_below:
+            return self.fallback.count(query, page_query)
+        return estimate, False
+
+
+class WindowCount(CountStrategy):
+    """
+    Selects ``COUNT(*) OVER ()`` along with the rows of the page, counting
+    them in the same round trip.  Needs a database with window functions:
+    Postgres, SQLite 3.25+ or MySQL 8.
+    """
+    alias = 'flask_peewee_count'
+
+    def paginate(self, query, page, paginate_by):
+        page_query = query.paginate(page, paginate_by)
+        page_query._select = list(page_query._select) + [
+            fn.COUNT(SQL('*')).over().alias(self.alias)]
+        return page_query
+
+    def count(self, query, page_query):
+        for row in page_query:
+            if isinstance(row, dict):
+                return row[self.alias], True
+            return getattr(row, self.alias), True
+        # past the last page, there is no row to read the count from
+        return query.count(), True
+
+
+class CachedCount(CountStrategy):
+    """
+    Remembers the counts of ``strategy`` -- exact counts by default -- for
+    ``ttl`` seconds, by query SQL and parameters.
+    """
+    def __init__(self, strategy=None, ttl=60, max_size=1024):
+        self.strategy = strategy or ExactCount()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, query):
+        sql, params = query.sql()
+        return (get_tenant_namespace(query.database), sql, tuple(params))
+
+    def paginate(self, query, page, paginate_by):
+        return self.strategy.paginate(query, page, paginate_by)
+
+    def count(self, query, page_query):
+        key = self.get_key(query)
+        try:
+            hash(key)
+        except TypeError:
+            return self.strategy.count(query, page_query)
+
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] >= time.time():
+                self._data[key] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        result = self.strategy.count(query, page_query)
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, result)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -1,14 +1,108 @@
+import os
+import re
+import sqlite3
+
 import peewee
+from flask import abort
+from flask import g
+from flask import request
+from flask import Response
 from peewee import *
 
+from flask_peewee._compat import PY2
+from flask_peewee._compat import string_types
+from flask_peewee.budget import QueryBudgetDatabase
+from flask_peewee.budget import QueryBudgetExceeded
+from flask_peewee.budget import start_query_budget
+from flask_peewee.compiler import SQLCacheDatabase
+from flask_peewee.concurrency import CooperativeDatabase
+from flask_peewee.contention import BusyRetryDatabase
+from flask_peewee.contention import SingleWriterDatabase
 from flask_peewee.exceptions import ImproperlyConfigured
+from flask_peewee.fork import ForkSafeDatabase
+from flask_peewee.instrumentation import InstrumentedDatabase
+from flask_peewee.invalidation import InvalidationBus
+from flask_peewee.invalidation import InvalidationDatabase
+from flask_peewee.invalidation import TRANSPORTS
+from flask_peewee.instrumentation import NPlusOneDatabase
+from flask_peewee.instrumentation import QueryStats
+from flask_peewee.pageindex import PageBoundaryIndex
+from flask_peewee.pageindex import PageIndexDatabase
+from flask_peewee.pool import PooledDatabase
+from flask_peewee.replicas import ReplicatedDatabase
+from flask_peewee.resultcache import CachedModel
+from flask_peewee.resultcache import ResultCache
+from flask_peewee.resultcache import ResultCacheDatabase
+from flask_peewee.shards import ShardedModel
+from flask_peewee.shards import ShardRouter
+from flask_peewee.streaming import StreamingDatabase
+from flask_peewee.tenants import TenantDatabase
 from flask_peewee.utils import load_class
+from flask_peewee.writebehind import WriteBehind
+
+
+# settings applied to every new sqlite connection with "pragmas": "performance"
+PERFORMANCE_PRAGMAS = (
+    ('busy_timeout', 5000),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -1024 * 64),
+    ('mmap_size', 1024 * 1024 * 256),
+    ('temp_store', 'memory'),
+)
+
+PRAGMA_PRESETS = {
+    'performance': PERFORMANCE_PRAGMAS,
+}
+
+# connection pool settings, which apply to tenants when "pool" is not enabled
+POOL_OPTIONS = ('max_connections', 'stale_timeout', 'checkout_timeout')
 
+# tenants which may be substituted into "tenant_name"
+_tenant_re = re.compile(r'^[\w-]+$')
 
 class Database(object):
+    # recycle connections between requests, enabled with "pool": True
+    pool = False
+
+    # defer connecting until the first query of a request, "lazy": True
+    lazy = False
+
+    # discard connections inherited across a fork, "fork_safe": True, and
+    # open "warm_connections" in each new worker from post_fork()
+    fork_safe = False
+    warm_connections = 0
+
+    # run each request in a single transaction, "transaction_per_request": True
+    transaction_per_request = False
+
+    # record per-request query statistics in g.query_stats, "instrument": True
+    instrument = False
+    instrument_headers = False
+    instrument_slowest = 5
+
+    # seconds each request's queries may take, "query_budget": 5, or None to
+    # enforce only the budgets given to individual views
+    query_budget = None
+    enforce_query_budget = False
+
+    # buffer of delayed writes, created with "write_behind": True
+    write_behind = None
+
     def __init__(self, app, database=None):
         self.app = app
         self.database = database
+        self.replicas = []
+        self.shards = []
+        self.shard_router = None
+        self.tenant_resolver = None
+        self.tenants = {}
+        self.tenant_name = None
+        self.tenant_exists = None
+        self.invalidation_bus = None
+        self.no_transaction_views = set()
+        self.isolation = None
+        self._shared_cache_conn = None
 
         if self.database is None:
             self.load_database()
@@ -25,32 +119,453 @@ class Database(object):
         except KeyError:
             raise ImproperlyConfigured('Please specify a "name" and "engine" for your database')
 
+        if 'pragmas' in self.database_config:
+            self.database_config['pragmas'] = self.get_pragmas(
+                self.database_engine,
+                self.database_config['pragmas'])
+
+        if self.database_config.pop('shared_cache', False):
+            self.database_name = self.get_shared_cache_name(
+                self.database_engine,
+                self.database_name)
+            self.database_config['uri'] = True
+            # the database only lives as long as one of its connections
+            self._shared_cache_conn = sqlite3.connect(self.database_name, uri=True)
+
+        if self.database_config.get('concurrency') == 'thread':
+            del self.database_config['concurrency']
+
+        self.pool = self.database_config.pop('pool', self.pool)
+        self.lazy = self.database_config.pop('lazy', self.lazy)
+        self.fork_safe = self.database_config.pop('fork_safe', self.fork_safe)
+        self.warm_connections = self.database_config.pop('warm_connections', self.warm_connections)
+        self.transaction_per_request = self.database_config.pop(
+            'transaction_per_request',
+            self.transaction_per_request)
+        self.instrument = self.database_config.pop('instrument', self.instrument)
+        self.instrument_headers = self.database_config.pop('instrument_headers', self.instrument_headers)
+        self.instrument_slowest = self.database_config.pop('instrument_slowest', self.instrument_slowest)
+        if 'query_budget' in self.database_config:
+            self.enforce_query_budget = True
+            self.query_budget = self.database_config.pop('query_budget')
+        write_behind = self.database_config.pop('write_behind', False)
+        write_behind_interval = self.database_config.pop('write_behind_interval', 1.0)
+        write_behind_size = self.database_config.pop('write_behind_size', 1000)
+        write_behind_retries = self.database_config.pop('write_behind_retries', 3)
+
+        if self.database_config.get('result_cache'):
+            # shared by the primary and its replicas, so that writes to the
+            # primary invalidate results read from a replica
+            self.database_config['result_cache'] = ResultCache(
+                self.database_config.pop('result_cache_size', 1024),
+                self.database_config.pop('result_cache_ttl', 300),
+                self.database_config.pop('result_cache_max_rows', 1000))
+
+        if self.database_config.get('page_index'):
+            self.database_config['page_index'] = PageBoundaryIndex(
+                self.database_config.pop('page_index_step', 1000),
+                self.database_config.pop('page_index_size', 256))
+
+        # options consumed by the primary database only
+        primary_options = {}
+        if 'replica_policy' in self.database_config:
+            primary_options['replica_policy'] = self.load_config_class(
+                self.database_config.pop('replica_policy'), 'Replica policy')
+        if 'sticky_window' in self.database_config:
+            primary_options['sticky_window'] = self.database_config.pop('sticky_window')
+
+        invalidation_bus = self.database_config.pop('invalidation_bus', None)
+        invalidation_bus_path = self.database_config.pop('invalidation_bus_path', None)
+        poll_interval = self.database_config.pop('invalidation_poll_interval', 1.0)
+        if invalidation_bus is not None:
+            self.invalidation_bus = self.load_invalidation_bus(
+                invalidation_bus,
+                invalidation_bus_path,
+                poll_interval)
+            primary_options['invalidation_bus'] = self.invalidation_bus
+            if self.database_config.get('result_cache'):
+                self.invalidation_bus.subscribe(self.database_config['result_cache'].invalidate)
+            if self.database_config.get('page_index'):
+                self.invalidation_bus.subscribe(self.database_config['page_index'].invalidate)
+
+        shard_router = ShardRouter
+        if 'shard_router' in self.database_config:
+            shard_router = self.load_config_class(
+                self.database_config.pop('shard_router'), 'Shard router')
+
+        for replica_config in self.database_config.pop('replicas', None) or ():
+            self.replicas.append(self.load_replica(replica_config))
+        if self.replicas:
+            primary_options['replicas'] = self.replicas
+
+        for shard_config in self.database_config.pop('shards', None) or ():
+            self.shards.append(self.load_shard(shard_config))
+        if self.shards:
+            self.shard_router = shard_router(self.shards)
+
+        tenant_resolver = self.database_config.pop('tenant_resolver', None)
+        self.tenants = self.database_config.pop('tenants', None) or {}
+        self.tenant_name = self.database_config.pop('tenant_name', None)
+        tenant_exists = self.database_config.pop('tenant_exists', None)
+        if tenant_exists is not None:
+            if isinstance(tenant_exists, string_types):
+                tenant_exists = self.load_config_class(tenant_exists, 'Tenant check')
+            self.tenant_exists = tenant_exists
+        elif self.tenant_name and not issubclass(
+                self.load_config_class(self.database_engine), SqliteDatabase):
+            raise ImproperlyConfigured(
+                'Please specify "tenant_exists" to check the tenants whose '
+                'database is named by "tenant_name"')
+        if 'max_tenants' in self.database_config:
+            primary_options['max_tenants'] = self.database_config.pop('max_tenants')
+        if tenant_resolver is not None:
+            self.tenant_resolver = self.load_tenant_resolver(tenant_resolver)
+            primary_options['tenant_factory'] = self.load_tenant
+
+        mixins = self.get_database_mixins()
+        database_config = dict(self.database_config, **primary_options)
+        if PooledDatabase not in mixins:
+            for key in POOL_OPTIONS:
+                database_config.pop(key, None)
+
+        self.database_class = self.get_database_class(self.database_engine, mixins)
+        self.database = self.database_class(self.database_name, **database_config)
+
+        if write_behind:
+            self.write_behind = WriteBehind(
+                self.database,
+                write_behind_interval,
+                write_behind_size,
+                retries=write_behind_retries)
+
+    def load_replica(self, replica_config):
+        return self.load_secondary_database(replica_config, 'replica')
+
+    def load_shard(self, shard_config):
+        return self.load_secondary_database(shard_config, 'shard')
+
+    def get_tenant_config(self, tenant):
+        if tenant in self.tenants:
+            return self.tenants[tenant]
+        if self.tenant_name and _tenant_re.match(tenant):
+            return {'name': self.tenant_name % tenant}
+
+    def is_known_tenant(self, tenant):
+        """
+        Return whether requests may be routed to ``tenant``.  Listed tenants
+        always are, any other once ``tenant_exists`` confirms it -- by default
+        that its SQLite database exists, as connecting would create it.
+        """
+        if tenant in self.tenants:
+            return True
+        config = self.get_tenant_config(tenant)
+        if config is None:
+            return False
+        if self.tenant_exists is not None:
+            return bool(self.tenant_exists(tenant))
+        return os.path.exists(config['name'])
+
+    def load_tenant(self, tenant):
+        # each tenant has a connection pool of its own
+        mixins = self.get_database_mixins(replica=True)
+        if PooledDatabase not in mixins:
+            mixins.append(PooledDatabase)
+        return self.load_secondary_database(
+            self.get_tenant_config(tenant),
+            'tenant',
+            mixins)
+
+    def load_tenant_resolver(self, tenant_resolver):
+        if isinstance(tenant_resolver, string_types):
+            tenant_resolver = self.load_config_class(tenant_resolver, 'Tenant resolver')
+        if isinstance(tenant_resolver, type):
+            tenant_resolver = tenant_resolver()
+        return tenant_resolver
+
+    def load_invalidation_bus(self, transport, path=None, poll_interval=1.0):
+        if isinstance(transport, InvalidationBus):
+            return transport
+        if isinstance(transport, string_types):
+            if transport in TRANSPORTS:
+                if path is None:
+                    raise ImproperlyConfigured('Please specify an "invalidation_bus_path"')
+                transport = TRANSPORTS[transport]
+            else:
+                transport = self.load_config_class(transport, 'Invalidation transport')
+        if isinstance(transport, type):
+            transport = transport(path) if path is not None else transport()
+        return InvalidationBus(transport, poll_interval)
+
+    def load_secondary_database(self, secondary_config, description, mixins=None):
+        # replicas, shards and tenants inherit the engine and connection
+        # parameters of the primary
+        config = dict(self.database_config, **secondary_config)
+        engine = config.pop('engine', self.database_engine)
+        try:
+            name = config.pop('name')
+        except KeyError:
+            raise ImproperlyConfigured('Please specify a "name" for each %s' % description)
+        if 'pragmas' in config:
+            config['pragmas'] = self.get_pragmas(engine, config['pragmas'])
+
+        if mixins is None:
+            mixins = self.get_database_mixins(replica=True)
+        database_class = self.get_database_class(engine, mixins)
+        return database_class(name, **config)
+
+    def load_config_class(self, path, description='Database engine'):
         try:
-            self.database_class = load_class(self.database_engine)
-            assert issubclass(self.database_class, peewee.Database)
+            return load_class(path)
         except ImportError:
-            raise ImproperlyConfigured('Unable to import: "%s"' % self.database_engine)
+            raise ImproperlyConfigured('Unable to import: "%s"' % path)
         except AttributeError:
-            raise ImproperlyConfigured('Database engine not found: "%s"' % self.database_engine)
-        except AssertionError:
-            raise ImproperlyConfigured('Database engine not a subclass of peewee.Database: "%s"' % self.database_engine)
+            raise ImproperlyConfigured('%s not found: "%s"' % (description, path))
+
+    def get_database_class(self, engine, mixins):
+        database_class = self.load_config_class(engine)
+        if not issubclass(database_class, peewee.Database):
+            raise ImproperlyConfigured('Database engine not a subclass of peewee.Database: "%s"' % engine)
+
+        if mixins:
+            database_class = type(
+                database_class.__name__,
+                tuple(mixins) + (database_class,),
+                {})
+        return database_class
+
+    def get_shared_cache_name(self, engine, name):
+        if not issubclass(self.load_config_class(engine), SqliteDatabase):
+            raise ImproperlyConfigured('Shared cache is only supported by sqlite databases: "%s"' % engine)
+        if PY2:
+            raise ImproperlyConfigured('Shared cache requires Python 3')
+        if name == ':memory:':
+            name = 'flask_peewee_%s' % id(self)
+        return 'file:%s?mode=memory&cache=shared' % name
 
-        self.database = self.database_class(self.database_name, **self.database_config)
+    def get_pragmas(self, engine, pragmas):
+        if not issubclass(self.load_config_class(engine), SqliteDatabase):
+            raise ImproperlyConfigured('Pragmas are only supported by sqlite databases: "%s"' % engine)
+
+        if isinstance(pragmas, string_types):
+            try:
+                pragmas = PRAGMA_PRESETS[pragmas]
+            except KeyError:
+                raise ImproperlyConfigured('Unknown pragma preset: "%s"' % pragmas)
+        elif isinstance(pragmas, dict):
+            pragmas = pragmas.items()
+
+        # peewee applies these, in order, whenever it opens a connection
+        return list(pragmas)
+
+    def get_database_mixins(self, replica=False):
+        mixins = []
+        if self.database_config.get('concurrency'):
+            mixins.append(CooperativeDatabase)
+        if self.fork_safe:
+            mixins.append(ForkSafeDatabase)
+        if self.replicas and not replica:
+            mixins.append(ReplicatedDatabase)
+        if self.tenant_resolver and not replica:
+            mixins.append(TenantDatabase)
+        if self.database_config.get('n_plus_one'):
+            mixins.append(NPlusOneDatabase)
+        if self.instrument:
+            mixins.append(InstrumentedDatabase)
+        if self.database_config.get('sql_cache'):
+            mixins.append(SQLCacheDatabase)
+        if self.database_config.get('result_cache'):
+            mixins.append(ResultCacheDatabase)
+        if self.database_config.get('page_index'):
+            mixins.append(PageIndexDatabase)
+        if self.invalidation_bus and not replica:
+            mixins.append(InvalidationDatabase)
+        if self.enforce_query_budget:
+            mixins.append(QueryBudgetDatabase)
+        if self.database_config.get('single_writer'):
+            mixins.append(SingleWriterDatabase)
+        if self.database_config.get('busy_retries'):
+            mixins.append(BusyRetryDatabase)
+        if self.database_config.get('streaming'):
+            mixins.append(StreamingDatabase)
+        if self.pool:
+            mixins.append(PooledDatabase)
+        return mixins
 
     def get_model_class(self):
-        class BaseModel(Model):
-            class Meta:
-                database = self.database
+        if self.shards:
+            class BaseModel(ShardedModel):
+                class Meta:
+                    database = self.database
+                    shard_router = self.shard_router
+        elif isinstance(self.database, ResultCacheDatabase):
+            class BaseModel(CachedModel):
+                class Meta:
+                    database = self.database
+        else:
+            class BaseModel(Model):
+                class Meta:
+                    database = self.database
 
         return BaseModel
 
+    def get_databases(self):
+        return [self.database] + self.replicas + self.shards
+
+    def get_pool_stats(self):
+        if isinstance(self.database, PooledDatabase):
+            return self.database.get_stats()
+
+    def get_tenant_stats(self):
+        if isinstance(self.database, TenantDatabase):
+            return self.database.get_tenant_stats()
+
+    def get_sql_cache_stats(self):
+        if isinstance(self.database, SQLCacheDatabase):
+            return self.database.sql_cache.get_stats()
+
+    def get_result_cache_stats(self):
+        if isinstance(self.database, ResultCacheDatabase):
+            return self.database.result_cache.get_stats()
+
+    def get_page_index_stats(self):
+        if isinstance(self.database, PageIndexDatabase):
+            return self.database.page_index.get_stats()
+
+    def get_invalidation_stats(self):
+        if self.invalidation_bus is not None:
+            return self.invalidation_bus.get_stats()
+
+    def get_write_behind_stats(self):
+        if self.write_behind is not None:
+            return self.write_behind.get_stats()
+
+    def get_query_stats(self):
+        return getattr(g, 'query_stats', None)
+
+    def start_instrumentation(self):
+        g.query_stats = QueryStats(self.instrument_slowest)
+
+    def add_instrumentation_headers(self, response):
+        stats = self.get_query_stats()
+        if stats is not None:
+            for header, value in stats.get_headers():
+                response.headers.add(header, value)
+        return response
+
+    def start_query_budget(self):
+        start_query_budget(self.query_budget)
+
+    def response_budget_exceeded(self, exc):
+        self.app.logger.warning('Request to %s stopped: %s', request.path, exc)
+        return Response('Query time budget exceeded', 503)
+
+    def post_fork(self):
+        """
+        Reset the connection state inherited from the parent process and warm
+        the connection pool.  Register this as the server's post-fork hook.
+        """
+        for database in self.get_databases():
+            if isinstance(database, ForkSafeDatabase):
+                database.check_pid()
+            if self.warm_connections and isinstance(database, PooledDatabase):
+                database.warm(self.warm_connections)
+        if self.invalidation_bus is not None:
+            # start receiving the invalidations published to this worker
+            self.invalidation_bus.poll()
+
+    def no_transaction(self, view):
+        """
+        Decorator which excludes a view from the per-request transaction, so
+        that its queries are committed as they run.
+        """
+        self.no_transaction_views.add(view)
+        return view
+
+    def begin_isolation(self):
+        """
+        Run everything until :py:meth:`end_isolation` in transactions which
+        are then rolled back, keeping the connections open in between --
+        intended for tests.
+        """
+        self.isolation = []
+        for database in self.get_databases():
+            transaction = database.transaction()
+            transaction.__enter__()
+            self.isolation.append(transaction)
+
+    def end_isolation(self):
+        isolation, self.isolation = self.isolation, None
+        for transaction in isolation or ():
+            database = transaction.db
+            transaction.__exit__(Exception, None, None)
+            # transactions left open by the test
+            while database.transaction_depth():
+                database.pop_transaction()
+            database.set_autocommit(True)
+
+    def begin_request_transaction(self):
+        view = self.app.view_functions.get(request.endpoint)
+        if view is not None and view in self.no_transaction_views:
+            return
+        if self.isolation is not None:
+            # rolling back must keep what the test set up
+            transaction = self.database.savepoint()
+        else:
+            transaction = self.database.transaction()
+        transaction.__enter__()
+        g._db_transaction = transaction
+
+    def end_request_transaction(self, commit=True):
+        transaction = g.pop('_db_transaction', None)
+        if transaction is None:
+            return
+        if commit:
+            transaction.__exit__(None, None, None)
+        else:
+            # rolled back as if an error had been raised in its block
+            transaction.__exit__(Exception, None, None)
+
+    def commit_request_transaction(self, response):
+        # commit here rather than at teardown, so that a failed commit still
+        # results in an error response
+        self.end_request_transaction(commit=response.status_code < 400)
+        return response
+
+    def resolve_tenant(self):
+        tenant = self.tenant_resolver()
+        if tenant is not None and not self.is_known_tenant(tenant):
+            abort(404)
+        g.tenant = tenant
+
     def connect_db(self):
-        self.database.connect()
+        # in lazy mode peewee opens the connection when the first query runs
+        if not self.lazy and self.database.is_closed():
+            self.database.connect()
 
     def close_db(self, exc):
-        if not self.database.is_closed():
-            self.database.close()
+        if self.transaction_per_request:
+            self.end_request_transaction(commit=False)
+        if self.isolation is not None:
+            return
+        for database in self.get_databases():
+            if not database.is_closed():
+                database.close()
 
     def register_handlers(self):
+        if self.instrument:
+            self.app.before_request(self.start_instrumentation)
+            if self.instrument_headers:
+                self.app.after_request(self.add_instrumentation_headers)
+        if self.enforce_query_budget:
+            if self.query_budget is not None:
+                self.app.before_request(self.start_query_budget)
+            self.app.register_error_handler(QueryBudgetExceeded, self.response_budget_exceeded)
+        if self.tenant_resolver:
+            self.app.before_request(self.resolve_tenant)
+        if self.invalidation_bus:
+            self.app.before_request(self.invalidation_bus.poll)
         self.app.before_request(self.connect_db)
+        if self.transaction_per_request:
+            self.app.before_request(self.begin_request_transaction)
+            self.app.after_request(self.commit_request_transaction)
         self.app.teardown_request(self.close_db)
@@ -0,0 +1,94 @@
+"""
+Fork safety for the flask-peewee database wrapper.
+
+Pre-fork servers such as gunicorn and uWSGI can import the application once in
+the master process and fork the workers from it.  Any connection opened in the
+master before the fork (for instance by a ``create_table()`` call at import
+time) would otherwise be shared by every worker.  With ``fork_safe`` enabled,
+the database notices that it is running in a new process and discards the
+inherited connection state before it is used:
+
+    DATABASE = {
+        'name': 'my_app',
+        'engine': 'peewee.PostgresqlDatabase',
+        'pool': True,
+        'fork_safe': True,
+        'warm_connections': 4,  # opened by Database.post_fork()
+    }
+
+Register ``Database.post_fork`` with the server to warm a fresh pool in each
+worker as soon as it starts, e.g. in a gunicorn config file:
+
+    def post_fork(server, worker):
+        db.post_fork()
+"""
+import os
+
+from peewee import _BaseConnectionLocal
+
+from flask_peewee.concurrency import concurrency_for
+from flask_peewee.concurrency import get_connection_local
+from flask_peewee.concurrency import set_connection_local
+
+
+class ForkSafeDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which resets its connection state when it
+    is used from a different process than the one it was created in.
+    """
+    def __init__(self, database, threadlocals=True, **kwargs):
+        self._pid = os.getpid()
+        self._threadlocals = threadlocals
+
+        # connections inherited from the parent are never used or closed, as
+        # closing them could end the parent's session, but they are kept
+        # referenced so that garbage collection doesn't close them either.
+        self._inherited = []
+
+        super(ForkSafeDatabase, self).__init__(
+            database,
+            threadlocals=threadlocals,
+            **kwargs)
+
+    def check_pid(self):
+        if self._pid != os.getpid():
+            self.reset_after_fork()
+
+    def reset_after_fork(self):
+        self._pid = os.getpid()
+
+        local = get_connection_local(self)
+        if not local.closed:
+            self._inherited.append(local.conn)
+        for transaction in local.context_stack:
+            if transaction.connection is not None:
+                self._inherited.append(transaction.connection)
+
+        concurrency = concurrency_for(self)
+        if self._threadlocals:
+            set_connection_local(self, concurrency.connection_local())
+        else:
+            set_connection_local(self, _BaseConnectionLocal())
+
+        # the lock may have been held by another thread at the time of fork
+        self._conn_lock = concurrency.lock()
+
+        reset_pool = getattr(self, 'reset_pool', None)
+        if reset_pool is not None:
+            self._inherited.extend(reset_pool())
+
+    def connect(self):
+        self.check_pid()
+        return super(ForkSafeDatabase, self).connect()
+
+    def close(self):
+        self.check_pid()
+        return super(ForkSafeDatabase, self).close()
+
+    def get_conn(self):
+        self.check_pid()
+        return super(ForkSafeDatabase, self).get_conn()
+
+    def is_closed(self):
+        self.check_pid()
+        return super(ForkSafeDatabase, self).is_closed()
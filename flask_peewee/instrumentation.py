@@ -0,0 +1,193 @@
+"""
+Per-request SQL instrumentation for the flask-peewee database wrapper.
+
+When enabled, every statement executed while handling a request is counted and
+timed, and the results are available as ``g.query_stats``:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'instrument': True,
+        'instrument_headers': True,  # emit Server-Timing and X-Query-Count
+    }
+
+During development it can also detect N+1 query patterns, where the same
+query shape is issued over and over, typically from a loop that follows a
+foreign key on each object:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'n_plus_one': 'raise',  # or 'warn'
+        'n_plus_one_threshold': 10,
+    }
+"""
+import heapq
+import os
+import re
+import sys
+import time
+import traceback
+import warnings
+
+import peewee
+from flask import g
+from flask import has_request_context
+
+
+class QueryStats(object):
+    """
+    Collects the statements executed over the course of a single request.
+    """
+    def __init__(self, keep_slowest=5):
+        self.keep_slowest = keep_slowest
+        self.count = 0
+        self.duration = 0.
+        self.rows = 0
+        self._slowest = []
+
+    def record(self, sql, params, duration):
+        self.count += 1
+        self.duration += duration
+        entry = (duration, self.count, sql, params)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self.keep_slowest:
+            heapq.heappushpop(self._slowest, entry)
+
+    def add_rows(self, n):
+        self.rows += n
+
+    def get_slowest(self):
+        """
+        Return the slowest statements as (duration, sql, params) tuples, slowest
+        first.
+        """
+        return [(duration, sql, params) for duration, _, sql, params in
+                sorted(self._slowest, reverse=True)]
+
+    def get_headers(self):
+        return [
+            ('Server-Timing', 'db;dur=%.2f;desc="%d queries"' % (
+                self.duration * 1000, self.count)),
+            ('X-Query-Count', str(self.count)),
+        ]
+
+
+def get_query_stats():
+    if has_request_context():
+        return getattr(g, 'query_stats', None)
+
+
+class CountingCursor(object):
+    """
+    Wraps a DB-API cursor, counting the rows fetched from it.
+    """
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats.add_rows(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats.add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats.add_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class InstrumentedDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which records each statement executed
+    during a request in ``g.query_stats``.
+    """
+    def execute_sql(self, sql, params=None, require_commit=True):
+        stats = get_query_stats()
+        if stats is None:
+            return super(InstrumentedDatabase, self).execute_sql(sql, params, require_commit)
+
+        start = time.time()
+        try:
+            cursor = super(InstrumentedDatabase, self).execute_sql(sql, params, require_commit)
+        finally:
+            stats.record(sql, params, time.time() - start)
+        return CountingCursor(cursor, stats)
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+class NPlusOneWarning(UserWarning):
+    pass
+
+
+_in_clause = re.compile(r'\(\?(?:, \?)+\)|\(%s(?:, %s)+\)')
+
+def get_fingerprint(sql):
+    """
+    Reduce a statement to its shape, so that queries differing only in their
+    parameters (or in the length of an IN list) compare equal.
+    """
+    return _in_clause.sub('(...)', ' '.join(sql.split()))
+
+
+class NPlusOneDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which counts how many times each query
+    shape runs during a request, and complains when one runs more than
+    ``n_plus_one_threshold`` times.
+    """
+    def __init__(self, database, n_plus_one='warn', n_plus_one_threshold=10,
+                 **kwargs):
+        self.n_plus_one = n_plus_one
+        self.n_plus_one_threshold = n_plus_one_threshold
+        super(NPlusOneDatabase, self).__init__(database, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        if has_request_context():
+            counts = g.setdefault('query_fingerprints', {})
+            fingerprint = get_fingerprint(sql)
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+            if counts[fingerprint] == self.n_plus_one_threshold + 1:
+                self.report_repeated_query(fingerprint)
+
+        return super(NPlusOneDatabase, self).execute_sql(sql, params, require_commit)
+
+    def get_call_site(self):
+        # the innermost frame which is not part of peewee or the database
+        # wrapper is the code responsible for issuing the query
+        internal = set()
+        for module in (peewee, sys.modules[__name__]):
+            internal.add(os.path.splitext(module.__file__)[0])
+        for cls in type(self).__mro__:
+            module = sys.modules.get(cls.__module__)
+            if getattr(module, '__file__', None):
+                internal.add(os.path.splitext(module.__file__)[0])
+
+        for filename, lineno, func, line in reversed(traceback.extract_stack()):
+            if os.path.splitext(filename)[0] not in internal:
+                return '%s:%s in %s' % (filename, lineno, func)
+
+    def report_repeated_query(self, fingerprint):
+        message = 'Query executed more than %s times in one request, from %s: %s' % (
+            self.n_plus_one_threshold,
+            self.get_call_site(),
+            fingerprint)
+        if self.n_plus_one == 'raise':
+            raise NPlusOneError(message)
+        warnings.warn(message, NPlusOneWarning)
@@ -0,0 +1,405 @@
+"""
+Cross-process cache invalidation for the flask-peewee database wrapper.
+
+Each worker process of an application has caches of its own, which go stale
+as soon as another worker writes.  With an invalidation bus, the database
+publishes the tables written by every committed statement, and each worker
+invalidates its caches as it receives them:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'result_cache': True,
+        'result_cache_ttl': 3600,
+        'invalidation_bus': 'sqlite',  # or 'unix', or a transport class
+        'invalidation_bus_path': '/var/run/example/invalidation.db',
+    }
+
+Workers poll the bus at the start of every request, so a request sees all the
+writes committed before it started.  Caches of your own can subscribe to the
+bus as well:
+
+    db.invalidation_bus.subscribe(lambda namespace, tables: ...)
+
+Two transports are included, neither of which needs a service of its own:
+``SqliteTransport`` appends messages to a table of a shared SQLite database,
+``UnixSocketTransport`` sends them as datagrams to a socket bound by each
+process in a shared directory.  Both only reach processes of the same host.
+"""
+import errno
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask_peewee.concurrency import concurrency_for
+from flask_peewee.tenants import get_tenant_namespace
+from flask_peewee.utils import is_write_query
+
+
+# a possibly quoted and schema-qualified table name, capturing the table
+_table = r'(?:[`"]?[\w$]+[`"]?\.)?[`"]?([\w$]+)[`"]?'
+
+_read_tables = re.compile(r'\b(?:FROM|JOIN)\s+' + _table, re.I)
+
+_write_table = re.compile(
+    r'^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|'
+    r'DELETE\s+FROM|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE|'
+    r'TRUNCATE(?:\s+TABLE)?)\s+' + _table, re.I)
+
+# generation bumped by writes whose table is unknown, read by every entry
+ALL_TABLES = '*'
+
+def get_read_tables(sql):
+    return set(_read_tables.findall(sql))
+
+def get_written_table(sql):
+    """
+    Return the table written by ``sql``, ``ALL_TABLES`` if it writes but the
+    table can't be told, or ``None`` if it doesn't write.
+    """
+    match = _write_table.match(sql)
+    if match:
+        return match.group(1)
+    if is_write_query(sql):
+        return ALL_TABLES
+
+
+class GenerationTracker(object):
+    """
+    Base class of the caches of data read from tables, which count the
+    "generation" of each table of a namespace.  ``invalidate()`` increments
+    the generations of the tables written, making stale whatever was read
+    from them at an earlier generation.
+    """
+    def __init__(self):
+        self.invalidations = 0
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_generations(self, namespace, tables):
+        with self._lock:
+            return self._get_generations(namespace, tables)
+
+    def _get_generations(self, namespace, tables):
+        # called with the lock held
+        return tuple([
+            ((namespace, table), self._generations.get((namespace, table), 0))
+            for table in sorted(tables) + [ALL_TABLES]])
+
+    def _is_current(self, generations):
+        # called with the lock held
+        for key, generation in generations:
+            if self._generations.get(key, 0) != generation:
+                return False
+        return True
+
+    def invalidate(self, namespace, tables):
+        with self._lock:
+            for table in tables:
+                key = (namespace, table)
+                self._generations[key] = self._generations.get(key, 0) + 1
+
+
+class InvalidationTransport(object):
+    """
+    Delivers messages published by one process to all the others.
+    """
+    def publish(self, message):
+        raise NotImplementedError
+
+    def receive(self):
+        """
+        Return the messages published by other processes since the last call.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SqliteTransport(InvalidationTransport):
+    """
+    Transport keeping messages in a table of a SQLite database shared by all
+    processes.  Messages older than ``retention`` seconds are deleted.
+    """
+    table = 'flask_peewee_invalidation'
+
+    def __init__(self, path, retention=60):
+        self.path = path
+        self.retention = retention
+        self._conn = None
+        self._pid = None
+        self._last_id = None
+        self._published = 0
+        self._lock = threading.Lock()
+
+    def get_conn(self):
+        # connections don't survive a fork
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(
+                self.path,
+                timeout=5,
+                isolation_level=None,
+                check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=wal')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY '
+                'AUTOINCREMENT, message TEXT NOT NULL, created REAL NOT NULL)'
+                % self.table)
+            # messages published before the first poll don't concern us, while
+            # a forked worker carries on from the parent's last message
+            if self._last_id is None:
+                row = self._conn.execute('SELECT MAX(id) FROM %s' % self.table).fetchone()
+                self._last_id = row[0] or 0
+            self._pid = os.getpid()
+        return self._conn
+
+    def publish(self, message):
+        with self._lock:
+            conn = self.get_conn()
+            now = time.time()
+            conn.execute(
+                'INSERT INTO %s (message, created) VALUES (?, ?)' % self.table,
+                (message, now))
+            self._published += 1
+            if self._published % 100 == 0:
+                conn.execute(
+                    'DELETE FROM %s WHERE created < ?' % self.table,
+                    (now - self.retention,))
+
+    def receive(self):
+        with self._lock:
+            rows = self.get_conn().execute(
+                'SELECT id, message FROM %s WHERE id > ? ORDER BY id' % self.table,
+                (self._last_id,)).fetchall()
+            if rows:
+                self._last_id = rows[-1][0]
+        return [message for _, message in rows]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = self._pid = None
+
+
+class UnixSocketTransport(InvalidationTransport):
+    """
+    Transport sending each message as a datagram to the sockets which the
+    other processes bound in the directory ``path``.  Messages sent while a
+    process' socket buffer is full are lost, so cached data should still
+    expire eventually.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._socket_path = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_socket(self):
+        if self._pid != os.getpid():
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self._socket_path = os.path.join(
+                self.path,
+                '%s-%s.sock' % (os.getpid(), uuid.uuid4().hex[:8]))
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(self._socket_path)
+            self._sock.setblocking(False)
+            self._pid = os.getpid()
+        return self._sock
+
+    def publish(self, message):
+        data = message.encode('utf-8')
+        with self._lock:
+            sock = self.get_socket()
+            for filename in os.listdir(self.path):
+                socket_path = os.path.join(self.path, filename)
+                if not filename.endswith('.sock') or socket_path == self._socket_path:
+                    continue
+                try:
+                    sock.sendto(data, socket_path)
+                except socket.error as exc:
+                    if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        # the process has exited, or closed the transport
+                        try:
+                            os.unlink(socket_path)
+                        except OSError:
+                            pass
+                    elif exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                        raise
+
+    def receive(self):
+        messages = []
+        with self._lock:
+            sock = self.get_socket()
+            while True:
+                try:
+                    data = sock.recv(65536)
+                except socket.error as exc:
+                    if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                messages.append(data.decode('utf-8'))
+        return messages
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None and self._pid == os.getpid():
+                self._sock.close()
+                try:
+                    os.unlink(self._socket_path)
+                except OSError:
+                    pass
+            self._sock = self._socket_path = self._pid = None
+
+
+TRANSPORTS = {
+    'sqlite': SqliteTransport,
+    'unix': UnixSocketTransport,
+}
+
+
+class InvalidationBus(object):
+    """
+    Publishes invalidations of a namespace's tables to the other processes,
+    and passes those they published to the subscribed callbacks.
+    """
+    def __init__(self, transport, poll_interval=1.0):
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.subscribers = []
+        self.published = 0
+        self.received = 0
+        self._last_poll = 0
+        self._id = uuid.uuid4().hex
+        self._lock = threading.Lock()
+
+    def get_origin(self):
+        # forked workers share the bus created in the master process
+        return '%s-%s' % (self._id, os.getpid())
+
+    def subscribe(self, callback):
+        """
+        Call ``callback(namespace, tables)`` for each invalidation received.
+        """
+        self.subscribers.append(callback)
+        return callback
+
+    def publish(self, namespace, tables):
+        self.transport.publish(json.dumps({
+            'origin': self.get_origin(),
+            'namespace': namespace,
+            'tables': sorted(tables)}))
+        with self._lock:
+            self.published += 1
+
+    def poll(self):
+        """
+        Receive the invalidations published by other processes.
+        """
+        origin = self.get_origin()
+        with self._lock:
+            self._last_poll = time.time()
+            # our own writes were invalidated locally as they were made
+            messages = [
+                message for message in map(json.loads, self.transport.receive())
+                if message['origin'] != origin]
+            self.received += len(messages)
+
+        for message in messages:
+            for callback in self.subscribers:
+                callback(message['namespace'], message['tables'])
+
+    def maybe_poll(self):
+        """
+        Poll, unless the bus was polled less than ``poll_interval`` ago.
+        """
+        if time.time() - self._last_poll >= self.poll_interval:
+            self.poll()
+
+    def close(self):
+        self.transport.close()
+
+    def get_stats(self):
+        return {
+            'published': self.published,
+            'received': self.received,
+            'subscribers': len(self.subscribers),
+        }
+
+
+class WriteTrackingDatabase(object):
+    """
+    Base of the mixins for a ``peewee.Database`` which act on the tables
+    written through it, by overriding ``tables_written()``.  It is called as
+    each statement writes a table, and again with ``committed`` once the
+    write is committed, or only once outside of a transaction.
+    """
+    def __init__(self, database, **kwargs):
+        self._uncommitted = concurrency_for(self).local()
+        super(WriteTrackingDatabase, self).__init__(database, **kwargs)
+
+    def get_namespace(self):
+        return get_tenant_namespace(self)
+
+    def get_uncommitted(self):
+        """
+        Return the tables written by the current transaction.
+        """
+        tables = getattr(self._uncommitted, 'tables', None)
+        if tables is None:
+            tables = self._uncommitted.tables = set()
+        return tables
+
+    def tables_written(self, namespace, tables, committed):
+        pass
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        cursor = super(WriteTrackingDatabase, self).execute_sql(sql, params, require_commit)
+        table = get_written_table(sql)
+        if table is not None:
+            committed = not self.transaction_depth() and self.get_autocommit()
+            if not committed:
+                self.get_uncommitted().add(table)
+            self.tables_written(self.get_namespace(), [table], committed)
+        return cursor
+
+    def commit(self):
+        result = super(WriteTrackingDatabase, self).commit()
+        uncommitted = self.get_uncommitted()
+        if uncommitted:
+            tables = list(uncommitted)
+            uncommitted.clear()
+            self.tables_written(self.get_namespace(), tables, True)
+        return result
+
+    def rollback(self):
+        try:
+            return super(WriteTrackingDatabase, self).rollback()
+        finally:
+            self.get_uncommitted().clear()
+
+
+class InvalidationDatabase(WriteTrackingDatabase):
+    """
+    Mixin for a ``peewee.Database`` which publishes the tables it writes to an
+    invalidation bus, once the writes are committed.
+    """
+    def __init__(self, database, invalidation_bus=None, **kwargs):
+        self.invalidation_bus = invalidation_bus
+        super(InvalidationDatabase, self).__init__(database, **kwargs)
+
+    def poll_invalidations(self):
+        self.invalidation_bus.maybe_poll()
+
+    def tables_written(self, namespace, tables, committed):
+        if committed:
+            self.invalidation_bus.publish(namespace, tables)
+        super(InvalidationDatabase, self).tables_written(namespace, tables, committed)
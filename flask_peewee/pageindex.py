@@ -0,0 +1,145 @@
+"""
+Page boundary index for jumping to numbered pages of keyset-paginated queries.
+
+Cursors make the next and previous pages cheap, but jumping to page 500 still
+means skipping the rows of the 499 pages before it.  The page boundary index
+remembers the ordering key of every ``step``-th row of each query it has seen,
+so that a page is found by seeking past the nearest boundary and skipping at
+most ``step`` rows:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'page_index': True,
+        'page_index_step': 1000,   # rows between boundaries
+        'page_index_size': 256,    # queries remembered
+    }
+
+The boundaries are collected as deeper pages are requested, and are kept per
+ordering and filters of a query.  Any write to a table the query reads makes
+them stale, in the same way as cached results, see resultcache.py.
+"""
+from collections import OrderedDict
+
+from flask_peewee.invalidation import GenerationTracker
+from flask_peewee.invalidation import WriteTrackingDatabase
+from flask_peewee.invalidation import get_read_tables
+from flask_peewee.tenants import get_tenant_namespace
+
+
+class PageBoundaryIndex(GenerationTracker):
+    """
+    Thread-safe LRU mapping of a query, ordering and filters included, to the
+    keys of every ``step``-th row of its results.
+    """
+    def __init__(self, step=1000, max_size=256):
+        super(PageBoundaryIndex, self).__init__()
+        self.step = step
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get_boundaries(self, key, namespace, tables):
+        with self._lock:
+            generations = self._get_generations(namespace, tables)
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return generations, []
+            if not self._is_current(entry[0]):
+                self.invalidations += 1
+                self.misses += 1
+                return generations, []
+            self._data[key] = entry
+            self.hits += 1
+            return generations, list(entry[1])
+
+    def set_boundaries(self, key, namespace, tables, generations, boundaries):
+        with self._lock:
+            # a write while the boundaries were read makes them stale already
+            if not self._is_current(generations):
+                return
+            self._data.pop(key, None)
+            self._data[key] = (generations, boundaries)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def locate(self, paginated_query, offset):
+        """
+        Return the key of the last boundary before row ``offset`` of a keyset
+        ``PaginatedQuery``, and the number of rows between the two.  The key
+        is ``None`` if there is no boundary before the row.
+        """
+        steps = offset // self.step
+        if not steps:
+            return None, offset
+
+        query = paginated_query.query
+        namespace = get_tenant_namespace(query.database)
+        sql, params = query.order_by().sql()
+        key = (namespace, tuple(paginated_query.get_signature()), sql, tuple(params))
+        try:
+            hash(key)
+        except TypeError:
+            return None, offset
+
+        tables = list(get_read_tables(sql))
+        generations, boundaries = self.get_boundaries(key, namespace, tables)
+
+        if len(boundaries) < steps:
+            keys = paginated_query.keys
+            key_query = query.select(*[field for field, _ in keys]).order_by(*[
+                field.desc() if desc else field.asc()
+                for field, desc in keys]).tuples()
+
+            # read the keys of the rows selected alone, a boundary at a time
+            extended = False
+            while len(boundaries) < steps:
+                boundary_query = key_query
+                if boundaries:
+                    boundary_query = boundary_query.where(
+                        paginated_query.get_seek_expression(boundaries[-1], False))
+                rows = list(boundary_query.offset(self.step - 1).limit(1))
+                if not rows:
+                    break
+                boundaries.append(list(rows[0]))
+                extended = True
+
+            if extended:
+                self.set_boundaries(key, namespace, tables, generations, list(boundaries))
+
+        found = min(steps, len(boundaries))
+        if not found:
+            return None, offset
+        return boundaries[found - 1], offset - found * self.step
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+class PageIndexDatabase(WriteTrackingDatabase):
+    """
+    Mixin for a ``peewee.Database`` which keeps a page boundary index, and
+    invalidates it as tables are written.
+    """
+    def __init__(self, database, page_index=True, **kwargs):
+        if not isinstance(page_index, PageBoundaryIndex):
+            page_index = PageBoundaryIndex()
+        self.page_index = page_index
+        super(PageIndexDatabase, self).__init__(database, **kwargs)
+
+    def tables_written(self, namespace, tables, committed):
+        self.page_index.invalidate(namespace, tables)
+        super(PageIndexDatabase, self).tables_written(namespace, tables, committed)
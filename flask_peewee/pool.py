@@ -0,0 +1,277 @@
+"""
+Connection pooling for the flask-peewee database wrapper.
+
+Rather than opening a brand-new connection at the start of every request and
+closing it at the end, a pooled database hands out a previously opened
+connection and takes it back when the request is torn down.  Enable it from
+the app config:
+
+    DATABASE = {
+        'name': 'my_app',
+        'engine': 'peewee.PostgresqlDatabase',
+        'pool': True,
+        'max_connections': 32,
+        'stale_timeout': 300,   # recycle connections older than 5 minutes
+        'checkout_timeout': 5,  # wait up to 5 seconds for a free connection
+    }
+"""
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+
+from peewee import SqliteDatabase
+
+from flask_peewee.concurrency import concurrency_for
+from flask_peewee.concurrency import get_exception_wrapper
+
+
+logger = logging.getLogger('flask_peewee.pool')
+
+
+class MaxConnectionsExceeded(ValueError):
+    pass
+
+
+class PooledDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` subclass which recycles connections.
+
+    Idle connections are kept in a heap ordered by the time they were opened,
+    so the oldest is handed out first and stale connections are retired as
+    early as possible.  When the pool is exhausted, callers wait in line and
+    are served in the order they arrived.
+    """
+    def __init__(self, database, max_connections=20, stale_timeout=None,
+                 checkout_timeout=None, **kwargs):
+        self.max_connections = max_connections
+        self.stale_timeout = stale_timeout
+        self.checkout_timeout = checkout_timeout
+
+        self._init_pool()
+
+        if isinstance(self, SqliteDatabase):
+            # pooled connections are handed to whichever thread asks next
+            kwargs.setdefault('check_same_thread', False)
+
+        super(PooledDatabase, self).__init__(database, **kwargs)
+
+    def _init_pool(self):
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._pending = 0
+        self._pool_lock = threading.Lock()
+
+        # callers waiting for a connection, and those which have been
+        # promised one ahead of any newcomers
+        self._waiters = deque()
+        self._granted = set()
+
+        self._created = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def conn_key(self, conn):
+        return id(conn)
+
+    def _get_free(self):
+        if not self.max_connections:
+            # an unbounded pool has room for everybody waiting
+            return len(self._waiters)
+        return self.max_connections - len(self._in_use) - self._pending - \
+            len(self._granted)
+
+    def _can_connect(self, ident):
+        if ident in self._granted or not self.max_connections:
+            return True
+        return not self._waiters and self._get_free() > 0
+
+    def _grant(self):
+        free = self._get_free()
+        while self._waiters and free > 0:
+            ident, event = self._waiters.popleft()
+            self._granted.add(ident)
+            event.set()
+            free -= 1
+
+    def connect(self):
+        # wait for a free connection outside of peewee's connection lock, so
+        # that threads returning connections to the pool are never blocked.
+        deadline = None
+        while True:
+            try:
+                return super(PooledDatabase, self).connect()
+            except MaxConnectionsExceeded:
+                deadline = self._wait_for_connection(deadline)
+
+    def checkout(self):
+        """
+        Take a connection from the pool without making it the current thread's
+        connection.  It must be handed back with ``_close()``.
+        """
+        deadline = None
+        while True:
+            try:
+                with get_exception_wrapper(self):
+                    conn = self._connect(self.database, **self.connect_kwargs)
+            except MaxConnectionsExceeded:
+                deadline = self._wait_for_connection(deadline)
+            else:
+                self.initialize_connection(conn)
+                return conn
+
+    def _wait_for_connection(self, deadline):
+        concurrency = concurrency_for(self)
+        event = self.checkout_timeout and concurrency.event()
+        if not event:
+            with self._pool_lock:
+                self._timeouts += 1
+            raise MaxConnectionsExceeded('Exceeded maximum connections.')
+
+        ident = concurrency.get_ident()
+        with self._pool_lock:
+            now = time.time()
+            if deadline is None:
+                deadline = now + self.checkout_timeout
+                self._waits += 1
+            remaining = deadline - now
+            if remaining <= 0:
+                self._timeouts += 1
+                raise MaxConnectionsExceeded(
+                    'Timed out waiting for a connection after %s seconds.'
+                    % self.checkout_timeout)
+            if self._can_connect(ident):
+                return deadline
+            waiter = (ident, event)
+            self._waiters.append(waiter)
+
+        event.wait(remaining)
+        with self._pool_lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return deadline
+
+    def _checkout(self):
+        while self._connections:
+            ts, key, conn = heapq.heappop(self._connections)
+            if self._is_closed(key, conn):
+                logger.debug('Connection %s was closed.', key)
+                self._closed.discard(key)
+            elif self.stale_timeout and self._is_stale(ts):
+                logger.debug('Connection %s was stale, closing.', key)
+                super(PooledDatabase, self)._close(conn)
+            else:
+                self._in_use[key] = ts
+                return conn
+
+    def _connect(self, *args, **kwargs):
+        ident = concurrency_for(self).get_ident()
+        with self._pool_lock:
+            if not self._can_connect(ident):
+                raise MaxConnectionsExceeded('Exceeded maximum connections.')
+            self._granted.discard(ident)
+            conn = self._checkout()
+            if conn is not None:
+                return conn
+            self._pending += 1
+
+        try:
+            conn = super(PooledDatabase, self)._connect(*args, **kwargs)
+        except:
+            with self._pool_lock:
+                self._pending -= 1
+                self._grant()
+            raise
+
+        key = self.conn_key(conn)
+        logger.debug('Created new connection %s.', key)
+        with self._pool_lock:
+            self._pending -= 1
+            self._created += 1
+            self._in_use[key] = time.time()
+        return conn
+
+    def _is_stale(self, timestamp):
+        return (time.time() - timestamp) > self.stale_timeout
+
+    def _is_closed(self, key, conn):
+        return key in self._closed
+
+    def _close(self, conn, close_conn=False):
+        key = self.conn_key(conn)
+        with self._pool_lock:
+            if close_conn:
+                self._closed.add(key)
+                self._in_use.pop(key, None)
+                super(PooledDatabase, self)._close(conn)
+            elif key in self._in_use:
+                ts = self._in_use.pop(key)
+                if self.stale_timeout and self._is_stale(ts):
+                    logger.debug('Closing stale connection %s.', key)
+                    super(PooledDatabase, self)._close(conn)
+                else:
+                    logger.debug('Returning %s to pool.', key)
+                    heapq.heappush(self._connections, (ts, key, conn))
+            self._grant()
+
+    def manual_close(self):
+        """
+        Close the underlying connection without returning it to the pool.
+        """
+        conn = self.get_conn()
+        self.close()
+        if not self._is_closed(self.conn_key(conn), conn):
+            self._close(conn, close_conn=True)
+
+    def close_all(self):
+        """
+        Close all idle connections managed by the pool.
+        """
+        with self._pool_lock:
+            connections, self._connections = self._connections, []
+        for _, _, conn in connections:
+            super(PooledDatabase, self)._close(conn)
+
+    def reset_pool(self):
+        """
+        Forget every connection managed by the pool without closing them, for
+        instance after a fork, returning the idle connections.
+        """
+        connections = [conn for _, _, conn in self._connections]
+        self._init_pool()
+        return connections
+
+    def warm(self, n):
+        """
+        Open connections ahead of time until the pool holds ``n``.
+        """
+        if self.max_connections:
+            n = min(n, self.max_connections)
+        with self._pool_lock:
+            missing = n - len(self._connections) - len(self._in_use) - self._pending
+
+        for i in range(missing):
+            with get_exception_wrapper(self):
+                conn = super(PooledDatabase, self)._connect(
+                    self.database,
+                    **self.connect_kwargs)
+                self.initialize_connection(conn)
+            with self._pool_lock:
+                self._created += 1
+                heapq.heappush(
+                    self._connections,
+                    (time.time(), self.conn_key(conn), conn))
+
+    def get_stats(self):
+        with self._pool_lock:
+            return {
+                'max_connections': self.max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'waiting': len(self._waiters),
+                'created': self._created,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+            }
@@ -0,0 +1,284 @@
+"""
+Query plan checks for the filters and orderings exposed by the REST API and
+the admin.
+
+Every field a ``RestResource`` or ``ModelAdmin`` lets clients filter or order
+by is a query someone can run against production data.  The guard builds each
+of these queries the way the views do and asks the database for its plan,
+reporting those which scan, or sort, a whole large table:
+
+    from flask_peewee.queryplans import QueryPlanGuard
+
+    class QueryPlanTestCase(unittest.TestCase):
+        def test_query_plans(self):
+            guard = QueryPlanGuard(
+                min_rows=10000,
+                # production sizes, the test database is nearly empty
+                table_sizes={'message': 2000000, 'user': 50000},
+                # scans accepted for now
+                ignore=['api/message: filter content__*', '* contains'])
+            guard.assert_plans(api, admin)
+
+SQLite plans come from ``EXPLAIN QUERY PLAN``, Postgres and MySQL plans from
+``EXPLAIN``.
+"""
+import fnmatch
+import re
+
+from peewee import DJANGO_MAP
+from peewee import MySQLDatabase
+from peewee import PostgresqlDatabase
+from peewee import SqliteDatabase
+
+from flask_peewee.filters import QueryFilter
+from flask_peewee.utils import get_read_query
+
+
+# tables named in a FROM or JOIN clause, and their aliases
+_table_alias = re.compile(
+    r'\b(?:FROM|JOIN)\s+(?:[`"]?[\w$]+[`"]?\.)?[`"]?([\w$]+)[`"]?'
+    r'(?:\s+AS\s+[`"]?([\w$]+)[`"]?)?', re.I)
+
+# "SCAN t1", "SCAN TABLE message AS t1", "SEARCH t2 USING INDEX ..."
+_sqlite_step = re.compile(r'^(SCAN|SEARCH)(?: TABLE)? ([\w$]+)(?: AS ([\w$]+))?(.*)$')
+
+# "Seq Scan on message t1  (cost=...)"
+_postgres_scan = re.compile(r'Seq Scan on (?:[\w$]+\.)?"?([\w$]+)"?')
+_postgres_sort = re.compile(r'^(?:->\s*)?(?:Incremental )?Sort\b')
+
+def get_table_aliases(sql):
+    aliases = {}
+    for table, alias in _table_alias.findall(sql):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+class QueryPlan(object):
+    """
+    The plan of one query exposed by a view, and the tables it scans in full.
+    """
+    def __init__(self, source, description, sql, params, plan, scans, sorts):
+        self.source = source
+        self.description = description
+        self.sql = sql
+        self.params = params
+        self.plan = plan
+        self.scans = scans
+        self.sorts = sorts
+
+    def __str__(self):
+        return '%s: %s' % (self.source, self.description)
+
+    def format(self):
+        return '%s\n    %s %r\n    %s' % (
+            self,
+            self.sql,
+            list(self.params),
+            '\n    '.join(self.plan))
+
+
+class QueryPlanGuard(object):
+    """
+    Reports exposed queries which scan whole tables of at least ``min_rows``
+    rows, or which sort them.  Table sizes are counted unless given in
+    ``table_sizes``, and queries matching one of the ``ignore`` patterns are
+    not reported.
+    """
+    # REST API filter operations to check, every one clients may use
+    rest_operations = tuple(sorted(DJANGO_MAP))
+
+    # admin filters to check, all of them
+    admin_filters = (QueryFilter,)
+
+    # value given to every filter, which is valid for most field types
+    filter_value = '1'
+
+    def __init__(self, min_rows=1000, table_sizes=None, ignore=None):
+        self.min_rows = min_rows
+        self.table_sizes = dict(table_sizes or {})
+        self.ignore = list(ignore or ())
+
+    def get_table_size(self, database, table):
+        if table not in self.table_sizes:
+            cursor = database.execute_sql(
+                'SELECT COUNT(*) FROM %s' % database.compiler().quote(table))
+            self.table_sizes[table] = cursor.fetchone()[0]
+        return self.table_sizes[table]
+
+    def explain(self, database, sql, params):
+        """
+        Return the plan of ``sql`` as a list of lines, the tables it scans in
+        full and whether it sorts rows.
+        """
+        aliases = get_table_aliases(sql)
+
+        if isinstance(database, SqliteDatabase):
+            cursor = database.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+            scans = []
+            for step in plan:
+                match = _sqlite_step.match(step)
+                if match and match.group(1) == 'SCAN' and 'INDEX' not in match.group(4):
+                    scans.append(aliases.get(match.group(2), match.group(2)))
+            sorts = any('TEMP B-TREE FOR ORDER BY' in step for step in plan)
+
+        elif isinstance(database, PostgresqlDatabase):
+            cursor = database.execute_sql('EXPLAIN ' + sql, params)
+            plan = [row[0] for row in cursor.fetchall()]
+            scans = [
+                aliases.get(table, table)
+                for step in plan for table in _postgres_scan.findall(step)]
+            sorts = any(_postgres_sort.match(step.strip()) for step in plan)
+
+        elif isinstance(database, MySQLDatabase):
+            cursor = database.execute_sql('EXPLAIN ' + sql, params)
+            columns = [column[0].lower() for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            plan = [
+                ', '.join('%s=%s' % (column, row[column]) for column in columns)
+                for row in rows]
+            scans = [
+                aliases.get(row['table'], row['table'])
+                for row in rows if row.get('type') == 'ALL' and row.get('table')]
+            sorts = any('filesort' in (row.get('extra') or '') for row in rows)
+
+        else:
+            raise NotImplementedError(
+                'Query plans are not supported by %s' % type(database).__name__)
+
+        return plan, scans, sorts
+
+    def check_query(self, query, source, description, ordering=False):
+        """
+        Return the plan of ``query`` if it scans a large table -- or, for
+        ``ordering`` checks, if it sorts one -- otherwise ``None``.
+        """
+        name = '%s: %s' % (source, description)
+        if any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore):
+            return None
+
+        database = query.database
+        sql, params = query.sql()
+        plan, scans, sorts = self.explain(database, sql, params)
+        large = [t for t in scans if self.get_table_size(database, t) >= self.min_rows]
+        if large and (sorts or not ordering):
+            return QueryPlan(source, description, sql, params, plan, large, sorts)
+
+    def iter_field_paths(self, field_tree):
+        # the same breadth first search as RestResource.process_query()
+        queue = [(field_tree, '')]
+        while queue:
+            node, prefix = queue.pop(0)
+            for field in node.fields:
+                yield prefix + field.name, field
+            for child_prefix, child_node in node.children.items():
+                queue.append((child_node, prefix + child_prefix + '__'))
+
+    def iter_filter_fields(self, filter_form):
+        # yields the request argument prefix FilterForm.parse_query_filters()
+        # looks for, along with the "__" path of each field
+        queue = [(filter_form._field_tree, '', '')]
+        while queue:
+            node, prefix, path = queue.pop(0)
+            for field in node.fields:
+                yield prefix, path + field.name, field
+            for child_prefix, child_node in node.children.items():
+                queue.append((
+                    child_node,
+                    prefix + filter_form.field_relation_prefix + child_prefix + filter_form.separator,
+                    path + child_prefix + '__'))
+
+    def check_resource(self, resource):
+        """
+        Check the filters and orderings exposed by a ``RestResource``.
+        """
+        source = '%s/%s' % (resource.api.blueprint.name, resource.get_api_name())
+        app = resource.api.app
+        problems = []
+
+        for path, field in self.iter_field_paths(resource._field_tree):
+            for op in self.rest_operations:
+                with app.test_request_context(query_string={
+                        '%s__%s' % (path, op): self.filter_value}):
+                    query = resource.process_query(get_read_query(resource.get_query()))
+                    problems.append(self.check_query(
+                        query,
+                        source,
+                        'filter %s__%s' % (path, op)))
+
+        for name in resource.model._meta.sorted_field_names:
+            for ordering in (name, '-' + name):
+                with app.test_request_context(query_string={'ordering': ordering}):
+                    query = resource.apply_ordering(get_read_query(resource.get_query()))
+                    if resource.paginate_by:
+                        query = query.paginate(1, resource.get_paginate_by())
+                    problems.append(self.check_query(
+                        query,
+                        source,
+                        'ordering %s' % ordering,
+                        ordering=True))
+
+        return [problem for problem in problems if problem is not None]
+
+    def check_model_admin(self, model_admin):
+        """
+        Check the filters of the ``FilterForm`` and the sortable columns of a
+        ``ModelAdmin``.
+        """
+        source = '%s/%s' % (model_admin.admin.blueprint.name, model_admin.get_admin_name())
+        app = model_admin.admin.app
+        filter_form = model_admin.get_filter_form()
+        problems = []
+
+        for prefix, path, field in self.iter_filter_fields(filter_form):
+            for idx, query_filter in enumerate(filter_form._query_filters[field]):
+                if not isinstance(query_filter, self.admin_filters):
+                    continue
+                with app.test_request_context(query_string={
+                        filter_form.field_operation_prefix.join((prefix, field.name)): str(idx),
+                        filter_form.field_value_prefix.join((prefix, field.name)): self.filter_value}):
+                    form, query, cleaned, field_tree = model_admin.process_filters(
+                        get_read_query(model_admin.get_query()))
+                    problems.append(self.check_query(
+                        query,
+                        source,
+                        'filter %s %s' % (path, query_filter.operation())))
+
+        for column in model_admin.get_columns():
+            if not model_admin.column_is_sortable(column):
+                continue
+            for ordering in (column, '-' + column):
+                with app.test_request_context(query_string={'ordering': ordering}):
+                    query = model_admin.apply_ordering(
+                        get_read_query(model_admin.get_query()),
+                        ordering)
+                    problems.append(self.check_query(
+                        query.paginate(1, model_admin.paginate_by),
+                        source,
+                        'ordering %s' % ordering,
+                        ordering=True))
+
+        return [problem for problem in problems if problem is not None]
+
+    def check(self, *registries):
+        """
+        Check every resource or model admin registered with the given
+        ``RestAPI`` and ``Admin`` instances.
+        """
+        problems = []
+        for registry in registries:
+            for provider in registry._registry.values():
+                if hasattr(provider, 'get_filter_form'):
+                    problems.extend(self.check_model_admin(provider))
+                else:
+                    problems.extend(self.check_resource(provider))
+        return problems
+
+    def assert_plans(self, *registries):
+        problems = self.check(*registries)
+        if problems:
+            raise AssertionError('%d exposed queries scan large tables:\n\n%s' % (
+                len(problems),
+                '\n\n'.join(problem.format() for problem in problems)))
@@ -0,0 +1,108 @@
+"""
+Read-replica routing for the flask-peewee database wrapper.
+
+The primary database is configured as usual, and any number of replicas may
+be listed alongside it.  Replica configurations inherit the engine and
+connection parameters of the primary unless they override them:
+
+    DATABASE = {
+        'name': 'my_app',
+        'engine': 'peewee.PostgresqlDatabase',
+        'user': 'postgres',
+        'replicas': [
+            {'name': 'my_app', 'host': 'replica-1'},
+            {'name': 'my_app', 'host': 'replica-2'},
+        ],
+        'replica_policy': 'flask_peewee.replicas.RandomPolicy',
+        'sticky_window': 5,
+    }
+
+Once a request has written to the primary, reads stay on the primary for the
+rest of the request and, for clients that keep their session cookie, for
+``sticky_window`` seconds afterwards.
+"""
+import itertools
+import random
+import threading
+import time
+
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import session
+
+from flask_peewee.utils import is_write_query
+
+
+class ReplicaPolicy(object):
+    """
+    Decides which replica should serve a read.
+    """
+    def __init__(self, replicas):
+        self.replicas = replicas
+
+    def choose(self):
+        raise NotImplementedError
+
+
+class RoundRobinPolicy(ReplicaPolicy):
+    def __init__(self, replicas):
+        super(RoundRobinPolicy, self).__init__(replicas)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            idx = next(self._counter)
+        return self.replicas[idx % len(self.replicas)]
+
+
+class RandomPolicy(ReplicaPolicy):
+    def choose(self):
+        return random.choice(self.replicas)
+
+
+class ReplicatedDatabase(object):
+    """
+    Mixin for the primary ``peewee.Database`` which knows about its replicas
+    and remembers when the current request last wrote to it.
+    """
+    session_key = '_db_last_write'
+
+    def __init__(self, database, replicas=None, replica_policy=RoundRobinPolicy,
+                 sticky_window=5, **kwargs):
+        self.replicas = replicas or []
+        self.replica_policy = replica_policy(self.replicas)
+        self.sticky_window = sticky_window
+        super(ReplicatedDatabase, self).__init__(database, **kwargs)
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        cursor = super(ReplicatedDatabase, self).execute_sql(sql, params, require_commit)
+        if has_request_context() and is_write_query(sql):
+            self.record_write()
+        return cursor
+
+    def record_write(self):
+        g._db_wrote = True
+        if current_app.secret_key:
+            session[self.session_key] = time.time()
+
+    def should_read_primary(self):
+        depth = self.transaction_depth()
+        if has_request_context() and g.get('_db_transaction') is not None:
+            # the per-request transaction only pins reads to the primary
+            # once the request has written something
+            depth -= 1
+        if depth:
+            return True
+        if not has_request_context():
+            return False
+        if getattr(g, '_db_wrote', False):
+            return True
+        last_write = session.get(self.session_key)
+        return bool(last_write) and time.time() - last_write < self.sticky_window
+
+    def get_read_database(self):
+        if not self.replicas or self.should_read_primary():
+            return self
+        return self.replica_policy.choose()
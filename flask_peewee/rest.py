@@ -12,15 +12,19 @@ from flask import g
 from flask import redirect
 from flask import request
 from flask import session
+from flask import stream_with_context
 from flask import url_for
 from peewee import *
 from peewee import DJANGO_MAP
 
+from flask_peewee.budget import query_budget
 from flask_peewee.filters import make_field_tree
 from flask_peewee.serializer import Deserializer
 from flask_peewee.serializer import Serializer
+from flask_peewee.streaming import stream
 from flask_peewee.utils import PaginatedQuery
 from flask_peewee.utils import get_object_or_404
+from flask_peewee.utils import get_read_query
 from flask_peewee.utils import slugify
 from flask_peewee._compat import reduce
 
@@ -118,6 +122,12 @@ class AdminAuthentication(UserAuthentication):
 class RestResource(object):
     paginate_by = 20
 
+    # paginate by cursors rather than page numbers, see PaginatedQuery
+    keyset_pagination = False
+
+    # how the pages are counted, exactly by default -- see counting.py
+    count_strategy = None
+
     # serializing: dictionary of model -> field names to restrict output
     fields = None
     exclude = None
@@ -134,6 +144,10 @@ class RestResource(object):
     # delete behavior
     delete_recursive = True
 
+    # seconds the queries of each request may take, see the database's
+    # "query_budget" option
+    query_budget = None
+
     def __init__(self, rest_api, model, authentication, allowed_methods=None):
         self.api = rest_api
         self.model = model
@@ -267,6 +281,21 @@ class RestResource(object):
                 for obj in query
         ]
 
+    def overrides(self, name):
+        method = getattr(type(self), name)
+        original = RestResource.__dict__[name]
+        return getattr(method, '__func__', method) is not original
+
+    def can_stream(self):
+        # resources customizing how lists are serialized or sent get them
+        # whole, through serialize_query() and response()
+        return not self.overrides('serialize_query') and not self.overrides('response')
+
+    def stream_query(self, query):
+        s = self.get_serializer()
+        for obj in stream(query):
+            yield self.prepare_data(obj, s.serialize_object(obj, self._fields, self._exclude))
+
     def deserialize_object(self, data, instance):
         d = self.get_deserializer()
         return d.deserialize_object(instance, data)
@@ -284,6 +313,19 @@ class RestResource(object):
         kwargs = {} if request.is_xhr else {'indent': 2}
         return Response(json.dumps(data, **kwargs), mimetype='application/json')
 
+    def response_stream(self, objects):
+        # serialize one object at a time, so unpaginated lists of any size can
+        # be sent in constant memory
+        kwargs = {} if request.is_xhr else {'indent': 2}
+
+        def generate():
+            yield '['
+            for i, obj in enumerate(objects):
+                yield ', ' if i else '\n'
+                yield json.dumps(obj, **kwargs)
+            yield '\n]'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
     def require_method(self, func, methods):
         @functools.wraps(func)
         def inner(*args, **kwargs):
@@ -325,10 +367,13 @@ class RestResource(object):
             return self.create()
 
     def api_detail(self, pk, method=None):
-        obj = get_object_or_404(self.get_query(), self.pk==pk)
-
         method = method or request.method
 
+        query = self.get_query()
+        if method == 'GET':
+            query = get_read_query(query)
+        obj = get_object_or_404(query, self.pk==pk)
+
         if not getattr(self, 'check_%s' % method.lower())(obj):
             return self.response_forbidden()
 
@@ -353,6 +398,9 @@ class RestResource(object):
         return query
 
     def get_request_metadata(self, paginated_query):
+        if paginated_query.keyset:
+            return self.get_keyset_metadata(paginated_query)
+
         var = paginated_query.page_var
         request_arguments = request.args.copy()
 
@@ -362,7 +410,7 @@ class RestResource(object):
         if current_page > 1:
             request_arguments[var] = current_page - 1
             previous = url_for(self.get_url_name('api_list'), **request_arguments)
-        if current_page < paginated_query.get_pages():
+        if paginated_query.has_next():
             request_arguments[var] = current_page + 1
             next = url_for(self.get_url_name('api_list'), **request_arguments)
 
@@ -373,6 +421,31 @@ class RestResource(object):
             'next': next,
         }
 
+    def get_keyset_metadata(self, paginated_query):
+        var = paginated_query.cursor_var
+        request_arguments = request.args.copy()
+        request_arguments.pop(paginated_query.page_var, None)
+
+        previous_cursor = paginated_query.get_previous_cursor()
+        next_cursor = paginated_query.get_next_cursor()
+        next = previous = ''
+
+        if previous_cursor:
+            request_arguments[var] = previous_cursor
+            previous = url_for(self.get_url_name('api_list'), **request_arguments)
+        if next_cursor:
+            request_arguments[var] = next_cursor
+            next = url_for(self.get_url_name('api_list'), **request_arguments)
+
+        return {
+            'model': self.get_api_name(),
+            'page': paginated_query.get_page(),
+            'previous': previous,
+            'next': next,
+            'previous_cursor': previous_cursor,
+            'next_cursor': next_cursor,
+        }
+
     def get_paginate_by(self):
         try:
             paginate_by = int(request.args.get('limit', self.paginate_by))
@@ -385,7 +458,11 @@ class RestResource(object):
 
     def paginated_object_list(self, filtered_query):
         paginate_by = self.get_paginate_by()
-        pq = PaginatedQuery(filtered_query, paginate_by)
+        pq = PaginatedQuery(
+            filtered_query,
+            paginate_by,
+            self.keyset_pagination,
+            self.count_strategy)
         meta_data = self.get_request_metadata(pq)
 
         query_dict = self.serialize_query(pq.get_list())
@@ -396,7 +473,7 @@ class RestResource(object):
         })
 
     def object_list(self):
-        query = self.get_query()
+        query = get_read_query(self.get_query())
         query = self.apply_ordering(query)
 
         # process any filters
@@ -405,6 +482,8 @@ class RestResource(object):
         if self.paginate_by or 'limit' in request.args:
             return self.paginated_object_list(query)
 
+        if self.can_stream():
+            return self.response_stream(self.stream_query(query))
         return self.response(self.serialize_query(query))
 
     def object_detail(self, obj):
@@ -522,10 +601,13 @@ class RestAPI(object):
             api_name = provider.get_api_name()
             for url, callback in provider.get_urls():
                 full_url = '/%s%s' % (api_name, url)
+                view = self.auth_wrapper(callback, provider)
+                if provider.query_budget is not None:
+                    view = query_budget(provider.query_budget)(view)
                 self.blueprint.add_url_rule(
                     full_url,
                     '%s_%s' % (api_name, callback.__name__),
-                    self.auth_wrapper(callback, provider),
+                    view,
                     methods=provider.allowed_methods,
                 )
 
@@ -0,0 +1,214 @@
+"""
+Caching of query results for models whose tables rarely change.
+
+With the result cache enabled, SELECT queries on models which opt in are
+answered from memory when the same SQL and parameters were seen recently:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'result_cache': True,
+        'result_cache_size': 1024,     # entries
+        'result_cache_ttl': 300,       # seconds
+        'result_cache_max_rows': 1000, # larger results are not cached
+    }
+
+    class Category(db.Model):
+        name = CharField()
+
+        class Meta:
+            cache_results = True
+            cache_ttl = 3600  # optional, overrides result_cache_ttl
+
+Every entry is tagged with the tables its query read and the "generation" of
+each of them.  Any write to a table made through the database -- saving or
+deleting instances, insert, update and delete queries, even raw SQL --
+increments the table's generation, which makes the entries reading it stale.
+"""
+import time
+from collections import OrderedDict
+
+from peewee import Model
+from peewee import SelectQuery
+
+from flask_peewee.invalidation import GenerationTracker
+from flask_peewee.invalidation import WriteTrackingDatabase
+from flask_peewee.invalidation import get_read_tables
+
+
+class ResultCache(GenerationTracker):
+    """
+    Thread-safe LRU mapping of (SQL, parameters) to result rows.
+    """
+    def __init__(self, max_size=1024, ttl=300, max_rows=1000):
+        super(ResultCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires, generations, result = entry
+            if expires < time.time() or not self._is_current(generations):
+                self.invalidations += 1
+                self.misses += 1
+                return None
+
+            self._data[key] = entry
+            self.hits += 1
+            return result
+
+    def set(self, key, generations, result, ttl=None):
+        if len(result[0]) > self.max_rows:
+            return
+        expires = time.time() + (ttl or self.ttl)
+        with self._lock:
+            # a write while the query ran makes the result stale already
+            if not self._is_current(generations):
+                return
+            self._data.pop(key, None)
+            self._data[key] = (expires, generations, result)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+            }
+
+
+class CachedCursor(object):
+    """
+    Cursor over rows taken from the result cache.
+    """
+    name = None
+
+    def __init__(self, rows, description):
+        self.description = description
+        self.rowcount = len(rows)
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=1):
+        return [row for _, row in zip(range(size), self._rows)]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class ResultCacheDatabase(WriteTrackingDatabase):
+    """
+    Mixin for a ``peewee.Database`` which caches the results of SELECT queries
+    and invalidates them as tables are written.
+    """
+    def __init__(self, database, result_cache=True, **kwargs):
+        if not isinstance(result_cache, ResultCache):
+            result_cache = ResultCache()
+        self.result_cache = result_cache
+        super(ResultCacheDatabase, self).__init__(database, **kwargs)
+
+    def tables_written(self, namespace, tables, committed):
+        # invalidated again on commit, in case another connection cached the
+        # old rows in the meantime
+        self.result_cache.invalidate(namespace, tables)
+        super(ResultCacheDatabase, self).tables_written(namespace, tables, committed)
+
+    def execute_cached(self, sql, params=None, require_commit=True, ttl=None):
+        """
+        Execute a SELECT, answering it from the result cache when possible.
+        """
+        # catch up with the writes of other processes, see invalidation.py
+        poll_invalidations = getattr(self, 'poll_invalidations', None)
+        if poll_invalidations is not None:
+            poll_invalidations()
+
+        uncommitted = self.get_uncommitted()
+        namespace = self.get_namespace()
+        key = (namespace, sql, tuple(params or ()))
+        try:
+            hash(key)
+        except TypeError:
+            return self.execute_sql(sql, params, require_commit)
+
+        result = self.result_cache.get(key)
+        if result is not None:
+            rows, description = result
+            return CachedCursor(rows, description)
+
+        generations = self.result_cache.get_generations(namespace, get_read_tables(sql))
+        cursor = self.execute_sql(sql, params, require_commit)
+        if uncommitted:
+            # rows which other connections can't see yet must not be shared
+            return cursor
+
+        rows = tuple(cursor.fetchall())
+        description = cursor.description
+        cursor.close()
+        self.result_cache.set(key, generations, (rows, description), ttl)
+        return CachedCursor(rows, description)
+
+
+class CachedSelectQuery(SelectQuery):
+    """
+    SelectQuery whose results are cached if its model has ``cache_results``
+    set in its ``Meta``.
+    """
+    def get_cache_ttl(self):
+        meta = self.model_class._meta
+        if getattr(meta, 'cache_results', False) or getattr(meta, 'cache_ttl', None):
+            return getattr(meta, 'cache_ttl', None) or True
+
+    def is_locking(self):
+        # peewee 2.10 keeps the locking clause, if any, and earlier versions a
+        # (for_update, nowait) tuple
+        for_update = self._for_update
+        if isinstance(for_update, tuple):
+            return for_update[0]
+        return bool(for_update)
+
+    def _execute(self):
+        execute_cached = getattr(self.database, 'execute_cached', None)
+        ttl = self.get_cache_ttl()
+        if execute_cached is None or not ttl or self.is_locking():
+            return super(CachedSelectQuery, self)._execute()
+
+        sql, params = self.sql()
+        return execute_cached(
+            sql,
+            params,
+            self.require_commit,
+            ttl if ttl is not True else None)
+
+
+class CachedModel(Model):
+    @classmethod
+    def select(cls, *selection):
+        query = CachedSelectQuery(cls, *selection)
+        if cls._meta.order_by:
+            query = query.order_by(*cls._meta.order_by)
+        return query
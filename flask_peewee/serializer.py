@@ -1,11 +1,56 @@
 import datetime
+import decimal
 import sys
+import uuid
 
+from peewee import ForeignKeyField
 from peewee import Model
+from flask_peewee._compat import PY2
+from flask_peewee._compat import string_types
 from flask_peewee.utils import get_dictionary_from_model
 from flask_peewee.utils import get_model_from_dictionary
 
 
+# values of these types are serialized as they are
+PLAIN_TYPES = set((type(None), bool, int, float, bytes, decimal.Decimal, uuid.UUID) + string_types)
+if PY2:
+    PLAIN_TYPES.add(long)
+
+# the default formats, which isoformat() produces much faster than strftime()
+ISO_FORMATS = {
+    (datetime.datetime, '%Y-%m-%d %H:%M:%S'): lambda value: value.isoformat(' ')[:19],
+    (datetime.date, '%Y-%m-%d'): lambda value: value.isoformat(),
+    (datetime.time, '%H:%M:%S'): lambda value: value.isoformat()[:8],
+}
+
+def freeze(fields):
+    if fields:
+        return frozenset((model, tuple(names)) for model, names in fields.items())
+
+
+class SerializationPlan(object):
+    """
+    The fields of a model to serialize, each with the converter for its
+    values, resolved once for a combination of ``fields`` and ``exclude``.
+    """
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.steps = []
+
+    def serialize(self, obj):
+        data = obj._data
+        result = {}
+        for name, convert, plain, rel_plan in self.steps:
+            value = data.get(name)
+            if rel_plan is not None and value:
+                result[name] = rel_plan.serialize(getattr(obj, name))
+            elif plain and value.__class__ in PLAIN_TYPES:
+                result[name] = value
+            else:
+                result[name] = convert(value)
+        return result
+
+
 class Serializer(object):
     date_format = '%Y-%m-%d'
     time_format = '%H:%M:%S'
@@ -33,9 +78,90 @@ class Serializer(object):
                 data[key] = self.convert_value(value)
         return data
 
+    def clean_value(self, value):
+        # what clean_data() does to a single value
+        if isinstance(value, dict):
+            return self.clean_data(value)
+        elif isinstance(value, (list, tuple)):
+            return map(self.clean_data, value)
+        return self.convert_value(value)
+
+    def overrides(self, name):
+        method = getattr(type(self), name)
+        original = Serializer.__dict__[name]
+        return getattr(method, '__func__', method) is not original
+
+    def get_converter(self, field):
+        """
+        Return the function converting values of ``field``, which takes the
+        shortcut for the type the field normally holds.
+        """
+        clean_value = self.clean_value
+        if self.overrides('convert_value'):
+            return clean_value
+
+        for value_type, value_format in (
+                (datetime.datetime, self.datetime_format),
+                (datetime.date, self.date_format),
+                (datetime.time, self.time_format)):
+            if field.get_db_field() != value_type.__name__:
+                continue
+            isoformat = ISO_FORMATS.get((value_type, value_format))
+            if isoformat is not None:
+                def convert(value, value_type=value_type, isoformat=isoformat):
+                    # strftime() doesn't pad years before 1000
+                    if value.__class__ is value_type and \
+                            getattr(value, 'year', 1000) >= 1000:
+                        return isoformat(value)
+                    return clean_value(value)
+            else:
+                def convert(value, value_type=value_type, value_format=value_format):
+                    if value.__class__ is value_type:
+                        return value.strftime(value_format)
+                    return clean_value(value)
+            return convert
+        return clean_value
+
+    def get_plan(self, model_class, fields=None, exclude=None):
+        """
+        Return the serialization plan of ``model_class`` for the given
+        ``fields`` and ``exclude``, compiling it the first time.
+        """
+        # keyed on a copy of the field lists, which callers may change later
+        plans = self.__dict__.setdefault('_plans', {})
+        key = (model_class, freeze(fields), freeze(exclude))
+        plan = plans.get(key)
+        if plan is None:
+            # registered first, so that models referencing themselves reuse it
+            plan = plans[key] = SerializationPlan(model_class)
+            plan.steps = self.compile(model_class, fields or {}, exclude or {})
+        return plan
+
+    def compile(self, model_class, fields, exclude):
+        plain = not self.overrides('convert_value')
+        curr_exclude = exclude.get(model_class, [])
+        curr_fields = fields.get(model_class, model_class._meta.sorted_field_names)
+
+        steps = []
+        for field_name in curr_fields:
+            if field_name in curr_exclude:
+                continue
+            field_obj = model_class._meta.fields[field_name]
+            rel_plan = None
+            if isinstance(field_obj, ForeignKeyField) and field_obj.rel_model in fields:
+                rel_plan = self.get_plan(field_obj.rel_model, fields, exclude)
+            steps.append((field_name, self.get_converter(field_obj), plain, rel_plan))
+        return steps
+
     def serialize_object(self, obj, fields=None, exclude=None):
-        data = get_dictionary_from_model(obj, fields, exclude)
-        return self.clean_data(data)
+        compiled = self.__dict__.get('_compiled')
+        if compiled is None:
+            # plans can't apply a clean_data() of a subclass field by field
+            compiled = self._compiled = not self.overrides('clean_data')
+        if not compiled:
+            data = get_dictionary_from_model(obj, fields, exclude)
+            return self.clean_data(data)
+        return self.get_plan(type(obj), fields, exclude).serialize(obj)
 
 
 class Deserializer(object):
@@ -0,0 +1,619 @@
+"""
+Sharding of models across several databases.
+
+Large tables can be split across shards, while all other models stay in the
+primary database.  Shard configurations inherit the engine and connection
+parameters of the primary, like replicas do:
+
+    DATABASE = {
+        'name': 'main.db',
+        'engine': 'peewee.SqliteDatabase',
+        'shards': [
+            {'name': 'messages-0.db'},
+            {'name': 'messages-1.db'},
+        ],
+    }
+
+A model is sharded by naming the field which decides where its rows live:
+
+    class Message(db.Model):
+        user = ForeignKeyField(User)
+        content = TextField()
+
+        class Meta:
+            shard_key = 'user'
+
+Inserts, and queries which filter on the shard key (or on the primary key),
+run against a single shard.  Any other query runs on every shard, with the
+results merged, ordered and paginated afterwards.
+
+Integer primary keys are allocated so that the shard a row lives on can be
+told from its id, making lookups by primary key as cheap as lookups by the
+shard key.  Every shard keeps the next id of its tables in an allocation row,
+which a write locks until it commits, so concurrent writers never pick the
+same id.
+"""
+import numbers
+import zlib
+
+from peewee import *
+from peewee import Clause
+from peewee import DeleteQuery
+from peewee import Expression
+from peewee import Func
+from peewee import InsertQuery
+from peewee import JOIN
+from peewee import Node
+from peewee import OP
+from peewee import SelectQuery
+from peewee import UpdateQuery
+
+from flask_peewee._compat import text_type
+
+
+class CrossShardQuery(Exception):
+    """
+    Raised for queries which can't be answered from rows merged across shards.
+    """
+    pass
+
+
+AGGREGATES = ('AVG', 'COUNT', 'GROUP_CONCAT', 'MAX', 'MIN', 'SUM', 'TOTAL')
+
+
+def get_referenced_models(nodes, accum=None):
+    if accum is None:
+        accum = set()
+    for node in nodes:
+        if isinstance(node, Field):
+            accum.add(node.model_class)
+        elif isinstance(node, Expression):
+            get_referenced_models((node.lhs, node.rhs), accum)
+        elif isinstance(node, Func):
+            get_referenced_models(node.arguments, accum)
+        elif isinstance(node, Clause):
+            get_referenced_models(node.nodes, accum)
+        elif isinstance(node, (list, tuple)):
+            get_referenced_models(node, accum)
+    return accum
+
+
+class ShardRouter(object):
+    """
+    Maps shard keys and primary keys to the index of a shard.
+    """
+    def __init__(self, shards):
+        self.shards = shards
+
+    def get_index(self, value):
+        if isinstance(value, Model):
+            value = value._get_pk_value()
+        if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+            return value % len(self.shards)
+        value = text_type(value).encode('utf-8')
+        return (zlib.crc32(value) & 0xffffffff) % len(self.shards)
+
+    def get_pk_index(self, pk):
+        # ids on shard "i" are allocated as i + 1, i + 1 + n, i + 1 + 2n, ...
+        return (pk - 1) % len(self.shards)
+
+    # table on every shard holding the next id to allocate for each table
+    allocation_table = 'shard_ids'
+
+    def create_allocation_table(self, database):
+        database.execute_sql(
+            'CREATE TABLE IF NOT EXISTS %s (name VARCHAR(255) NOT NULL '
+            'PRIMARY KEY, next_id BIGINT NOT NULL)' % self.quote(
+                database, self.allocation_table))
+
+    def reset_allocation(self, database, model_class):
+        if self.allocation_table in database.get_tables():
+            database.execute_sql(
+                'DELETE FROM %s WHERE name = %s' % (
+                    self.quote(database, self.allocation_table),
+                    database.interpolation),
+                (model_class._meta.db_table,))
+
+    def quote(self, database, name):
+        return '%s%s%s' % (database.quote_char, name, database.quote_char)
+
+    def allocate_pk(self, model_class, index):
+        """
+        Return a new primary key for a row of ``model_class`` on the shard at
+        ``index``.  Incrementing the allocation row locks it until the
+        transaction ends, so concurrent writers get distinct ids.
+        """
+        database = self.shards[index]
+        try:
+            with database.atomic():
+                return self._allocate_pk(database, model_class, index)
+        except IntegrityError:
+            # another writer created the allocation row first
+            with database.atomic():
+                return self._allocate_pk(database, model_class, index)
+
+    def _allocate_pk(self, database, model_class, index):
+        step = len(self.shards)
+        name = model_class._meta.db_table
+        table = self.quote(database, self.allocation_table)
+        param = database.interpolation
+
+        cursor = database.execute_sql(
+            'UPDATE %s SET next_id = next_id + %s WHERE name = %s' % (
+                table, param, param),
+            (step, name))
+        if cursor.rowcount:
+            cursor = database.execute_sql(
+                'SELECT next_id FROM %s WHERE name = %s' % (table, param),
+                (name,))
+            return cursor.fetchone()[0] - step
+
+        # the first id allocated for the table follows any rows already in it
+        pk = model_class._meta.primary_key
+        cursor = database.execute_sql(
+            'SELECT MAX(%s) FROM %s' % (
+                self.quote(database, pk.db_column),
+                self.quote(database, model_class._meta.db_table)))
+        last_id = cursor.fetchone()[0]
+        if last_id is None:
+            next_id = index + 1
+        else:
+            # the next id after it which belongs to this shard
+            next_id = last_id + 1 + (index - last_id) % step
+        database.execute_sql(
+            'INSERT INTO %s (name, next_id) VALUES (%s, %s)' % (
+                table, param, param),
+            (name, next_id + step))
+        return next_id
+
+
+class MergedCursor(object):
+    """
+    Cursor-like object returning the rows from several cursors, optionally
+    de-duplicated, sorted and sliced.
+    """
+    def __init__(self, cursors, ordering=None, offset=None, limit=None,
+                 distinct=False):
+        self.description = None
+        rows = []
+        for cursor in cursors:
+            if self.description is None:
+                self.description = cursor.description
+            rows.extend(cursor.fetchall())
+
+        if distinct:
+            seen = set()
+            rows = [row for row in rows
+                    if not (row in seen or seen.add(row))]
+
+        # sort on the least significant column first, relying on sort stability
+        for idx, descending in reversed(ordering or ()):
+            rows.sort(
+                key=lambda row: (row[idx] is not None, row[idx]),
+                reverse=descending)
+
+        start = offset or 0
+        if limit is not None:
+            rows = rows[start:start + limit]
+        elif start:
+            rows = rows[start:]
+
+        self.rowcount = len(rows)
+        self.lastrowid = None
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=100):
+        return [row for row in (self.fetchone() for i in range(size))
+                if row is not None]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+class SummedCursor(object):
+    """
+    Cursor-like object reporting the rows affected by a write on every shard.
+    """
+    def __init__(self, cursors):
+        self.description = None
+        self.lastrowid = None
+        self.rowcount = sum(cursor.rowcount for cursor in cursors)
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class ShardedQuery(object):
+    """
+    Mixin for peewee queries on sharded models, which decides at execution
+    time which shards the query runs on.
+    """
+    @property
+    def router(self):
+        return self.model_class._meta.shard_router
+
+    def get_shards(self):
+        indexes = self.get_shard_indexes(getattr(self, '_where', None))
+        if indexes is None:
+            return list(self.router.shards)
+        return [self.router.shards[idx] for idx in sorted(indexes)]
+
+    def get_shard_indexes(self, node):
+        """
+        Return the set of shard indexes the rows matching ``node`` may live
+        on, or ``None`` if they could be on any shard.
+        """
+        if not isinstance(node, Expression) or node._negated:
+            return None
+
+        if node.op in (OP.AND, OP.OR):
+            lhs = self.get_shard_indexes(node.lhs)
+            rhs = self.get_shard_indexes(node.rhs)
+            if node.op == OP.OR:
+                if lhs is None or rhs is None:
+                    return None
+                return lhs | rhs
+            elif lhs is None or rhs is None:
+                return rhs if lhs is None else lhs
+            return lhs & rhs
+
+        if node.op == OP.EQ:
+            values = [node.rhs]
+        elif node.op == OP.IN and isinstance(node.rhs, (list, tuple, set)):
+            values = node.rhs
+        else:
+            return None
+
+        field = node.lhs
+        if not isinstance(field, Field) or field.model_class is not self.model_class:
+            return None
+        get_index = self.get_index_function(field)
+        if get_index is None:
+            return None
+        try:
+            return set(get_index(value) for value in values)
+        except (TypeError, ValueError):
+            return None
+
+    def get_index_function(self, field):
+        # values are converted as they would be for the database, so that
+        # e.g. "1" from a query string routes the same way as 1
+        meta = self.model_class._meta
+        if field.name == meta.shard_key:
+            return lambda value: self.router.get_index(field.db_value(value))
+        elif field is meta.primary_key and meta.auto_increment:
+            return lambda pk: self.router.get_pk_index(field.db_value(pk))
+
+    def _execute_on(self, shards):
+        sql, params = self.sql()
+        return [shard.execute_sql(sql, params, self.require_commit)
+                for shard in shards]
+
+
+class ShardedSelectQuery(ShardedQuery, SelectQuery):
+    def _execute_on(self, shards):
+        return super(ShardedSelectQuery, self._prune_joins())._execute_on(shards)
+
+    def _prune_joins(self):
+        """
+        Filtering on a foreign key (e.g. ``.filter(user=1)``) joins the related
+        model, which is not available on the shards when it isn't sharded.
+        Inner joins like these, which nothing else in the query refers to, are
+        replaced by a check that the foreign key is set.
+        """
+        referenced = get_referenced_models((
+            self._select,
+            self._where,
+            self._order_by or (),
+            self._group_by or (),
+            self._having))
+
+        query = self
+        for src, joins in self._joins.items():
+            for join in joins:
+                dest = join.dest
+                if dest in referenced or dest in self._joins or \
+                        join.join_type not in (None, JOIN.INNER) or \
+                        getattr(dest, '_meta', None) is None or \
+                        getattr(dest._meta, 'shard_key', None) is not None:
+                    continue
+
+                fk = src._meta.rel_for_model(dest)
+                if fk is None or not self.is_fk_join(join.on, fk):
+                    continue
+
+                if query is self:
+                    query = self.clone()
+                query._joins[src] = [j for j in query._joins[src] if j is not join]
+                if fk.null:
+                    query = query.where(fk.is_null(False))
+        return query
+
+    def _execute(self):
+        shards = self.get_shards()
+        if len(shards) == 1:
+            return self._execute_on(shards)[0]
+
+        if self._group_by:
+            raise CrossShardQuery(
+                'Grouping a query across shards is not supported, filter '
+                'it by "%s".' % self.model_class._meta.shard_key)
+        if self.has_aggregates():
+            raise CrossShardQuery(
+                'Aggregating a query across shards is not supported, filter '
+                'it by "%s".' % self.model_class._meta.shard_key)
+
+        # every shard returns enough rows to fill the requested page, which
+        # is then taken from the merged results
+        clone = self.clone()
+        if self._limit is not None:
+            clone._limit = self._limit + (self._offset or 0)
+        clone._offset = None
+        return MergedCursor(
+            clone._execute_on(shards),
+            ordering=self.get_ordering(),
+            offset=self._offset,
+            limit=self._limit,
+            distinct=bool(self._distinct))
+
+    def exists(self):
+        clone = self.order_by().paginate(1, 1)
+        clone._select = [SQL('1')]
+        return bool(clone.scalar())
+
+    def has_aggregates(self):
+        for node in self._select:
+            if isinstance(node, Func) and node.name.upper() in AGGREGATES:
+                return True
+        return False
+
+    def get_ordering(self):
+        ordering = []
+        for node in self._order_by or ():
+            for idx, selected in enumerate(self._select):
+                if self.is_same_column(node, selected):
+                    ordering.append((idx, node._ordering == 'DESC'))
+                    break
+            else:
+                raise CrossShardQuery(
+                    'Results merged across shards can only be ordered by '
+                    'selected fields: %r' % (node,))
+        return ordering
+
+    def is_same_column(self, node, selected):
+        if isinstance(node, Field):
+            return isinstance(selected, Field) and \
+                selected.model_class is node.model_class and \
+                selected.name == node.name
+        return node._alias is not None and node._alias == selected._alias
+
+    def is_fk_join(self, on, fk):
+        if on is None or on is fk:
+            return True
+        return isinstance(on, Expression) and on.op == OP.EQ and \
+            on.lhs is fk and on.rhs is fk.to_field
+
+    def aggregate(self, aggregation=None, convert=True):
+        shards = self.get_shards()
+        if len(shards) == 1 or aggregation is not None:
+            return super(ShardedSelectQuery, self).aggregate(aggregation, convert)
+
+        # counts can be added up
+        cursors = self._aggregate()._execute_on(shards)
+        return sum(cursor.fetchone()[0] or 0 for cursor in cursors)
+
+    def wrapped_count(self, clear_limit=False):
+        clone = self._prune_joins().order_by()
+        clone._limit = clone._offset = None
+        shards = clone.get_shards()
+        if len(shards) > 1 and self._group_by:
+            raise CrossShardQuery(
+                'Grouping a query across shards is not supported, filter '
+                'it by "%s".' % self.model_class._meta.shard_key)
+
+        sql, params = clone.sql()
+        wrapped = 'SELECT COUNT(1) FROM (%s) AS wrapped_select' % sql
+        count = sum(
+            shard.execute_sql(wrapped, params, self.require_commit).fetchone()[0]
+            for shard in shards)
+
+        if not clear_limit:
+            count = max(0, count - (self._offset or 0))
+            if self._limit is not None:
+                count = min(count, self._limit)
+        return count
+
+
+class ShardedUpdateQuery(ShardedQuery, UpdateQuery):
+    def check_shard_key(self, shards):
+        """
+        Rows stay on the shard they were inserted on, so the shard key may
+        only be set to a value of the one shard the update runs on.
+        """
+        meta = self.model_class._meta
+        for field, value in self._update.items():
+            if field.name != meta.shard_key:
+                continue
+            index = None
+            if not isinstance(value, Node):
+                index = self.router.get_index(field.db_value(value))
+            if index is None or shards != [self.router.shards[index]]:
+                raise CrossShardQuery(
+                    'Updating "%s" would move rows to another shard, delete '
+                    'and insert them again instead.' % meta.shard_key)
+
+    def _execute(self):
+        shards = self.get_shards()
+        self.check_shard_key(shards)
+        cursors = self._execute_on(shards)
+        if len(cursors) == 1:
+            return cursors[0]
+        return SummedCursor(cursors)
+
+
+class ShardedDeleteQuery(ShardedQuery, DeleteQuery):
+    def _execute(self):
+        cursors = self._execute_on(self.get_shards())
+        if len(cursors) == 1:
+            return cursors[0]
+        return SummedCursor(cursors)
+
+
+class ShardedInsertQuery(ShardedQuery, InsertQuery):
+    def get_row_index(self, row):
+        meta = self.model_class._meta
+        pk = meta.primary_key
+        key_value = pk_value = None
+        for field, value in row.items():
+            if field.name == meta.shard_key:
+                key_value = field.db_value(value)
+            elif field is pk:
+                pk_value = field.db_value(value)
+
+        if key_value is not None:
+            return self.router.get_index(key_value)
+        elif pk_value is not None and meta.auto_increment:
+            return self.router.get_pk_index(pk_value)
+        raise ValueError('Unable to insert %s without a value for the shard '
+                         'key "%s".' % (self.model_class.__name__, meta.shard_key))
+
+    def has_pk(self, row):
+        pk = self.model_class._meta.primary_key
+        return any(getattr(key, 'name', key) == pk.name for key in row)
+
+    def _insert_with_loop(self):
+        last_id = None
+        id_list = []
+        for row in self._rows:
+            last_id = (type(self)(self.model_class, row)
+                       .upsert(self._upsert)
+                       .execute())
+            id_list.append(last_id)
+        return id_list if self._return_id_list else last_id
+
+    def execute(self):
+        # rows are inserted one at a time, each on its own shard with an id
+        # allocated there
+        if self._is_multi_row_insert and self._query is None and \
+                self.model_class._meta.auto_increment:
+            return self._insert_with_loop()
+        return super(ShardedInsertQuery, self).execute()
+
+    def _execute(self):
+        if self._query is not None:
+            raise CrossShardQuery('INSERT ... SELECT is not supported for '
+                                  'sharded models.')
+
+        rows = list(self._iter_rows())
+        indexes = set(self.get_row_index(row) for row in rows)
+        if len(indexes) != 1:
+            raise ValueError('Rows inserted together must belong to the same '
+                             'shard.')
+        index = indexes.pop()
+
+        query = self
+        meta = self.model_class._meta
+        if meta.auto_increment:
+            pk = meta.primary_key
+            query = self.clone()
+            query._rows = [
+                row if self.has_pk(row) else dict(row, **{
+                    pk.name: self.router.allocate_pk(self.model_class, index)})
+                for row in self._rows]
+        return query._execute_on([self.router.shards[index]])[0]
+
+
+class ShardedModel(Model):
+    """
+    Model base class whose subclasses may be sharded by setting ``shard_key``
+    in their ``Meta``.  Models without a shard key live in the primary
+    database as usual.
+    """
+    @classmethod
+    def is_sharded(cls):
+        return getattr(cls._meta, 'shard_key', None) is not None
+
+    @classmethod
+    def select(cls, *selection):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).select(*selection)
+        query = ShardedSelectQuery(cls, *selection)
+        if cls._meta.order_by:
+            query = query.order_by(*cls._meta.order_by)
+        return query
+
+    @classmethod
+    def update(cls, __data=None, **update):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).update(__data, **update)
+        fdict = __data or {}
+        fdict.update([(cls._meta.fields[f], update[f]) for f in update])
+        return ShardedUpdateQuery(cls, fdict)
+
+    @classmethod
+    def insert(cls, __data=None, **insert):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).insert(__data, **insert)
+        fdict = __data or {}
+        fdict.update([(cls._meta.fields[f], insert[f]) for f in insert])
+        return ShardedInsertQuery(cls, fdict)
+
+    @classmethod
+    def insert_many(cls, rows, validate_fields=True):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).insert_many(rows, validate_fields)
+        return ShardedInsertQuery(cls, rows=rows, validate_fields=validate_fields)
+
+    @classmethod
+    def delete(cls):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).delete()
+        return ShardedDeleteQuery(cls)
+
+    @classmethod
+    def get_shard_databases(cls):
+        if cls.is_sharded():
+            return cls._meta.shard_router.shards
+        return [cls._meta.database]
+
+    @classmethod
+    def table_exists(cls):
+        kwargs = {}
+        if cls._meta.schema:
+            kwargs['schema'] = cls._meta.schema
+        return all(cls._meta.db_table in database.get_tables(**kwargs)
+                   for database in cls.get_shard_databases())
+
+    @classmethod
+    def create_table(cls, fail_silently=False):
+        if not cls.is_sharded():
+            return super(ShardedModel, cls).create_table(fail_silently)
+
+        for database in cls.get_shard_databases():
+            cls._meta.shard_router.create_allocation_table(database)
+            if fail_silently and cls._meta.db_table in database.get_tables():
+                continue
+            database.create_table(cls)
+            for field in cls._fields_to_index():
+                database.create_index(cls, [field], field.unique)
+            for fields, unique in cls._meta.indexes:
+                database.create_index(cls, fields, unique)
+
+    @classmethod
+    def drop_table(cls, fail_silently=False, cascade=False):
+        for database in cls.get_shard_databases():
+            database.drop_table(cls, fail_silently, cascade)
+            if cls.is_sharded():
+                cls._meta.shard_router.reset_allocation(database, cls)
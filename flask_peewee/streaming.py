@@ -0,0 +1,131 @@
+"""
+Streaming iteration over large query results.
+
+Iterating over a query caches every model instance it creates, and most
+database drivers fetch the complete result set up front.  ``stream()`` instead
+fetches rows in chunks and keeps none of them, using a server-side cursor
+where the engine has one, so that memory use stays flat however many rows
+there are:
+
+    from flask_peewee.streaming import stream
+
+    for message in stream(Message.select(), chunk_size=1000):
+        ...
+
+Server-side cursors are used by databases with ``streaming`` enabled:
+
+    DATABASE = {
+        'name': 'my_app',
+        'engine': 'peewee.PostgresqlDatabase',
+        'streaming': True,
+    }
+
+Postgres streams through a named cursor and MySQL through an unbuffered
+``SSCursor`` -- which ties up the connection until the rows have been read.
+SQLite cursors produce rows as they are fetched anyway.  The rows are read in
+a transaction (or a savepoint of the current one), since a named cursor is
+gone once the transaction that declared it commits.
+"""
+import uuid
+
+import peewee
+from peewee import MySQLDatabase
+from peewee import PostgresqlDatabase
+
+from flask_peewee.concurrency import concurrency_for
+from flask_peewee.shards import ShardedQuery
+
+
+class ChunkedCursor(object):
+    """
+    Wraps a DB-API cursor, fetching ``chunk_size`` rows at a time.
+    """
+    def __init__(self, cursor, chunk_size):
+        self._cursor = cursor
+        self._chunk_size = chunk_size
+        self._rows = []
+        self._idx = 0
+
+    def fetchone(self):
+        if self._idx >= len(self._rows):
+            self._rows = self._cursor.fetchmany(self._chunk_size)
+            self._idx = 0
+            if not self._rows:
+                return None
+        row = self._rows[self._idx]
+        self._idx += 1
+        return row
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+
+class StreamingDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which can run a statement on a
+    server-side cursor.
+    """
+    def __init__(self, database, streaming=True, **kwargs):
+        self._stream_local = concurrency_for(self).local()
+        super(StreamingDatabase, self).__init__(database, **kwargs)
+
+    def get_cursor(self):
+        if getattr(self._stream_local, 'server_side', False):
+            self._stream_local.server_side = False
+            return self.get_server_side_cursor()
+        return super(StreamingDatabase, self).get_cursor()
+
+    def get_server_side_cursor(self):
+        conn = self.get_conn()
+        if isinstance(self, PostgresqlDatabase):
+            return conn.cursor(name='flask_peewee_%s' % uuid.uuid4().hex)
+        elif isinstance(self, MySQLDatabase):
+            return conn.cursor(peewee.mysql.cursors.SSCursor)
+        return conn.cursor()
+
+    def execute_streaming(self, sql, params=None, require_commit=False):
+        """
+        Execute ``sql`` like ``execute_sql()``, on a server-side cursor.  The
+        cursor can only be read until the current transaction ends.
+        """
+        self._stream_local.server_side = True
+        try:
+            return self.execute_sql(sql, params, require_commit)
+        finally:
+            self._stream_local.server_side = False
+
+
+def iterate(result_wrapper):
+    # QueryResultWrapper.iterator() lets StopIteration escape its generator,
+    # which is an error as of Python 3.7
+    while True:
+        try:
+            obj = result_wrapper.iterate()
+        except StopIteration:
+            return
+        yield obj
+
+
+def stream(query, chunk_size=500):
+    """
+    Iterate over the results of ``query`` without caching them.
+    """
+    database = query.database
+    if isinstance(query, ShardedQuery) or \
+            not isinstance(database, StreamingDatabase):
+        for obj in iterate(query.execute()):
+            yield obj
+        return
+
+    sql, params = query.sql()
+    with database.atomic():
+        cursor = database.execute_streaming(sql, params)
+        result_wrapper = query._get_result_wrapper()(
+            query.model_class,
+            ChunkedCursor(cursor, chunk_size),
+            query.get_query_meta())
+        try:
+            for obj in iterate(result_wrapper):
+                yield obj
+        finally:
+            cursor.close()
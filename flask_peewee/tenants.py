@@ -0,0 +1,180 @@
+"""
+Per-tenant database routing for the flask-peewee database wrapper.
+
+When every customer has a database of their own, a resolver determines the
+tenant of each request and the wrapper hands out connections to that tenant's
+database.  Models are unchanged, so the REST API, admin and auth all work with
+the current tenant's data:
+
+    DATABASE = {
+        'name': 'default.db',
+        'engine': 'peewee.SqliteDatabase',
+        'tenant_resolver': 'flask_peewee.tenants.SubdomainResolver',
+        'tenant_name': 'tenants/%s.db',  # or list them under "tenants"
+        'max_tenants': 32,        # connection pools kept open at once
+        'max_connections': 4,     # per tenant
+    }
+
+Each tenant gets a connection pool of its own.  Only ``max_tenants`` pools are
+kept, the least recently used one being closed to make room for another.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import session
+
+from flask_peewee.concurrency import concurrency_for
+
+
+def get_tenant_namespace(database):
+    """
+    Return the tenant ``database`` is being used for, if it routes tenants.
+    Tenants share the SQL and connections of the primary, but not its data,
+    so whatever is remembered about the data is kept per tenant.
+    """
+    get_current_tenant = getattr(database, 'get_current_tenant', None)
+    if get_current_tenant is not None:
+        return get_current_tenant()
+
+
+class TenantResolver(object):
+    """
+    Callable returning the tenant of the current request, or ``None``.
+    """
+    def __call__(self):
+        raise NotImplementedError
+
+
+class SubdomainResolver(TenantResolver):
+    """
+    Resolve the tenant from the subdomain, e.g. "acme" for acme.example.com.
+    """
+    def __call__(self):
+        host = request.host.split(':')[0].lower()
+        server_name = current_app.config.get('SERVER_NAME')
+        if server_name:
+            server_name = '.' + server_name.split(':')[0].lower()
+            if host.endswith(server_name):
+                return host[:-len(server_name)] or None
+        else:
+            parts = host.split('.')
+            if len(parts) > 2:
+                return parts[0]
+
+
+class HeaderResolver(TenantResolver):
+    header = 'X-Tenant'
+
+    def __call__(self):
+        return request.headers.get(self.header) or None
+
+
+class SessionResolver(TenantResolver):
+    key = 'tenant'
+
+    def __call__(self):
+        return session.get(self.key)
+
+
+class TenantDatabase(object):
+    """
+    Mixin for a ``peewee.Database`` which, while handling a request for a
+    tenant, takes its connections from that tenant's pool rather than opening
+    them itself.  Everything else -- transactions, query compilation and the
+    other mixins -- keeps working on the wrapping database.
+    """
+    def __init__(self, database, tenant_factory=None, max_tenants=32, **kwargs):
+        self.tenant_factory = tenant_factory
+        self.max_tenants = max_tenants
+        self._tenants = OrderedDict()
+        self._tenants_lock = threading.Lock()
+        self._tenant_conns = {}
+        self._tenant_local = concurrency_for(self).local()
+        super(TenantDatabase, self).__init__(database, **kwargs)
+
+    def get_current_tenant(self):
+        tenant = getattr(self._tenant_local, 'tenant', None)
+        if tenant is not None:
+            return tenant
+        if has_request_context():
+            return g.get('tenant')
+
+    @contextmanager
+    def use_tenant(self, tenant):
+        """
+        Work with ``tenant``'s database outside of a request, e.g. in a
+        background job.  Connections opened in the block stay connected to
+        the tenant's database until they are closed.
+        """
+        previous = getattr(self._tenant_local, 'tenant', None)
+        self._tenant_local.tenant = tenant
+        try:
+            yield
+        finally:
+            self._tenant_local.tenant = previous
+
+    def get_tenant_database(self, tenant):
+        with self._tenants_lock:
+            database = self._tenants.pop(tenant, None)
+            if database is None:
+                database = self.tenant_factory(tenant)
+            self._tenants[tenant] = database
+
+            evicted = []
+            while len(self._tenants) > self.max_tenants:
+                evicted.append(self._tenants.popitem(last=False)[1])
+
+        # connections in use are closed as they are returned
+        for pool in evicted:
+            pool.close_all()
+        return database
+
+    def get_tenant_stats(self):
+        with self._tenants_lock:
+            tenants = list(self._tenants.items())
+        return dict((tenant, database.get_stats()) for tenant, database in tenants)
+
+    def connect(self):
+        tenant = self.get_current_tenant()
+        if tenant is None:
+            return super(TenantDatabase, self).connect()
+
+        # wait for the tenant's pool outside of peewee's connection lock
+        database = self.get_tenant_database(tenant)
+        self._tenant_local.checkout = (database, database.checkout())
+        try:
+            return super(TenantDatabase, self).connect()
+        finally:
+            checkout = self._tenant_local.checkout
+            if checkout is not None:
+                self._tenant_local.checkout = None
+                database._close(checkout[1])
+
+    def _connect(self, *args, **kwargs):
+        checkout = getattr(self._tenant_local, 'checkout', None)
+        if checkout is None:
+            return super(TenantDatabase, self)._connect(*args, **kwargs)
+
+        self._tenant_local.checkout = None
+        database, conn = checkout
+        with self._tenants_lock:
+            self._tenant_conns[id(conn)] = database
+        return conn
+
+    def _close(self, conn, close_conn=False):
+        with self._tenants_lock:
+            database = self._tenant_conns.pop(id(conn), None)
+            evicted = database is not None and \
+                not any(database is db for db in self._tenants.values())
+
+        if database is not None:
+            database._close(conn, close_conn=close_conn or evicted)
+        elif close_conn:
+            super(TenantDatabase, self)._close(conn, close_conn=True)
+        else:
+            super(TenantDatabase, self)._close(conn)
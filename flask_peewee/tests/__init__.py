@@ -1,5 +1,6 @@
 from flask_peewee.tests.admin import *
 from flask_peewee.tests.auth import *
+from flask_peewee.tests.db import *
 from flask_peewee.tests.rest import *
 from flask_peewee.tests.serializer import *
 from flask_peewee.tests.utils import *
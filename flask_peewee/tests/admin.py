@@ -28,6 +28,8 @@ from wtfpeewee.orm import model_form
 
 
 class BaseAdminTestCase(FlaskPeeweeTestCase):
+    isolation = 'rollback'
+
     def login(self, context=None):
         context = context or self.app
         context.post('/accounts/login/', data={
@@ -571,6 +573,48 @@ class AdminTestCase(BaseAdminTestCase):
             query = self.get_context('query')
             self.assertEqual(list(query.get_list()), notes[users[2]])
 
+    def test_model_admin_index_keyset_pagination(self):
+        users = self.create_users()
+        notes = {}
+
+        for user in users:
+            notes[user] = [Note.create(user=user, message='test-%d' % i) for i in range(20)]
+
+        note_admin = admin._registry[Note]
+        note_admin.keyset_pagination = True
+        try:
+            with self.flask_app.test_client() as c:
+                self.login(c)
+
+                resp = c.get('/admin/note/?ordering=-id')
+                self.assertEqual(resp.status_code, 200)
+
+                query = self.get_context('query')
+                self.assertTrue(query.keyset)
+                self.assertEqual(query.get_list(), notes[users[2]][::-1])
+                self.assertIsNone(query.get_previous_cursor())
+                next_cursor = query.get_next_cursor()
+                self.assertTrue(('cursor=%s' % next_cursor) in resp.get_data(as_text=True))
+
+                resp = c.get('/admin/note/?ordering=-id&cursor=%s' % next_cursor)
+                query = self.get_context('query')
+                self.assertEqual(query.get_list(), notes[users[1]][::-1])
+
+                resp = c.get('/admin/note/?ordering=-id&cursor=%s' % query.get_previous_cursor())
+                query = self.get_context('query')
+                self.assertEqual(query.get_list(), notes[users[2]][::-1])
+
+                # pages are linked by number, without the cursor
+                html = resp.get_data(as_text=True)
+                self.assertTrue('href="./?ordering=-id&amp;page=3"' in html)
+                resp = c.get('/admin/note/?ordering=-id&page=3')
+                query = self.get_context('query')
+                self.assertEqual(query.get_page(), 3)
+                self.assertEqual(query.get_list(), notes[users[0]][::-1])
+                self.assertIsNone(query.get_next_cursor())
+        finally:
+            note_admin.keyset_pagination = False
+
     def test_panel_simple(self):
         users = self.create_users()
 
@@ -590,18 +634,7 @@ class AdminTestCase(BaseAdminTestCase):
 
 
 class AdminFilterTestCase(BaseAdminTestCase):
-    def setUp(self):
-        super(AdminFilterTestCase, self).setUp()
-        BDetails.drop_table(True)
-        DModel.drop_table(True)
-        CModel.drop_table(True)
-        BModel.drop_table(True)
-        AModel.drop_table(True)
-        AModel.create_table()
-        BModel.create_table()
-        CModel.create_table()
-        DModel.create_table()
-        BDetails.create_table()
+    models = BaseAdminTestCase.models + [AModel, BModel, CModel, DModel, BDetails]
 
     def create_models(self):
         for i in range(1, 4):
@@ -712,6 +745,7 @@ class TemplateHelperTestCase(FlaskPeeweeTestCase):
         self.assertEqual(self.th.update_querystring(qs('page=1&session=3'), 'page', 2), 'session=3&page=2')
         self.assertEqual(self.th.update_querystring(qs('session=3&page=1&ordering=id'), 'page', 2), 'session=3&ordering=id&page=2')
         self.assertEqual(self.th.update_querystring(qs('session=3&ordering=id'), 'page', 2), 'session=3&ordering=id&page=2')
+        self.assertEqual(self.th.update_querystring(qs('cursor=abc&ordering=id'), 'page', 2, 'cursor'), 'ordering=id&page=2')
 
     def test_get_verbose_name(self):
         self.assertEqual(self.th.get_verbose_name(User, 'username'), 'Username')
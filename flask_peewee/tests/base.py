@@ -13,25 +13,42 @@ from flask_peewee.tests.test_app import Note
 from flask_peewee.tests.test_app import User
 
 
+# models whose tables were created by a test case using rollback isolation
+_created_models = set()
+
+
 class FlaskPeeweeTestCase(unittest.TestCase):
+    # "recreate" drops and creates the tables of ``models`` every test, while
+    # "rollback" creates them once and rolls back the changes made by each
+    # test -- keeping connections open across requests, and not resetting
+    # sequences on Postgres
+    isolation = 'recreate'
+    models = [User, Message, Note, EModel, FModel]
+
     def setUp(self):
-        Note.drop_table(True)
-        Message.drop_table(True)
-        User.drop_table(True)
-        User.create_table()
-        Message.create_table()
-        Note.create_table()
-
-        FModel.drop_table(True)
-        EModel.drop_table(True)
-        EModel.create_table()
-        FModel.create_table()
-        
+        if self.isolation == 'rollback':
+            self.create_tables([m for m in self.models if m not in _created_models])
+            _created_models.update(self.models)
+            test_app.db.begin_isolation()
+        else:
+            self.create_tables(self.models)
+            _created_models.difference_update(self.models)
+
         self.flask_app = test_app.app
         self.flask_app._template_context = {}
-        
-        self.app = test_app.app.test_client() 
-    
+
+        self.app = test_app.app.test_client()
+
+    def tearDown(self):
+        if test_app.db.isolation is not None:
+            test_app.db.end_isolation()
+
+    def create_tables(self, models):
+        for model in reversed(models):
+            model.drop_table(True)
+        for model in models:
+            model.create_table()
+
     def create_user(self, username, password, **kwargs):
         user = User(username=username, email=kwargs.pop('email', ''), **kwargs)
         user.set_password(password)
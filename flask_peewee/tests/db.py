@@ -0,0 +1,2413 @@
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import datetime
+import gc
+import logging
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+from flask import Flask
+from flask import abort
+from peewee import *
+
+from flask_peewee._compat import PY2
+from flask_peewee.admin import Admin
+from flask_peewee.admin import ModelAdmin
+from flask_peewee.auth import Auth
+from flask_peewee.concurrency import get_connection_local
+from flask_peewee.counting import CachedCount
+from flask_peewee.counting import CappedCount
+from flask_peewee.counting import EstimatedCount
+from flask_peewee.counting import WindowCount
+from flask_peewee.db import Database
+from flask_peewee.exceptions import ImproperlyConfigured
+from flask_peewee.instrumentation import NPlusOneError
+from flask_peewee.instrumentation import NPlusOneWarning
+from flask_peewee.instrumentation import get_fingerprint
+from flask_peewee.invalidation import InvalidationBus
+from flask_peewee.invalidation import SqliteTransport
+from flask_peewee.invalidation import UnixSocketTransport
+from flask_peewee.pool import MaxConnectionsExceeded
+from flask_peewee.queryplans import QueryPlanGuard
+from flask_peewee.rest import RestAPI
+from flask_peewee.rest import RestResource
+from flask_peewee.shards import CrossShardQuery
+from flask_peewee.utils import PaginatedQuery
+from flask_peewee.utils import get_read_query
+from flask_peewee.writebehind import WriteBehindError
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def get_database(self, **config):
+        app = Flask(__name__)
+        app.config['DATABASE'] = dict({
+            'name': os.path.join(self.temp_dir, 'db.db'),
+            'engine': 'peewee.SqliteDatabase',
+        }, **config)
+        return app, Database(app)
+
+
+class PooledDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(PooledDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            pool=True,
+            max_connections=2,
+            checkout_timeout=0.1,
+        )
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+        self.db.database.close()
+
+        @self.app.route('/')
+        def index():
+            return str(self.Item.select().count())
+
+    def tearDown(self):
+        self.db.database.close_all()
+        super(PooledDatabaseTestCase, self).tearDown()
+
+    def test_no_pool(self):
+        app, db = self.get_database()
+        self.assertEqual(db.get_pool_stats(), None)
+
+    def test_explicit_database(self):
+        app = Flask(__name__)
+        db = Database(app, database=SqliteDatabase(os.path.join(self.temp_dir, 'explicit.db')))
+
+        class Item(db.Model):
+            name = CharField()
+
+        Item.create_table()
+        Item.create(name='item')
+        self.assertEqual([item.name for item in Item.select()], ['item'])
+        self.assertEqual(db.get_pool_stats(), None)
+        self.assertEqual(db.get_result_cache_stats(), None)
+
+    def test_connections_recycled(self):
+        client = self.app.test_client()
+        for i in range(3):
+            resp = client.get('/')
+            self.assertEqual(resp.data, b'0')
+
+        stats = self.db.get_pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['created'], 1)
+
+    def test_checkout_timeout(self):
+        checked_out = threading.Event()
+        release = threading.Event()
+
+        def hold_connection():
+            self.db.database.connect()
+            checked_out.set()
+            release.wait()
+            self.db.database.close()
+
+        threads = [threading.Thread(target=hold_connection) for i in range(2)]
+        for t in threads:
+            t.start()
+
+        while self.db.get_pool_stats()['in_use'] < 2:
+            checked_out.wait(0.01)
+
+        self.assertRaises(MaxConnectionsExceeded, self.db.database.connect)
+        stats = self.db.get_pool_stats()
+        self.assertEqual(stats['in_use'], 2)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.db.get_pool_stats()['idle'], 2)
+
+    def test_unbounded(self):
+        app, db = self.get_database(pool=True, max_connections=None)
+        database = db.database
+        connections = [database.checkout() for i in range(3)]
+        for conn in connections:
+            database._close(conn)
+
+        database.connect()
+        database.close()
+        stats = db.get_pool_stats()
+        self.assertEqual(stats['max_connections'], None)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 3)
+        self.assertEqual(stats['created'], 3)
+        database.close_all()
+
+
+class LazyDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(LazyDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(lazy=True, pool=True)
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        Item.create_table()
+        self.db.database.close()
+
+        @self.app.route('/health/')
+        def health():
+            return str(self.db.database.is_closed())
+
+        @self.app.route('/query/')
+        def query():
+            return '%s %s' % (Item.select().count(), self.db.database.is_closed())
+
+    def test_lazy_connect(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/health/').data, b'True')
+        self.assertEqual(self.db.get_pool_stats()['created'], 1)
+
+        self.assertEqual(client.get('/query/').data, b'0 False')
+        self.assertTrue(self.db.database.is_closed())
+
+        stats = self.db.get_pool_stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['created'], 1)
+
+        client.get('/health/')
+        self.assertEqual(self.db.get_pool_stats()['idle'], 1)
+
+
+class ReplicatedDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ReplicatedDatabaseTestCase, self).setUp()
+        primary = os.path.join(self.temp_dir, 'db.db')
+        self.replica = os.path.join(self.temp_dir, 'replica.db')
+
+        # seed the primary, then take a copy to act as a (lagging) replica
+        app, db = self.get_database()
+
+        class Item(db.Model):
+            name = CharField()
+
+        Item.create_table()
+        Item.create(name='i1')
+        db.database.close()
+        shutil.copy(primary, self.replica)
+
+        self.app, self.db = self.get_database(
+            replicas=[{'name': self.replica}],
+            sticky_window=0.2,
+        )
+        self.app.secret_key = 'secret'
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create(name='i2')
+
+        api = RestAPI(self.app)
+        api.register(Item)
+        api.setup()
+
+        @self.app.route('/write/')
+        def write():
+            Item.create(name='i3')
+            return str(PaginatedQuery(Item, 10).get_list().count())
+
+    def object_count(self, client, url='/api/item/'):
+        return len(json.loads(client.get(url).data.decode('utf8'))['objects'])
+
+    def test_reads_from_replica(self):
+        client = self.app.test_client()
+        self.assertEqual(self.object_count(client), 1)
+        self.assertEqual(client.get('/api/item/2/').status_code, 404)
+
+        query = self.Item.select()
+        self.assertEqual(query.count(), 2)
+
+    def test_read_your_writes(self):
+        client = self.app.test_client()
+
+        # reads issued after a write in the same request go to the primary
+        self.assertEqual(client.get('/write/').data, b'3')
+
+        # subsequent requests stick to the primary until the window elapses
+        self.assertEqual(self.object_count(client), 3)
+        self.assertEqual(client.get('/api/item/3/').status_code, 200)
+
+        time.sleep(0.25)
+        self.assertEqual(self.object_count(client), 1)
+
+        # a client without the session cookie is not affected
+        self.app.test_client().get('/write/')
+        self.assertEqual(self.object_count(self.app.test_client()), 1)
+
+    def test_transaction_per_request(self):
+        app, db = self.get_database(
+            replicas=[{'name': self.replica}],
+            transaction_per_request=True)
+
+        class Item(db.Model):
+            name = CharField()
+
+        @app.route('/')
+        def index():
+            counts = [get_read_query(Item.select()).count()]
+            Item.create(name='i3')
+            counts.append(get_read_query(Item.select()).count())
+            return ','.join(map(str, counts))
+
+        # reads only move to the primary once the request has written
+        self.assertEqual(app.test_client().get('/').data, b'1,3')
+
+    def test_round_robin(self):
+        app, db = self.get_database(replicas=[
+            {'name': self.replica},
+            {'name': self.replica},
+        ])
+        first, second = db.replicas
+        with app.test_request_context('/'):
+            self.assertEqual(
+                [db.database.get_read_database() for i in range(3)],
+                [first, second, first])
+
+
+class InstrumentedDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(InstrumentedDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            instrument=True,
+            instrument_headers=True,
+            instrument_slowest=2,
+        )
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        Item.create_table()
+        for i in range(3):
+            Item.create(name='i%d' % i)
+
+        self.stats = []
+
+        @self.app.route('/')
+        def index():
+            names = [item.name for item in Item.select()]
+            Item.select().count()
+            Item.select().where(Item.name == 'i1').get()
+            self.stats.append(self.db.get_query_stats())
+            return ','.join(names)
+
+    def test_query_stats(self):
+        resp = self.app.test_client().get('/')
+        self.assertEqual(resp.data, b'i0,i1,i2')
+
+        stats, = self.stats
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.rows, 5)
+        self.assertTrue(stats.duration > 0)
+
+        slowest = stats.get_slowest()
+        self.assertEqual(len(slowest), 2)
+        self.assertTrue(slowest[0][0] >= slowest[1][0])
+
+        self.assertEqual(resp.headers['X-Query-Count'], '3')
+        self.assertTrue(resp.headers['Server-Timing'].startswith('db;dur='))
+
+    def test_outside_request(self):
+        self.assertEqual(self.db.database.execute_sql('select 1').fetchone(), (1,))
+
+
+class NPlusOneDatabaseTestCase(DatabaseTestCase):
+    def create_app(self, mode):
+        app, db = self.get_database(n_plus_one=mode, n_plus_one_threshold=3)
+        app.testing = True
+
+        class Author(db.Model):
+            name = CharField()
+
+        class Book(db.Model):
+            author = ForeignKeyField(Author)
+            title = CharField()
+
+        Author.create_table()
+        Book.create_table()
+        for i in range(5):
+            Book.create(author=Author.create(name='a%d' % i), title='b%d' % i)
+
+        @app.route('/')
+        def index():
+            return ','.join([book.author.name for book in Book.select()])
+
+        @app.route('/joined/')
+        def joined():
+            query = Book.select(Book, Author).join(Author)
+            return ','.join([book.author.name for book in query])
+
+        return app
+
+    def test_raise(self):
+        client = self.create_app('raise').test_client()
+        with self.assertRaises(NPlusOneError) as ctx:
+            client.get('/')
+        self.assertTrue('tests/db.py' in str(ctx.exception))
+        self.assertTrue('in <listcomp>' in str(ctx.exception) or
+                        'in index' in str(ctx.exception))
+
+        resp = client.get('/joined/')
+        self.assertEqual(resp.data, b'a0,a1,a2,a3,a4')
+
+    def test_warn(self):
+        client = self.create_app('warn').test_client()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            resp = client.get('/')
+            client.get('/')
+
+        self.assertEqual(resp.data, b'a0,a1,a2,a3,a4')
+        self.assertEqual(len(caught), 2)
+        self.assertTrue(issubclass(caught[0].category, NPlusOneWarning))
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            get_fingerprint('SELECT "t1"."id"\n FROM "a" WHERE ("t1"."id" IN (?, ?, ?))'),
+            get_fingerprint('SELECT "t1"."id" FROM "a" WHERE ("t1"."id" IN (?, ?))'))
+
+
+class SQLCacheDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(SQLCacheDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(sql_cache=True, sql_cache_size=4)
+
+        class Author(self.db.Model):
+            name = CharField()
+            active = BooleanField(default=True)
+
+        class Book(self.db.Model):
+            author = ForeignKeyField(Author)
+            title = CharField()
+
+        self.Author, self.Book = Author, Book
+        Author.create_table()
+        Book.create_table()
+
+    def assertCompiles(self, query):
+        # the cached sql and params must match what peewee generates
+        base_compiler = super(type(self.db.database), self.db.database).compiler()
+        base_compiler.sql_cache = None
+        expected = base_compiler.generate_select(query)
+        self.assertEqual(query.sql(), expected)
+        return expected
+
+    def test_cached_sql(self):
+        Author, Book = self.Author, self.Book
+        author = Author.create(name='a1')
+
+        def build(title, author_ids):
+            return (Book
+                    .select()
+                    .join(Author)
+                    .where(
+                        (Author.active == True) &
+                        (Book.title ** title) &
+                        (Book.author << author_ids))
+                    .order_by(Book.title.desc())
+                    .paginate(2, 10))
+
+        self.assertCompiles(build('%a%', [1, 2]))
+        self.assertEqual(self.db.get_sql_cache_stats()['misses'], 1)
+
+        sql, params = self.assertCompiles(build('%b%', [3, 4]))
+        self.assertEqual(params, [True, '%b%', 3, 4])
+        self.assertEqual(self.db.get_sql_cache_stats()['hits'], 1)
+
+        # model instances are converted to their primary key
+        self.assertCompiles(Book.select().where(Book.author == author))
+        sql, params = self.assertCompiles(Book.select().where(Book.author == author))
+        self.assertEqual(params, [author.id])
+
+        # a different IN list length is a different shape
+        self.assertCompiles(build('%b%', [3, 4, 5]))
+        stats = self.db.get_sql_cache_stats()
+        self.assertEqual(stats['misses'], 3)
+        self.assertEqual(stats['size'], 3)
+
+        self.assertEqual(list(build('%b%', [1])), [])
+
+    def test_uncacheable(self):
+        Author, Book = self.Author, self.Book
+        subquery = Author.select(Author.id).where(Author.name == 'a1')
+        query = Book.select().where(Book.author << subquery)
+        self.assertCompiles(query)
+        self.assertCompiles(query)
+        self.assertEqual(self.db.get_sql_cache_stats()['size'], 0)
+
+    def test_lru(self):
+        for i in range(6):
+            self.Author.select().paginate(i + 1, 10).sql()
+        self.Author.select().paginate(6, 10).sql()
+        stats = self.db.get_sql_cache_stats()
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual(stats['hits'], 1)
+
+
+class PragmaDatabaseTestCase(DatabaseTestCase):
+    def get_pragma(self, database, pragma):
+        return database.execute_sql('PRAGMA %s' % pragma).fetchone()[0]
+
+    def test_performance_preset(self):
+        app, db = self.get_database(pragmas='performance')
+        db.database.connect()
+        self.assertEqual(self.get_pragma(db.database, 'journal_mode'), 'wal')
+        self.assertEqual(self.get_pragma(db.database, 'synchronous'), 1)
+        self.assertEqual(self.get_pragma(db.database, 'temp_store'), 2)
+        self.assertEqual(self.get_pragma(db.database, 'cache_size'), -1024 * 64)
+        self.assertEqual(self.get_pragma(db.database, 'busy_timeout'), 5000)
+        db.database.close()
+
+    def test_pragmas(self):
+        app, db = self.get_database(pragmas={'cache_size': 1000})
+        db.database.connect()
+        self.assertEqual(self.get_pragma(db.database, 'cache_size'), 1000)
+        db.database.close()
+
+        app, db = self.get_database(pragmas=[('cache_size', 1000), ('cache_size', 2000)])
+        db.database.connect()
+        self.assertEqual(self.get_pragma(db.database, 'cache_size'), 2000)
+        db.database.close()
+
+    def test_pooled_connections(self):
+        app, db = self.get_database(pool=True, pragmas={'cache_size': 1000})
+
+        @app.route('/')
+        def index():
+            return str(self.get_pragma(db.database, 'cache_size'))
+
+        client = app.test_client()
+        for i in range(3):
+            self.assertEqual(client.get('/').data, b'1000')
+        self.assertEqual(db.get_pool_stats()['created'], 1)
+
+        # every new connection is configured, not just the first
+        db.database.close_all()
+        self.assertEqual(client.get('/').data, b'1000')
+        self.assertEqual(db.get_pool_stats()['created'], 2)
+
+    def test_replicas(self):
+        replica = os.path.join(self.temp_dir, 'replica.db')
+        app, db = self.get_database(
+            pragmas={'cache_size': 1000},
+            replicas=[{'name': replica}])
+        replica_db, = db.replicas
+        replica_db.connect()
+        self.assertEqual(self.get_pragma(replica_db, 'cache_size'), 1000)
+        replica_db.close()
+
+    def test_invalid(self):
+        self.assertRaises(ImproperlyConfigured, self.get_database, pragmas='unknown')
+        self.assertRaises(
+            ImproperlyConfigured,
+            self.get_database,
+            engine='peewee.PostgresqlDatabase',
+            pragmas='performance')
+
+
+class ForkSafeDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ForkSafeDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            fork_safe=True,
+            pool=True,
+            warm_connections=2,
+        )
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+
+        @self.app.route('/')
+        def index():
+            return str(self.Item.select().count())
+
+    def tearDown(self):
+        self.db.database.close_all()
+        super(ForkSafeDatabaseTestCase, self).tearDown()
+
+    def simulate_fork(self):
+        self.db.database._pid = -1
+
+    def test_inherited_connections(self):
+        database = self.db.database
+        inherited = database.get_conn()
+        self.db.post_fork()
+        self.assertEqual(database.get_stats()['in_use'], 1)
+        self.assertEqual(database.get_stats()['idle'], 1)
+
+        self.simulate_fork()
+        self.assertTrue(database.is_closed())
+        self.assertEqual(database.get_stats(), {
+            'max_connections': 20,
+            'in_use': 0,
+            'idle': 0,
+            'waiting': 0,
+            'created': 0,
+            'waits': 0,
+            'timeouts': 0,
+        })
+
+        # the parent's connections are neither reused nor closed
+        self.assertFalse(database.get_conn() is inherited)
+        self.assertEqual(len(database._inherited), 2)
+        for conn in database._inherited:
+            conn.execute('select 1')
+
+        database.close()
+
+    def test_post_fork(self):
+        self.Item.create(name='i1')
+        self.db.database.close()
+
+        self.simulate_fork()
+        self.db.post_fork()
+        self.assertEqual(self.db.get_pool_stats()['idle'], 2)
+        self.assertEqual(self.db.get_pool_stats()['created'], 2)
+
+        client = self.app.test_client()
+        self.assertEqual(client.get('/').data, b'1')
+        self.assertEqual(self.db.get_pool_stats()['created'], 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_fork(self):
+        self.Item.create(name='i1')
+        self.assertFalse(self.db.database.is_closed())
+
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.Item.create(name='i2')
+                os.write(w, str(self.Item.select().count()).encode('ascii'))
+            finally:
+                os._exit(0)
+
+        os.close(w)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(r, 10), b'2')
+        os.close(r)
+
+        # the parent's connection is still usable
+        self.assertEqual(self.Item.select().count(), 2)
+        self.db.database.close()
+
+
+class TransactionPerRequestTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(TransactionPerRequestTestCase, self).setUp()
+        self.app, self.db = self.get_database(transaction_per_request=True)
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+        self.db.database.close()
+
+        self.commits = 0
+        commit = self.db.database.commit
+        def counting_commit():
+            self.commits += 1
+            commit()
+        self.db.database.commit = counting_commit
+
+        @self.app.route('/create/<int:n>/')
+        def create(n):
+            for i in range(n):
+                Item.create(name='i%d' % i)
+            return str(Item.select().count())
+
+        @self.app.route('/fail/')
+        def fail():
+            Item.create(name='failed')
+            raise ValueError('oops')
+
+        @self.app.route('/not-found/')
+        def not_found():
+            Item.create(name='failed')
+            abort(404)
+
+        @self.app.route('/autocommit/')
+        @self.db.no_transaction
+        def autocommit():
+            Item.create(name='a1')
+            Item.create(name='a2')
+            return str(self.db.database.transaction_depth())
+
+    def get_names(self):
+        return sorted(item.name for item in self.Item.select())
+
+    def test_single_commit(self):
+        client = self.app.test_client()
+        resp = client.get('/create/3/')
+        self.assertEqual(resp.data, b'3')
+        self.assertEqual(self.commits, 1)
+        self.assertEqual(self.get_names(), ['i0', 'i1', 'i2'])
+        self.assertTrue(self.db.database.get_autocommit())
+
+    def test_rollback(self):
+        self.app.logger.disabled = True
+        client = self.app.test_client()
+        self.assertEqual(client.get('/fail/').status_code, 500)
+        self.assertEqual(client.get('/not-found/').status_code, 404)
+        self.assertEqual(self.commits, 0)
+        self.assertEqual(self.get_names(), [])
+        self.assertEqual(self.db.database.transaction_depth(), 0)
+
+        # exceptions propagated by the test client are rolled back at teardown
+        self.app.testing = True
+        self.assertRaises(ValueError, client.get, '/fail/')
+        self.assertEqual(self.get_names(), [])
+        self.assertEqual(self.db.database.transaction_depth(), 0)
+
+    def test_no_transaction(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/autocommit/').data, b'0')
+        self.assertEqual(self.commits, 2)
+        self.assertEqual(self.get_names(), ['a1', 'a2'])
+
+    def test_isolation(self):
+        self.app.logger.disabled = True
+        client = self.app.test_client()
+        self.db.begin_isolation()
+        self.Item.create(name='setup')
+        conn = self.db.database.get_conn()
+
+        self.assertEqual(client.get('/create/2/').data, b'3')
+        self.assertEqual(client.get('/autocommit/').data, b'1')
+        # failed requests only roll back their own changes
+        self.assertEqual(client.get('/fail/').status_code, 500)
+        self.assertEqual(self.get_names(), ['a1', 'a2', 'i0', 'i1', 'setup'])
+        self.assertTrue(self.db.database.get_conn() is conn)
+
+        self.db.end_isolation()
+        self.assertEqual(self.commits, 0)
+        self.assertEqual(self.get_names(), [])
+        self.assertEqual(self.db.database.transaction_depth(), 0)
+        self.assertTrue(self.db.database.get_autocommit())
+
+        # changes made afterwards are committed as usual
+        self.Item.create(name='i0')
+        self.db.database.close()
+        self.assertEqual(self.get_names(), ['i0'])
+
+    @unittest.skipIf(PY2, 'requires Python 3')
+    def test_shared_cache(self):
+        app, db = self.get_database(name=':memory:', shared_cache=True)
+
+        class Item(db.Model):
+            name = CharField()
+
+        Item.create_table()
+        Item.create(name='i1')
+        db.database.close()
+
+        # every connection of the process uses the same in-memory database
+        counts = []
+        t = threading.Thread(target=lambda: counts.append(Item.select().count()))
+        t.start()
+        t.join()
+        self.assertEqual(counts, [1])
+        self.assertFalse(os.path.exists(':memory:'))
+
+        self.assertRaises(
+            ImproperlyConfigured,
+            self.get_database,
+            engine='peewee.PostgresqlDatabase',
+            shared_cache=True)
+
+
+class WriteContentionTestCase(DatabaseTestCase):
+    def get_database(self, **config):
+        # fail immediately rather than using sqlite's own busy handler
+        app, db = super(WriteContentionTestCase, self).get_database(
+            timeout=0,
+            threadlocals=True,
+            **config)
+
+        class Item(db.Model):
+            name = CharField()
+
+        Item.create_table(True)
+        db.database.close()
+        return db, Item
+
+    def lock_database(self, duration):
+        locked = threading.Event()
+
+        def hold_lock():
+            conn = sqlite3.connect(os.path.join(self.temp_dir, 'db.db'))
+            conn.execute('BEGIN EXCLUSIVE')
+            locked.set()
+            time.sleep(duration)
+            conn.rollback()
+            conn.close()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        return thread
+
+    def test_busy_retry(self):
+        db, Item = self.get_database(
+            busy_retries=20,
+            busy_backoff=0.01,
+            busy_max_backoff=0.05)
+
+        thread = self.lock_database(0.1)
+        Item.create(name='i1')
+        thread.join()
+        self.assertEqual(Item.select().count(), 1)
+
+    def test_busy_retries_exhausted(self):
+        db, Item = self.get_database(busy_retries=1, busy_backoff=0.01)
+        db2, Item2 = self.get_database(busy_retries=100, busy_backoff=0.01)
+
+        thread = self.lock_database(0.2)
+        self.assertRaises(OperationalError, Item.create, name='i1')
+
+        # statements within a transaction are not retried
+        with db2.database.transaction():
+            start = time.time()
+            self.assertRaises(OperationalError, Item2.create, name='i1')
+            self.assertTrue(time.time() - start < 0.1)
+
+        thread.join()
+
+    def test_single_writer(self):
+        db, Item = self.get_database(single_writer=True)
+        errors = []
+
+        def write(n):
+            try:
+                for i in range(10):
+                    with db.database.transaction():
+                        Item.create(name='%s-%s' % (n, i))
+                        time.sleep(0.001)
+                    Item.create(name='%s-%s-autocommit' % (n, i))
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                db.database.close()
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Item.select().count(), 80)
+        self.assertFalse(db.database._write_lock.locked())
+
+    def test_single_writer_released(self):
+        db, Item = self.get_database(single_writer=True)
+        lock = db.database._write_lock
+
+        Item.create(name='i1')
+        self.assertFalse(lock.locked())
+
+        with db.database.transaction() as txn:
+            Item.select().count()
+            self.assertFalse(lock.locked())
+            Item.create(name='i2')
+            self.assertTrue(lock.locked())
+        self.assertFalse(lock.locked())
+
+        try:
+            with db.database.transaction():
+                Item.create(name='i3')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(lock.locked())
+        self.assertEqual(Item.select().count(), 2)
+
+
+class ShardedDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ShardedDatabaseTestCase, self).setUp()
+        self.shard_names = [
+            os.path.join(self.temp_dir, 'shard-%s.db' % i) for i in range(2)]
+        self.app, self.db = self.get_database(
+            shards=[{'name': name} for name in self.shard_names])
+
+        class User(self.db.Model):
+            username = CharField()
+
+        class Message(self.db.Model):
+            user = ForeignKeyField(User)
+            content = CharField()
+            priority = IntegerField(null=True)
+
+            class Meta:
+                shard_key = 'user'
+
+        self.User, self.Message = User, Message
+        User.create_table()
+        Message.create_table()
+
+        self.users = [User.create(username='u%s' % i) for i in range(1, 5)]
+        self.messages = []
+        for i in range(12):
+            user = self.users[i % 4]
+            self.messages.append(Message.create(
+                user=user,
+                content='%s-%02d' % (user.username, i),
+                priority=i % 3 or None))
+
+    def shard_contents(self, idx):
+        conn = sqlite3.connect(self.shard_names[idx])
+        try:
+            return sorted(row[0] for row in conn.execute('select content from message'))
+        finally:
+            conn.close()
+
+    def test_create_tables(self):
+        self.assertFalse('message' in self.db.database.get_tables())
+        self.assertTrue('user' in self.db.database.get_tables())
+        for shard in self.db.shards:
+            self.assertEqual(shard.get_tables(), ['message', 'shard_ids'])
+        self.assertTrue(self.Message.table_exists())
+
+    def test_insert_routing(self):
+        # users with an even id live on the first shard, odd on the second
+        self.assertEqual(self.shard_contents(0), [
+            'u2-01', 'u2-05', 'u2-09', 'u4-03', 'u4-07', 'u4-11'])
+        self.assertEqual(self.shard_contents(1), [
+            'u1-00', 'u1-04', 'u1-08', 'u3-02', 'u3-06', 'u3-10'])
+
+        # ids are unique across shards and tell which shard a row is on
+        ids = [message.id for message in self.messages]
+        self.assertEqual(len(set(ids)), 12)
+        for message in self.messages:
+            self.assertEqual((message.id - 1) % 2, message.user.id % 2)
+
+        self.assertRaises(ValueError, self.Message.create, content='none')
+
+    def test_pk_allocation(self):
+        def next_ids():
+            return [shard.execute_sql('select next_id from shard_ids').fetchall()
+                    for shard in self.db.shards]
+
+        # the next id of each shard is kept in its allocation row
+        self.assertEqual(next_ids(), [[(13,)], [(14,)]])
+        message = self.Message.create(user=self.users[1], content='new')
+        self.assertEqual(message.id, 13)
+        self.assertEqual(next_ids(), [[(15,)], [(14,)]])
+
+        # ids carry on from rows inserted before the allocation row existed
+        self.db.shards[1].execute_sql('delete from shard_ids')
+        self.db.shards[1].execute_sql(
+            "insert into message (id, user_id, content) values (20, 1, 'raw')")
+        message = self.Message.create(user=self.users[0], content='new')
+        self.assertEqual(message.id, 22)
+        self.assertEqual(next_ids(), [[(15,)], [(24,)]])
+
+        # keeping to the ids of the shard, whatever ids those rows were given
+        self.db.shards[0].execute_sql('delete from shard_ids')
+        self.db.shards[0].execute_sql(
+            "insert into message (id, user_id, content) values (30, 2, 'raw')")
+        message = self.Message.create(user=self.users[1], content='new')
+        self.assertEqual(message.id, 31)
+        self.assertEqual(self.Message.get(self.Message.id == 31).content, 'new')
+
+        # and start over once the table is dropped
+        self.Message.drop_table()
+        self.assertEqual(next_ids(), [[], []])
+        self.Message.create_table()
+        self.assertEqual(self.Message.create(user=self.users[0], content='a').id, 2)
+
+    def test_single_shard(self):
+        u1, u2 = self.users[:2]
+        query = self.Message.select().where(self.Message.user == u1)
+        self.assertEqual(query.get_shards(), [self.db.shards[1]])
+        self.assertEqual(
+            [m.content for m in query.order_by(self.Message.content)],
+            ['u1-00', 'u1-04', 'u1-08'])
+        self.assertEqual(query.count(), 3)
+
+        # values from a query string route the same way
+        query = self.Message.select().where(self.Message.user == str(u1.id))
+        self.assertEqual(query.get_shards(), [self.db.shards[1]])
+
+        query = self.Message.select().where(
+            (self.Message.user << [u1, u2]) & (self.Message.priority == 1))
+        self.assertEqual(len(query.get_shards()), 2)
+        self.assertEqual(sorted(m.content for m in query), ['u1-04', 'u2-01'])
+
+        message = self.messages[5]
+        query = self.Message.select().where(self.Message.id == message.id)
+        self.assertEqual(len(query.get_shards()), 1)
+        self.assertEqual(query.get().content, message.content)
+
+        # instances are updated and deleted on their own shard
+        message.content = 'edited'
+        self.assertEqual(message.save(), 1)
+        self.assertEqual(self.Message.get(self.Message.id == message.id).content, 'edited')
+        self.assertEqual(message.delete_instance(), 1)
+        self.assertEqual(self.Message.select().count(), 11)
+
+    def test_shard_key_updates(self):
+        Message = self.Message
+        u1, u2, u3 = self.users[:3]
+
+        # rows may move between keys of the same shard, but not to another
+        message = self.messages[0]
+        message.user = u3
+        self.assertEqual(message.save(), 1)
+        message.user = u2
+        self.assertRaises(CrossShardQuery, message.save)
+        self.assertEqual(Message.get(Message.id == message.id).user, u3)
+
+        query = Message.update(user=u1).where(Message.user == u3)
+        self.assertEqual(query.execute(), 4)
+        self.assertRaises(CrossShardQuery, Message.update(user=u1).execute)
+        self.assertRaises(
+            CrossShardQuery,
+            Message.update(user=Message.priority).where(Message.user == u1).execute)
+        self.assertEqual(Message.select().where(Message.user == u1).count(), 6)
+
+        query = Message.insert_many([{'user': u1, 'content': 'x'}], validate_fields=False)
+        self.assertFalse(query._validate_fields)
+
+    def test_fan_out(self):
+        Message = self.Message
+        expected = sorted(m.content for m in self.messages)
+        query = Message.select().order_by(Message.content)
+        self.assertEqual([m.content for m in query], expected)
+        self.assertEqual(
+            [m.content for m in query.paginate(2, 5)],
+            expected[5:10])
+        self.assertEqual(query.count(), 12)
+        self.assertEqual(query.paginate(3, 5).count(), 2)
+        self.assertEqual(len(query.paginate(3, 5)), 2)
+        self.assertTrue(query.exists())
+        self.assertEqual(query.get().content, 'u1-00')
+
+        # nulls sort first, descending orderings and ties are respected
+        query = Message.select().order_by(Message.priority.desc(), Message.content)
+        self.assertEqual([(m.priority, m.content) for m in query][:5], [
+            (2, 'u1-08'), (2, 'u2-05'), (2, 'u3-02'), (2, 'u4-11'), (1, 'u1-04')])
+        query = Message.select().order_by(Message.priority, Message.content.desc())
+        self.assertEqual([(m.priority, m.content) for m in query][:2], [
+            (None, 'u4-03'), (None, 'u3-06')])
+
+        self.assertEqual(
+            set(Message.select(Message.priority).distinct().tuples()),
+            set([(1,), (2,), (None,)]))
+        self.assertRaises(
+            CrossShardQuery,
+            Message.select(fn.Max(Message.id)).scalar)
+
+        self.assertEqual(
+            Message.update(content='x').where(Message.priority == 2).execute(), 4)
+        self.assertEqual(Message.delete().where(Message.content == 'x').execute(), 4)
+        self.assertEqual(Message.select().count(), 8)
+
+    def test_rest_api(self):
+        api = RestAPI(self.app)
+        api.register(self.Message)
+        api.setup()
+
+        client = self.app.test_client()
+        resp = client.get('/api/message/?ordering=-content&limit=5&page=2')
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(
+            [obj['content'] for obj in data['objects']],
+            sorted((m.content for m in self.messages), reverse=True)[5:10])
+
+        resp = client.get('/api/message/?user=3')
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(
+            sorted(obj['content'] for obj in data['objects']),
+            ['u3-02', 'u3-06', 'u3-10'])
+
+        message = self.messages[7]
+        resp = client.get('/api/message/%s/' % message.id)
+        self.assertEqual(
+            json.loads(resp.data.decode('utf8'))['content'], message.content)
+
+
+class TenantDatabaseTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(TenantDatabaseTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            tenant_resolver='flask_peewee.tenants.HeaderResolver',
+            tenant_name=os.path.join(self.temp_dir, 'tenant-%s.db'),
+            tenants={'shared': {'name': os.path.join(self.temp_dir, 'db.db')}},
+            max_tenants=2,
+            max_connections=2,
+        )
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+        Item.create(name='primary')
+        self.db.database.close()
+
+        for tenant in ('a', 'b', 'c'):
+            with self.db.database.use_tenant(tenant):
+                Item.create_table()
+                Item.create(name='item-%s' % tenant)
+                self.db.database.close()
+
+    def tenant_context(self, tenant):
+        test = self
+
+        class TenantContext(object):
+            def __enter__(self):
+                self.ctx = test.app.test_request_context(headers={'X-Tenant': tenant})
+                self.ctx.push()
+                test.app.preprocess_request()
+
+            def __exit__(self, *exc_info):
+                self.ctx.pop()
+
+        return TenantContext()
+
+    def test_resolvers(self):
+        from flask import session
+        from flask_peewee.tenants import SessionResolver
+        from flask_peewee.tenants import SubdomainResolver
+
+        resolve = SubdomainResolver()
+        with self.app.test_request_context(base_url='http://acme.example.com:5000/'):
+            self.assertEqual(resolve(), 'acme')
+        with self.app.test_request_context(base_url='http://example.com/'):
+            self.assertEqual(resolve(), None)
+
+        self.app.config['SERVER_NAME'] = 'app.example.com'
+        with self.app.test_request_context(base_url='http://acme.app.example.com/'):
+            self.assertEqual(resolve(), 'acme')
+        with self.app.test_request_context(base_url='http://app.example.com/'):
+            self.assertEqual(resolve(), None)
+
+        self.app.secret_key = 'secret'
+        with self.app.test_request_context():
+            self.assertEqual(SessionResolver()(), None)
+            session['tenant'] = 'acme'
+            self.assertEqual(SessionResolver()(), 'acme')
+
+    def test_tenant_routing(self):
+        api = RestAPI(self.app)
+        api.register(self.Item)
+        api.setup()
+
+        client = self.app.test_client()
+
+        def get_names(**headers):
+            resp = client.get('/api/item/', headers=headers)
+            data = json.loads(resp.data.decode('utf8'))
+            return [obj['name'] for obj in data['objects']]
+
+        self.assertEqual(get_names(), ['primary'])
+        self.assertEqual(get_names(**{'X-Tenant': 'b'}), ['item-b'])
+        self.assertEqual(get_names(**{'X-Tenant': 'c'}), ['item-c'])
+        self.assertEqual(get_names(**{'X-Tenant': 'shared'}), ['primary'])
+
+        # tenants not listed must be usable in a file name, and their database
+        # must exist already
+        for tenant in ('missing/../a', '..', 'd'):
+            resp = client.get('/api/item/', headers={'X-Tenant': tenant})
+            self.assertEqual(resp.status_code, 404)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, 'tenant-d.db')))
+
+        self.assertEqual(sorted(self.db.get_tenant_stats()), ['c', 'shared'])
+
+        # or pass the "tenant_exists" check
+        self.db.tenant_exists = lambda tenant: tenant != 'b'
+        self.assertEqual(client.get('/api/item/', headers={'X-Tenant': 'b'}).status_code, 404)
+        self.assertEqual(get_names(**{'X-Tenant': 'c'}), ['item-c'])
+        self.assertEqual(get_names(**{'X-Tenant': 'shared'}), ['primary'])
+
+        # which can only be left out when databases are files
+        self.assertRaises(
+            ImproperlyConfigured,
+            self.get_database,
+            engine='peewee.PostgresqlDatabase',
+            tenant_resolver='flask_peewee.tenants.HeaderResolver',
+            tenant_name='tenant_%s')
+
+    def test_tenant_pools(self):
+        client = self.app.test_client()
+
+        @self.app.route('/')
+        def index():
+            return str(self.Item.select().count())
+
+        for i in range(2):
+            for tenant in ('b', 'c'):
+                resp = client.get('/', headers={'X-Tenant': tenant})
+                self.assertEqual(resp.data, b'1')
+
+        # only the two most recently used tenants keep a pool
+        stats = self.db.get_tenant_stats()
+        self.assertEqual(sorted(stats), ['b', 'c'])
+        for tenant in ('b', 'c'):
+            self.assertEqual(stats[tenant]['created'], 1)
+            self.assertEqual(stats[tenant]['idle'], 1)
+            self.assertEqual(stats[tenant]['in_use'], 0)
+
+        # a connection in use when its pool is evicted is closed on return
+        with self.tenant_context('b'):
+            pool_b = self.db.database._tenants['b']
+            conn = self.db.database.get_conn()
+            self.assertEqual(pool_b.get_stats()['in_use'], 1)
+            t = threading.Thread(target=lambda: [
+                client.get('/', headers={'X-Tenant': tenant})
+                for tenant in ('a', 'c')])
+            t.start()
+            t.join()
+            self.assertEqual(sorted(self.db.get_tenant_stats()), ['a', 'c'])
+            self.assertEqual(self.Item.select().count(), 1)
+        self.assertEqual(pool_b.get_stats()['in_use'], 0)
+        self.assertEqual(pool_b.get_stats()['idle'], 0)
+        self.assertRaises(sqlite3.ProgrammingError, conn.execute, 'select 1')
+
+
+    def test_use_tenant(self):
+        from flask_peewee.writebehind import WriteBehind
+
+        with self.db.database.use_tenant('b'):
+            self.assertEqual([i.name for i in self.Item.select()], ['item-b'])
+            self.db.database.close()
+        self.assertEqual([i.name for i in self.Item.select()], ['primary'])
+        self.db.database.close()
+
+        # buffered writes go to the database of the tenant making them
+        write_behind = WriteBehind(self.db.database)
+        for tenant in ('b', 'c'):
+            with self.tenant_context(tenant):
+                item = self.Item.get()
+                write_behind.update(item, name='%s-changed' % item.name)
+                write_behind.insert(self.Item, name='new-%s' % tenant)
+        write_behind.close()
+
+        for tenant in ('b', 'c'):
+            with self.db.database.use_tenant(tenant):
+                self.assertEqual(
+                    [i.name for i in self.Item.select().order_by(self.Item.id)],
+                    ['item-%s-changed' % tenant, 'new-%s' % tenant])
+                self.db.database.close()
+        self.assertEqual([i.name for i in self.Item.select()], ['primary'])
+
+class CooperativeDatabaseTestCase(DatabaseTestCase):
+    def test_fair_waiting(self):
+        app, db = self.get_database(pool=True, max_connections=1, checkout_timeout=5)
+        database = db.database
+        database.connect()
+
+        order = []
+
+        def connect(i):
+            database.connect()
+            order.append(i)
+            database.close()
+
+        threads = []
+        for i in range(4):
+            t = threading.Thread(target=connect, args=(i,))
+            t.start()
+            threads.append(t)
+            while database.get_stats()['waiting'] < i + 1:
+                time.sleep(0.001)
+
+        database.close()
+        for t in threads:
+            t.join()
+
+        # served in the order they started waiting
+        self.assertEqual(order, [0, 1, 2, 3])
+        stats = database.get_stats()
+        self.assertEqual(stats['waits'], 4)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['created'], 1)
+
+    def test_task_connections(self):
+        app, db = self.get_database(
+            concurrency='asyncio',
+            pool=True,
+            max_connections=2,
+            checkout_timeout=5)
+        database = db.database
+
+        # switch between tasks by hand
+        from flask_peewee import concurrency
+
+        class Task(object):
+            pass
+        t1, t2, t3 = Task(), Task(), Task()
+        current = [t1]
+
+        def restore(current_task=concurrency._current_task):
+            concurrency._current_task = current_task
+        self.addCleanup(restore)
+        concurrency._current_task = lambda: current[0]
+
+        database.connect()
+        conn1 = database.get_conn()
+        current[0] = t2
+        self.assertTrue(database.is_closed())
+        database.connect()
+        self.assertFalse(database.get_conn() is conn1)
+
+        # tasks can't wait for a connection without blocking the event loop
+        current[0] = t3
+        self.assertRaises(MaxConnectionsExceeded, database.connect)
+        self.assertEqual(database.get_stats()['timeouts'], 1)
+
+        current[0] = t1
+        self.assertTrue(database.get_conn() is conn1)
+        database.close()
+        current[0] = t3
+        database.connect()
+        self.assertTrue(database.get_conn() is conn1)
+
+        # the state of finished tasks is discarded
+        current[0] = None
+        del t3
+        self.assertEqual(len(get_connection_local(database)._states), 2)
+
+    def test_asyncio_ident(self):
+        import asyncio
+        from flask_peewee.concurrency import AsyncioConcurrency
+
+        concurrency = AsyncioConcurrency()
+        self.assertTrue(concurrency.get_ident() is threading.current_thread())
+
+        @asyncio.coroutine
+        def get_ident():
+            return [concurrency.get_ident()]
+
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(get_ident())
+            self.assertTrue(loop.run_until_complete(task)[0] is task)
+        finally:
+            loop.close()
+
+    def test_unknown_concurrency(self):
+        self.assertRaises(ImproperlyConfigured, self.get_database, concurrency='fibers')
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_greenlets(self):
+        app, db = self.get_database(
+            concurrency='greenlet',
+            pool=True,
+            max_connections=4,
+            checkout_timeout=10)
+        database = db.database
+        conns = set()
+
+        def query():
+            database.connect()
+            conns.add(id(database.get_conn()))
+            gevent.sleep(0.001)
+            database.execute_sql('select 1')
+            database.close()
+
+        greenlets = [gevent.spawn(query) for i in range(500)]
+        gevent.joinall(greenlets, raise_error=True)
+
+        self.assertEqual(len(conns), 4)
+        stats = database.get_stats()
+        self.assertEqual(stats['created'], 4)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['timeouts'], 0)
+
+
+class QueryBudgetTestCase(DatabaseTestCase):
+    slow_query = (
+        'WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c '
+        'WHERE x < 1000000000) SELECT COUNT(*) FROM c')
+
+    def setUp(self):
+        super(QueryBudgetTestCase, self).setUp()
+        self.app, self.db = self.get_database(query_budget=0.2)
+        self.app.logger.disabled = True
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+        Item.create(name='i1')
+
+        @self.app.route('/slow/')
+        def slow():
+            return str(self.db.database.execute_sql(self.slow_query).fetchone()[0])
+
+        @self.app.route('/sleep/<float:seconds>/')
+        def sleep(seconds):
+            time.sleep(seconds)
+            return str(self.Item.select().count())
+
+    def test_statement_interrupted(self):
+        client = self.app.test_client()
+        start = time.time()
+        resp = client.get('/slow/')
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue(time.time() - start < 2)
+
+        # outside of a request there is no budget
+        self.assertEqual(self.Item.select().count(), 1)
+
+    def test_budget_carries_over(self):
+        client = self.app.test_client()
+        resp = client.get('/sleep/0.0/')
+        self.assertEqual(resp.data, b'1')
+
+        # the time already spent counts against the budget
+        resp = client.get('/sleep/0.3/')
+        self.assertEqual(resp.status_code, 503)
+
+    def test_view_budgets(self):
+        from flask_peewee.budget import query_budget
+        from flask_peewee.rest import RestResource
+
+        @self.app.route('/report/')
+        @query_budget(1)
+        def report():
+            time.sleep(0.3)
+            return str(self.Item.select().count())
+
+        class ItemResource(RestResource):
+            query_budget = 0
+
+        api = RestAPI(self.app)
+        api.register(self.Item, ItemResource)
+        api.setup()
+
+        client = self.app.test_client()
+        self.assertEqual(client.get('/report/').data, b'1')
+        self.assertEqual(client.get('/api/item/').status_code, 503)
+
+    def test_statement_timeouts(self):
+        statements = []
+
+        class TracedConnection(sqlite3.Connection):
+            def __init__(self, *args, **kwargs):
+                super(TracedConnection, self).__init__(*args, **kwargs)
+                self.set_trace_callback(lambda sql: statements.append(sql))
+
+        app, db = self.get_database(query_budget=5, factory=TracedConnection)
+        database = db.database
+        database.get_statement_timeout_sql = lambda: 'SELECT %d AS statement_timeout'
+
+        @app.route('/')
+        def index():
+            for i in range(20):
+                database.execute_sql('SELECT 1')
+            return ''
+
+        def get_timeouts():
+            timeouts = [sql for sql in statements if 'statement_timeout' in sql]
+            del statements[:]
+            return timeouts
+
+        client = app.test_client()
+        client.get('/')
+        # set once, as it only changes every timeout_resolution seconds
+        self.assertEqual(get_timeouts(), ['SELECT 5000 AS statement_timeout'])
+
+        # the connection of the next request is set again
+        client.get('/')
+        self.assertEqual(get_timeouts(), ['SELECT 5000 AS statement_timeout'])
+
+        # rolling back may restore an earlier timeout, so it's set again
+        @app.route('/rollback/')
+        def rollback():
+            with database.transaction() as transaction:
+                database.execute_sql('SELECT 1')
+                transaction.rollback()
+                database.execute_sql('SELECT 1')
+                with database.savepoint() as savepoint:
+                    database.execute_sql('SELECT 1')
+                    savepoint.rollback()
+                    database.execute_sql('SELECT 1')
+            return ''
+
+        client.get('/rollback/')
+        self.assertEqual(get_timeouts(), ['SELECT 5000 AS statement_timeout'] * 3)
+        # closed connections aren't remembered
+        gc.collect()
+        self.assertTrue(len(database._statement_timeouts) <= 1)
+
+        # and statements without a budget lift it
+        database.connect()
+        database.set_statement_timeout(database.get_conn(), 5000)
+        database.execute_sql('SELECT 1')
+        database.execute_sql('SELECT 1')
+        self.assertEqual(get_timeouts(), [
+            'SELECT 5000 AS statement_timeout',
+            'SELECT 0 AS statement_timeout'])
+        database.close()
+
+    def test_per_view_only(self):
+        from flask_peewee.budget import query_budget
+
+        app, db = self.get_database(query_budget=None)
+        app.logger.disabled = True
+
+        @app.route('/')
+        def index():
+            return str(db.database.execute_sql('SELECT 1').fetchone()[0])
+
+        @app.route('/slow/')
+        @query_budget(0.1)
+        def slow():
+            return str(db.database.execute_sql(self.slow_query).fetchone()[0])
+
+        client = app.test_client()
+        self.assertEqual(client.get('/').data, b'1')
+        self.assertEqual(client.get('/slow/').status_code, 503)
+
+
+class StreamingTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(StreamingTestCase, self).setUp()
+        self.app, self.db = self.get_database(instrument=True, streaming=True)
+
+        class Item(self.db.Model):
+            name = CharField()
+
+        self.Item = Item
+        Item.create_table()
+        for i in range(10):
+            Item.create(name='i%s' % i)
+
+    def test_stream(self):
+        from flask_peewee.streaming import stream
+
+        server_side = []
+        get_server_side_cursor = self.db.database.get_server_side_cursor
+
+        def record_cursor():
+            server_side.append(True)
+            return get_server_side_cursor()
+        self.db.database.get_server_side_cursor = record_cursor
+
+        query = self.Item.select().order_by(self.Item.id)
+        self.assertEqual(
+            [item.name for item in stream(query, chunk_size=3)],
+            ['i%s' % i for i in range(10)])
+        self.assertEqual(server_side, [True])
+
+        # the query's own results are left alone
+        self.assertEqual(query._qr, None)
+        self.assertEqual(self.Item.select().count(), 10)
+        self.assertEqual(server_side, [True])
+
+        query = self.Item.select(self.Item.name).where(self.Item.id > 8).tuples()
+        self.assertEqual(list(stream(query)), [('i8',), ('i9',)])
+
+        # nothing commits while the server-side cursor is being read, even
+        # for engines committing selects outside of a transaction
+        events = []
+        database = self.db.database
+        database.commit_select = True
+        commit = database.commit
+
+        def record_commit():
+            events.append('commit')
+            return commit()
+        database.commit = record_commit
+
+        class RecordedCursor(object):
+            def __init__(self, cursor):
+                self.cursor = cursor
+
+            def fetchmany(self, size):
+                events.append('fetch')
+                return self.cursor.fetchmany(size)
+
+            def __getattr__(self, attr):
+                return getattr(self.cursor, attr)
+
+        def declare_cursor():
+            events.append('declare')
+            return RecordedCursor(get_server_side_cursor())
+        database.get_server_side_cursor = declare_cursor
+
+        self.assertTrue(database.get_autocommit())
+        self.assertEqual(len(list(stream(self.Item.select(), chunk_size=4))), 10)
+        self.assertEqual(events, ['declare', 'fetch', 'fetch', 'fetch', 'fetch', 'commit'])
+
+        # databases without "streaming" iterate as usual
+        app, db = self.get_database()
+        self.assertFalse(hasattr(db.database, 'execute_streaming'))
+        query = self.Item.select().order_by(self.Item.id)
+        query.database = db.database
+        self.assertEqual(len(list(stream(query))), 10)
+
+    def test_rows_fetched_in_chunks(self):
+        from flask import g
+        from flask_peewee.streaming import stream
+
+        @self.app.route('/')
+        def index():
+            names = []
+            for item in stream(self.Item.select(), chunk_size=4):
+                names.append(item.name)
+                # at most one chunk has been fetched ahead
+                self.assertTrue(g.query_stats.rows - len(names) < 4)
+            return str(len(names))
+
+        self.assertEqual(self.app.test_client().get('/').data, b'10')
+
+    def test_streamed_responses(self):
+        from flask_peewee.admin import Export
+        from flask_peewee.rest import RestResource
+
+        class ItemResource(RestResource):
+            paginate_by = None
+
+        api = RestAPI(self.app)
+        api.register(self.Item, ItemResource)
+        api.setup()
+
+        @self.app.route('/export/')
+        def export():
+            return Export(self.Item.select().order_by(self.Item.id), {}, ['name']).json_response()
+
+        client = self.app.test_client()
+        resp = client.get('/api/item/')
+        self.assertTrue(resp.is_streamed)
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual([obj['name'] for obj in data], ['i%s' % i for i in range(10)])
+
+        resp = client.get('/export/')
+        data = json.loads(resp.data.decode('utf8'))
+        self.assertEqual(data, [{'name': 'i%s' % i} for i in range(10)])
+
+        # the connection is released once the response has been sent
+        self.assertTrue(self.db.database.is_closed())
+
+        self.Item.delete().execute()
+        self.assertEqual(json.loads(client.get('/api/item/').data.decode('utf8')), [])
+        self.assertEqual(json.loads(client.get('/export/').data.decode('utf8')), [])
+
+    def test_overridden_responses(self):
+        from flask_peewee.rest import RestResource
+
+        class CountedResource(RestResource):
+            paginate_by = None
+
+            def serialize_query(self, query):
+                return {'count': len(super(CountedResource, self).serialize_query(query))}
+
+        class WrappedResource(RestResource):
+            paginate_by = None
+
+            def response(self, data):
+                return super(WrappedResource, self).response({'data': data})
+
+        def get_list(resource):
+            app = Flask(__name__)
+            api = RestAPI(app)
+            api.register(self.Item, resource)
+            api.setup()
+            resp = app.test_client().get('/api/item/')
+            return json.loads(resp.data.decode('utf8'))
+
+        self.assertEqual(get_list(CountedResource), {'count': 10})
+        self.assertEqual(len(get_list(WrappedResource)['data']), 10)
+
+
+class ResultCacheTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(ResultCacheTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            result_cache=True,
+            result_cache_size=3,
+            result_cache_max_rows=5)
+
+        class Category(self.db.Model):
+            name = CharField()
+
+            class Meta:
+                cache_results = True
+
+        class Item(self.db.Model):
+            category = ForeignKeyField(Category, related_name='items')
+            name = CharField()
+
+        self.Category, self.Item = Category, Item
+        Category.create_table()
+        Item.create_table()
+        self.c1 = Category.create(name='c1')
+        Item.create(category=self.c1, name='i1')
+
+    def raw_update(self, sql):
+        # bypasses the database wrapper, so the cache can't know
+        conn = sqlite3.connect(self.db.database.database)
+        conn.execute(sql)
+        conn.commit()
+        conn.close()
+
+    def names(self, query=None):
+        if query is None:
+            query = self.Category.select().order_by(self.Category.name)
+        return [c.name for c in query]
+
+    def test_results_cached(self):
+        self.assertEqual(self.names(), ['c1'])
+        self.raw_update("update category set name = 'changed'")
+        self.assertEqual(self.names(), ['c1'])
+        self.assertEqual(self.Category.get(self.Category.id == self.c1.id).name, 'changed')
+        self.assertEqual(self.Category.get(self.Category.id == self.c1.id).name, 'changed')
+        self.assertEqual(self.Category.select().count(), 1)
+
+        stats = self.db.get_result_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (2, 3, 3))
+
+        # models which don't opt in are never cached
+        items = self.Item.select()
+        self.assertEqual([i.name for i in items], ['i1'])
+        self.raw_update("update item set name = 'changed'")
+        self.assertEqual([i.name for i in self.Item.select()], ['changed'])
+        self.assertEqual(self.db.get_result_cache_stats()['size'], 3)
+
+        # nor are rows selected for update
+        query = self.Category.select()
+        self.assertFalse(query.is_locking())
+        self.assertTrue(query.for_update().is_locking())
+        self.assertTrue(query.for_update(nowait=True).is_locking())
+
+    def test_writes_invalidate(self):
+        Category, Item = self.Category, self.Item
+        self.assertEqual(self.names(), ['c1'])
+
+        c2 = Category.create(name='c2')
+        self.assertEqual(self.names(), ['c1', 'c2'])
+        c2.name = 'c3'
+        c2.save()
+        self.assertEqual(self.names(), ['c1', 'c3'])
+        Category.update(name='c0').where(Category.id == c2.id).execute()
+        self.assertEqual(self.names(), ['c0', 'c1'])
+        c2.delete_instance()
+        self.assertEqual(self.names(), ['c1'])
+        self.db.database.execute_sql("UPDATE category SET name = 'raw'")
+        self.assertEqual(self.names(), ['raw'])
+
+        # queries are tagged with every table they read
+        query = lambda: Category.select().join(Item).where(Item.name == 'i2')
+        self.assertEqual(self.names(query()), [])
+        Item.create(category=self.c1, name='i2')
+        self.assertEqual(self.names(query()), ['raw'])
+
+    def test_transactions(self):
+        self.assertEqual(self.names(), ['c1'])
+        with self.db.database.transaction():
+            self.Category.create(name='c2')
+            self.assertEqual(self.names(), ['c1', 'c2'])
+            # uncommitted rows are not shared through the cache
+            self.assertEqual(self.db.get_result_cache_stats()['size'], 0)
+        self.assertEqual(self.names(), ['c1', 'c2'])
+        self.assertEqual(self.db.get_result_cache_stats()['size'], 1)
+
+        try:
+            with self.db.database.transaction():
+                self.Category.create(name='c3')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.names(), ['c1', 'c2'])
+
+    def test_bounds(self):
+        Category = self.Category
+        for i in range(2, 8):
+            Category.create(name='c%s' % i)
+
+        # too many rows to cache
+        self.assertEqual(len(self.names()), 7)
+        self.assertEqual(self.db.get_result_cache_stats()['size'], 0)
+
+        for i in range(1, 5):
+            self.names(Category.select().where(Category.name == 'c%s' % i))
+        self.assertEqual(self.db.get_result_cache_stats()['size'], 3)
+
+        class Tag(self.db.Model):
+            name = CharField()
+
+            class Meta:
+                cache_ttl = 0.05
+
+        Tag.create_table()
+        Tag.create(name='t1')
+        self.assertEqual([t.name for t in Tag.select()], ['t1'])
+        self.raw_update("update tag set name = 't2'")
+        self.assertEqual([t.name for t in Tag.select()], ['t1'])
+        time.sleep(0.06)
+        self.assertEqual([t.name for t in Tag.select()], ['t2'])
+
+
+class InvalidationBusTestCase(DatabaseTestCase):
+    def get_buses(self, transport_class, path):
+        # buses of two "processes" sharing a transport path
+        buses = [InvalidationBus(transport_class(path), poll_interval=0) for i in range(2)]
+        received = [[], []]
+        for bus, messages in zip(buses, received):
+            bus.subscribe(lambda namespace, tables, messages=messages:
+                          messages.append((namespace, tables)))
+            bus.poll()
+            self.addCleanup(bus.close)
+        return buses, received
+
+    def assertDelivered(self, buses, received):
+        buses[0].publish(None, ['item'])
+        buses[1].publish('acme', ['item', 'category'])
+        buses[0].publish(None, ['*'])
+        for bus in buses:
+            bus.poll()
+        self.assertEqual(received[0], [('acme', ['category', 'item'])])
+        self.assertEqual(received[1], [(None, ['item']), (None, ['*'])])
+
+        # nothing is delivered twice
+        buses[1].poll()
+        self.assertEqual(len(received[1]), 2)
+        self.assertEqual(buses[1].get_stats(), {
+            'published': 1, 'received': 2, 'subscribers': 1})
+
+    def test_sqlite_transport(self):
+        path = os.path.join(self.temp_dir, 'bus.db')
+        self.assertDelivered(*self.get_buses(SqliteTransport, path))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires unix sockets')
+    def test_unix_socket_transport(self):
+        path = os.path.join(self.temp_dir, 'bus')
+        buses, received = self.get_buses(UnixSocketTransport, path)
+        self.assertDelivered(buses, received)
+
+        # sockets of closed transports are cleaned up
+        self.assertEqual(len(os.listdir(path)), 2)
+        stale = UnixSocketTransport(path)
+        stale.receive()
+        stale._sock.close()
+        buses[0].publish(None, ['item'])
+        self.assertEqual(len(os.listdir(path)), 2)
+
+    def test_database_publishes(self):
+        bus_path = os.path.join(self.temp_dir, 'bus.db')
+        workers = []
+        for i in range(2):
+            app, db = self.get_database(
+                result_cache=True,
+                invalidation_bus='sqlite',
+                invalidation_bus_path=bus_path,
+                invalidation_poll_interval=60)
+
+            @app.route('/')
+            def names(db=db):
+                return ','.join(c.name for c in db.Category.select().order_by(db.Category.name))
+
+            class Category(db.Model):
+                name = CharField()
+
+                class Meta:
+                    cache_results = True
+
+            db.Category = Category
+            workers.append((app.test_client(), db))
+            self.addCleanup(db.invalidation_bus.close)
+
+        (client1, db1), (client2, db2) = workers
+        db1.Category.create_table()
+        db1.Category.create(name='c1')
+        self.assertEqual(client1.get('/').data, b'c1')
+        self.assertEqual(client2.get('/').data, b'c1')
+
+        # the second worker's cache is invalidated by the first one's write
+        db1.Category.create(name='c2')
+        self.assertEqual(client2.get('/').data, b'c1,c2')
+        self.assertEqual(client1.get('/').data, b'c1,c2')
+        self.assertEqual(db2.get_result_cache_stats()['hits'], 0)
+        self.assertEqual(client2.get('/').data, b'c1,c2')
+        self.assertEqual(db2.get_result_cache_stats()['hits'], 1)
+
+        # published once committed
+        published = lambda: db1.get_invalidation_stats()['published']
+        before = published()
+        with db1.database.transaction():
+            db1.Category.create(name='c3')
+            db1.Category.create(name='c4')
+            self.assertEqual(published(), before)
+        self.assertEqual(published(), before + 1)
+        self.assertEqual(client2.get('/').data, b'c1,c2,c3,c4')
+
+        try:
+            with db1.database.transaction():
+                db1.Category.create(name='c5')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(published(), before + 1)
+
+        # messages published before the second worker's first poll are skipped
+        self.assertEqual(db2.get_invalidation_stats()['received'], 2)
+        self.assertEqual(db1.get_invalidation_stats()['received'], 0)
+
+    def test_config(self):
+        self.assertRaises(ImproperlyConfigured, self.get_database, invalidation_bus='unix')
+        self.assertRaises(
+            ImproperlyConfigured,
+            self.get_database,
+            invalidation_bus='flask_peewee.invalidation.Missing')
+
+        bus = InvalidationBus(SqliteTransport(os.path.join(self.temp_dir, 'bus.db')))
+        app, db = self.get_database(invalidation_bus=bus)
+        self.assertTrue(db.invalidation_bus is bus)
+        self.assertEqual(self.get_database()[1].get_invalidation_stats(), None)
+
+
+class WriteBehindTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(WriteBehindTestCase, self).setUp()
+        self.app, self.db = self.get_database(
+            write_behind=True,
+            write_behind_interval=60,
+            write_behind_size=45)
+
+        class User(self.db.Model):
+            username = CharField()
+            last_seen = IntegerField(null=True)
+            views = IntegerField(default=0)
+
+        class Activity(self.db.Model):
+            user = ForeignKeyField(User)
+            action = CharField()
+
+        self.User, self.Activity = User, Activity
+        User.create_table()
+        Activity.create_table()
+        self.users = [User.create(username='u%s' % i) for i in range(3)]
+
+    def tearDown(self):
+        self.db.write_behind.close()
+        super(WriteBehindTestCase, self).tearDown()
+
+    def get_users(self):
+        return [(u.username, u.last_seen, u.views)
+                for u in self.User.select().order_by(self.User.id)]
+
+    def test_coalesced_updates(self):
+        write_behind = self.db.write_behind
+        u0, u1, u2 = self.users
+        for i in range(10):
+            write_behind.update(u0, last_seen=i)
+            write_behind.increment(u1, views=2)
+        write_behind.update(u2, last_seen=100, username='changed')
+        write_behind.increment(u2, views=1, last_seen=5)
+        self.assertEqual(len(write_behind), 3)
+        self.assertEqual((u0.last_seen, u1.views), (9, 20))
+
+        # nothing is written until flushed
+        self.assertEqual(self.get_users(), [('u0', None, 0), ('u1', None, 0), ('u2', None, 0)])
+
+        queries = []
+        execute_sql = self.db.database.execute_sql
+        def logged_execute_sql(sql, *args, **kwargs):
+            queries.append(sql)
+            return execute_sql(sql, *args, **kwargs)
+        self.db.database.execute_sql = logged_execute_sql
+
+        self.assertTrue(write_behind.flush())
+        self.assertEqual(self.get_users(), [('u0', 9, 0), ('u1', None, 20), ('changed', 105, 1)])
+        self.assertEqual(len([sql for sql in queries if sql.startswith('UPDATE')]), 1)
+
+        # increments apply to the stored value
+        write_behind.increment(self.User.get(self.User.id == u1.id), views=1)
+        write_behind.flush()
+        self.assertEqual(self.get_users()[1], ('u1', None, 21))
+        self.assertEqual(self.db.get_write_behind_stats(), {
+            'buffered': 0, 'flushes': 2, 'written': 4, 'errors': 0, 'dropped': 0})
+
+        self.assertRaises(AttributeError, write_behind.update, u0, missing=1)
+        self.assertRaises(ValueError, write_behind.update, self.User(), views=1)
+
+    def test_inserts(self):
+        write_behind = self.db.write_behind
+        write_behind.batch_size = 10
+        for i in range(45):
+            write_behind.insert(self.Activity, user=self.users[i % 3].id, action='a%s' % i)
+
+        # reaching write_behind_size starts writing without waiting
+        for i in range(100):
+            if self.Activity.select().count() == 45:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.Activity.select().count(), 45)
+
+        logger = logging.getLogger('flask_peewee.writebehind')
+        logger.disabled = True
+        self.addCleanup(setattr, logger, 'disabled', False)
+
+        # rows which can't be written are kept, and written by the next flush
+        database = self.db.database
+        def locked_execute_sql(sql, *args, **kwargs):
+            if sql.startswith('INSERT'):
+                raise OperationalError('database is locked')
+            return execute_sql(sql, *args, **kwargs)
+        execute_sql = database.execute_sql
+        database.execute_sql = locked_execute_sql
+        write_behind.insert(self.Activity, user=self.users[0].id, action='a45')
+        write_behind.update(self.users[0], last_seen=1)
+        self.assertRaises(WriteBehindError, write_behind.flush)
+        write_behind.increment(self.users[0], views=1)
+        stats = self.db.get_write_behind_stats()
+        self.assertEqual((stats['buffered'], stats['errors'], stats['dropped']), (2, 1, 0))
+
+        database.execute_sql = execute_sql
+        self.assertTrue(write_behind.flush())
+        self.assertEqual(self.Activity.select().count(), 46)
+        self.assertEqual(self.get_users()[0], ('u0', 1, 1))
+
+        # and dropped once they have failed "retries" more times
+        write_behind.insert(self.Activity, user=self.users[0].id)
+        for i in range(write_behind.retries + 1):
+            self.assertRaises(WriteBehindError, write_behind.flush)
+        stats = self.db.get_write_behind_stats()
+        self.assertEqual((stats['buffered'], stats['errors'], stats['dropped']), (0, 5, 1))
+        self.assertTrue(write_behind.flush())
+
+        write_behind.insert(self.Activity, user=self.users[0].id, action='a46')
+        write_behind.close()
+        self.assertEqual(self.Activity.select().count(), 47)
+
+    def test_interval(self):
+        write_behind = self.db.write_behind
+        write_behind.interval = 0.01
+        write_behind.increment(self.users[0], views=1)
+        for i in range(100):
+            if self.get_users()[0][2] == 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.get_users()[0], ('u0', None, 1))
+        self.assertEqual(len(write_behind), 0)
+
+
+class QueryPlanGuardTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(QueryPlanGuardTestCase, self).setUp()
+        self.app, self.db = self.get_database()
+        self.app.secret_key = 'secret'
+
+        class Author(self.db.Model):
+            name = CharField()
+            email = CharField(index=True)
+
+        class Book(self.db.Model):
+            author = ForeignKeyField(Author)
+            title = CharField()
+            published = DateField(index=True)
+
+        class BookResource(RestResource):
+            filter_fields = ('title', 'published', 'author__email')
+
+        class BookAdmin(ModelAdmin):
+            columns = ('title', 'published')
+            filter_fields = ('published', 'author__name')
+
+        self.Author, self.Book = Author, Book
+        Author.create_table()
+        Book.create_table()
+
+        self.api = RestAPI(self.app)
+        self.api.register(Book, BookResource)
+        self.admin = Admin(self.app, Auth(self.app, self.db))
+        self.admin.register(Book, BookAdmin)
+
+    def get_problems(self, guard, registry):
+        return sorted(str(problem) for problem in guard.check(registry))
+
+    def test_rest_api(self):
+        guard = QueryPlanGuard(min_rows=1000, table_sizes={'book': 1000, 'author': 10})
+        problems = self.get_problems(guard, self.api)
+        for op in ('eq', 'gt', 'gte', 'ilike', 'in', 'is', 'like', 'lt', 'lte', 'ne', 'regexp'):
+            self.assertTrue('api/book: filter title__%s' % op in problems)
+        # operations an index can't serve are reported for indexed fields too
+        for op in ('ne', 'ilike', 'regexp'):
+            self.assertTrue('api/book: filter published__%s' % op in problems)
+            self.assertTrue('api/book: filter author__email__%s' % op in problems)
+        for op in ('eq', 'gt', 'gte', 'in', 'lt', 'lte'):
+            self.assertFalse('api/book: filter published__%s' % op in problems)
+            self.assertFalse('api/book: filter author__email__%s' % op in problems)
+        self.assertTrue('api/book: ordering title' in problems)
+        self.assertTrue('api/book: ordering -title' in problems)
+
+        # known scans can be silenced
+        guard = QueryPlanGuard(min_rows=1000, table_sizes={'book': 1000, 'author': 10}, ignore=[
+            'api/book: filter *__ne',
+            'api/book: filter *like',
+            'api/book: filter *__regexp',
+            'api/book: filter title__*'])
+        self.assertEqual(self.get_problems(guard, self.api), [
+            'api/book: ordering -title',
+            'api/book: ordering title',
+        ])
+
+        # scans of small tables are fine
+        guard = QueryPlanGuard(min_rows=1000, table_sizes={'book': 999})
+        self.assertEqual(self.get_problems(guard, self.api), [])
+
+        guard = QueryPlanGuard(min_rows=1, table_sizes={'book': 1000}, ignore=[
+            '*title*', '*__ne', '*like', '*__regexp'])
+        self.assertEqual(self.get_problems(guard, self.api), [])
+
+        guard = QueryPlanGuard(min_rows=0)
+        problems = guard.check(self.api)
+        self.assertEqual(problems[0].scans, ['book'])
+        try:
+            guard.assert_plans(self.api)
+        except AssertionError as exc:
+            message = str(exc)
+            self.assertTrue(message.startswith(
+                '%d exposed queries scan large tables' % len(problems)))
+            self.assertTrue('api/book: filter title__eq\n    SELECT' in message)
+        else:
+            self.fail('AssertionError not raised')
+
+    def test_admin(self):
+        # the author's name has no index, so every author is scanned
+        guard = QueryPlanGuard(min_rows=1000, table_sizes={'book': 1000, 'author': 1000})
+        self.assertEqual(self.get_problems(guard, self.admin), [
+            'admin/book: filter author__name contains',
+            'admin/book: filter author__name equal to',
+            'admin/book: filter author__name not equal to',
+            'admin/book: filter author__name starts with',
+            'admin/book: filter published month equals',
+            'admin/book: filter published not equal to',
+            'admin/book: filter published year equals',
+            'admin/book: ordering -title',
+            'admin/book: ordering title',
+        ])
+        self.assertEqual(self.get_problems(QueryPlanGuard(), self.admin), [])
+
+
+class KeysetPaginationTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(KeysetPaginationTestCase, self).setUp()
+        self.app, self.db = self.get_database()
+
+        class Item(self.db.Model):
+            rank = IntegerField()
+            created = DateTimeField()
+            note = CharField(null=True)
+
+        self.Item = Item
+        Item.create_table()
+        start = datetime.datetime(2020, 1, 1)
+        with self.db.database.atomic():
+            for i in range(45):
+                Item.create(rank=i % 7, created=start + datetime.timedelta(hours=i % 5))
+
+    def get_page(self, query, cursor=None, paginate_by=10):
+        query_string = {'cursor': cursor} if cursor else {}
+        with self.app.test_request_context(query_string=query_string):
+            pq = PaginatedQuery(query, paginate_by, keyset=True)
+            ids = [item.id for item in pq.get_list()]
+            return pq, ids
+
+    def walk(self, query, paginate_by=10):
+        pages = []
+        cursor = None
+        while True:
+            pq, ids = self.get_page(query, cursor, paginate_by)
+            pages.append((pq, ids))
+            cursor = pq.get_next_cursor()
+            if cursor is None:
+                return pages
+
+    def test_forward_and_backward(self):
+        Item = self.Item
+        for ordering in ([Item.rank.desc()], [Item.rank, Item.created.desc()], [Item.created]):
+            query = Item.select().order_by(*ordering)
+            expected = [item.id for item in query.order_by(*(ordering + [
+                Item.id.desc() if ordering[-1]._ordering == 'DESC' else Item.id]))]
+
+            pages = self.walk(query)
+            self.assertEqual([len(ids) for pq, ids in pages], [10, 10, 10, 10, 5])
+            self.assertEqual(sum([ids for pq, ids in pages], []), expected)
+            self.assertTrue(all(pq.keyset for pq, ids in pages))
+            self.assertIsNone(pages[0][0].get_previous_cursor())
+
+            # and back again from the last page
+            pq = pages[-1][0]
+            for previous_pq, ids in reversed(pages[:-1]):
+                pq, page_ids = self.get_page(query, pq.get_previous_cursor())
+                self.assertEqual(page_ids, ids)
+                self.assertIsNotNone(pq.get_next_cursor())
+            self.assertIsNone(pq.get_previous_cursor())
+
+    def test_seek_instead_of_offset(self):
+        Item = self.Item
+        pages = self.walk(Item.select().order_by(Item.rank))
+        with self.app.test_request_context(query_string={'cursor': pages[-2][0].get_next_cursor()}):
+            pq = PaginatedQuery(Item.select().order_by(Item.rank), 10, keyset=True)
+            sql, params = pq.query.order_by(Item.rank, Item.id).where(
+                pq.get_seek_expression(pq.get_cursor()[1], False)).sql()
+        self.assertNotIn('OFFSET', sql)
+        self.assertIn('WHERE (("t1"."rank" >= ?) AND (("t1"."rank" > ?) OR '
+                      '(("t1"."rank" = ?) AND ("t1"."id" > ?))))', sql)
+
+    def test_invalid_cursor(self):
+        Item = self.Item
+        query = Item.select().order_by(Item.rank)
+        first_page = self.walk(query)[0][1]
+        other_ordering = self.walk(Item.select().order_by(Item.created))[0][0].get_next_cursor()
+        for cursor in ('garbage', 'e30', other_ordering):
+            pq, ids = self.get_page(query, cursor)
+            self.assertEqual(ids, first_page)
+
+    def test_fallback_to_offset(self):
+        Item = self.Item
+        for query in (Item.select().order_by(Item.note), Item.select().order_by(fn.Random())):
+            with self.app.test_request_context(query_string={'page': '2'}):
+                pq = PaginatedQuery(query, 10, keyset=True)
+                self.assertFalse(pq.keyset)
+                self.assertIn('OFFSET', pq.get_list().sql()[0])
+                self.assertEqual(len(list(pq.get_list())), 10)
+
+
+class CountStrategyTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(CountStrategyTestCase, self).setUp()
+        self.app, self.db = self.get_database()
+
+        class Item(self.db.Model):
+            rank = IntegerField()
+
+        self.Item = Item
+        Item.create_table()
+        self.add_items(45)
+
+    def add_items(self, n):
+        with self.db.database.atomic():
+            for i in range(n):
+                self.Item.create(rank=i % 7)
+
+    def paginate(self, count_strategy, page=1, query=None, keyset=False):
+        if query is None:
+            query = self.Item.select().order_by(self.Item.id)
+        with self.app.test_request_context(query_string={'page': str(page)}):
+            pq = PaginatedQuery(query, 10, keyset=keyset, count_strategy=count_strategy)
+            return pq, [item.id for item in pq.get_list()], pq.get_count(), pq.has_next()
+
+    def test_exact(self):
+        pq, ids, count, has_next = self.paginate(None, 5)
+        self.assertEqual(ids, list(range(41, 46)))
+        self.assertEqual(count, (45, True))
+        self.assertFalse(has_next)
+        self.assertEqual(pq.get_pages(), 5)
+
+    def test_capped(self):
+        capped = CappedCount(20)
+        pq, ids, count, has_next = self.paginate(capped, 1)
+        self.assertEqual((count, has_next, pq.get_pages()), ((20, False), True, 2))
+
+        # beyond the cap, rows are counted up to the end of the page and the
+        # next page is looked for
+        pq, ids, count, has_next = self.paginate(capped, 3)
+        self.assertEqual((count, has_next), ((30, False), True))
+        pq, ids, count, has_next = self.paginate(capped, 4)
+        self.assertEqual((count, has_next), ((40, False), True))
+        pq, ids, count, has_next = self.paginate(capped, 5)
+        self.assertEqual((count, has_next), ((45, True), False))
+
+        pq, ids, count, has_next = self.paginate(CappedCount(100), 1)
+        self.assertEqual(count, (45, True))
+
+    def test_estimated(self):
+        estimated = EstimatedCount(exact_below=10)
+        # without statistics the rows are counted
+        self.assertEqual(self.paginate(estimated)[2], (45, True))
+
+        self.db.database.execute_sql('ANALYZE')
+        self.add_items(5)
+        self.assertEqual(self.paginate(estimated)[2], (45, False))
+        pq, ids, count, has_next = self.paginate(estimated, 5)
+        self.assertEqual((len(ids), has_next), (10, False))
+
+        # statistics only know whole tables
+        query = self.Item.select().where(self.Item.rank == 1)
+        self.assertEqual(self.paginate(estimated, query=query)[2], (8, True))
+
+        # small estimates are counted
+        self.assertEqual(self.paginate(EstimatedCount(exact_below=100))[2], (50, True))
+
+    def test_window(self):
+        window = WindowCount()
+        pq, ids, count, has_next = self.paginate(window, 2)
+        self.assertEqual(ids, list(range(11, 21)))
+        self.assertEqual((count, has_next), ((45, True), True))
+        self.assertIn('OVER', pq.get_list().sql()[0])
+
+        query = self.Item.select().where(self.Item.rank == 1).order_by(self.Item.id)
+        with self.app.test_request_context():
+            pq = PaginatedQuery(query.dicts(), 5, count_strategy=window)
+            self.assertEqual(len(pq.get_list()), 5)
+            self.assertEqual(pq.get_count(), (7, True))
+
+        # past the last page there are no rows to read the count from
+        pq, ids, count, has_next = self.paginate(window, 6)
+        self.assertEqual((ids, count, has_next), ([], (45, True), False))
+
+    def test_cached(self):
+        cached = CachedCount(ttl=60)
+        self.assertEqual(self.paginate(cached, 1)[2], (45, True))
+        self.add_items(5)
+        self.assertEqual(self.paginate(cached, 2)[2], (45, True))
+        self.assertEqual(cached.get_stats(), {'size': 1, 'hits': 1, 'misses': 1})
+
+        query = self.Item.select().where(self.Item.rank == 1)
+        self.assertEqual(self.paginate(cached, query=query)[2], (8, True))
+
+        cached.clear()
+        self.assertEqual(self.paginate(cached, 1)[2], (50, True))
+        self.assertEqual(cached.get_stats(), {'size': 1, 'hits': 1, 'misses': 3})
+
+        # cached counts of another strategy
+        cached = CachedCount(CappedCount(20))
+        self.assertEqual(self.paginate(cached, 1)[2], (20, False))
+        self.assertEqual(self.paginate(cached, 1)[2], (20, False))
+        self.assertEqual(cached.get_stats()['hits'], 1)
+
+    def test_keyset(self):
+        self.db.database.execute_sql('ANALYZE')
+        for strategy, count in (
+                (None, (45, True)),
+                (CappedCount(20), (30, False)),
+                (EstimatedCount(exact_below=10), (45, False)),
+                (WindowCount(), (45, True)),
+                (CachedCount(), (45, True)),
+                (CachedCount(CappedCount(20)), (30, False))):
+            pq, ids, page_count, has_next = self.paginate(strategy, 3, keyset=True)
+            self.assertTrue(pq.keyset)
+            self.assertEqual(ids, list(range(21, 31)))
+            self.assertEqual((page_count, has_next), (count, True))
+            self.assertEqual(pq.get_pages(), int(math.ceil(count[0] / 10.0)))
+
+
+class PageIndexTestCase(DatabaseTestCase):
+    def setUp(self):
+        super(PageIndexTestCase, self).setUp()
+        self.app, self.db = self.get_database(page_index=True, page_index_step=10)
+
+        class Item(self.db.Model):
+            rank = IntegerField()
+
+        self.Item = Item
+        Item.create_table()
+        with self.db.database.atomic():
+            for i in range(95):
+                Item.create(rank=i % 7)
+
+    def get_query(self):
+        return self.Item.select().order_by(self.Item.rank.desc())
+
+    def get_expected(self):
+        return [item.id for item in self.get_query().order_by(
+            self.Item.rank.desc(), self.Item.id.desc())]
+
+    def get_page(self, page=None, cursor=None, query=None):
+        query_string = {}
+        if page:
+            query_string['page'] = str(page)
+        if cursor:
+            query_string['cursor'] = cursor
+        with self.app.test_request_context(query_string=query_string):
+            pq = PaginatedQuery(query or self.get_query(), 5, keyset=True)
+            return pq, [item.id for item in pq.get_list()]
+
+    def test_page_jumps(self):
+        expected = self.get_expected()
+        page_index = self.db.database.page_index
+
+        pq, ids = self.get_page(7)
+        self.assertEqual(ids, expected[30:35])
+        self.assertEqual(pq.get_page(), 7)
+        self.assertEqual(self.db.get_page_index_stats(), {
+            'size': 1, 'max_size': 256, 'hits': 0, 'misses': 1, 'invalidations': 0})
+
+        # the cursors carry on from a jump
+        next_pq, ids = self.get_page(cursor=pq.get_next_cursor())
+        self.assertEqual((next_pq.get_page(), ids), (8, expected[35:40]))
+        previous_pq, ids = self.get_page(cursor=pq.get_previous_cursor())
+        self.assertEqual((previous_pq.get_page(), ids), (6, expected[25:30]))
+
+        # deeper pages extend the boundaries, seeking from the last one
+        for page in (15, 19, 3, 1):
+            pq, ids = self.get_page(page)
+            self.assertEqual(ids, expected[(page - 1) * 5:page * 5])
+        self.assertEqual(self.db.get_page_index_stats()['hits'], 3)
+
+        # the boundary before a row is the last row of its step
+        with self.app.test_request_context():
+            pq = PaginatedQuery(self.get_query(), 5, keyset=True)
+            values, remainder = page_index.locate(pq, 73)
+            boundary = self.Item.get(self.Item.id == expected[69])
+            self.assertEqual((values, remainder), ([boundary.rank, boundary.id], 3))
+
+        pq, ids = self.get_page(30)
+        self.assertEqual((ids, pq.get_previous_cursor(), pq.get_next_cursor()), ([], None, None))
+
+    def test_filtered(self):
+        query = self.Item.select().where(self.Item.rank < 3).order_by(self.Item.rank.desc())
+        expected = [item.id for item in query.order_by(self.Item.rank.desc(), self.Item.id.desc())]
+        pq, ids = self.get_page(4, query=query)
+        self.assertEqual(ids, expected[15:20])
+        self.get_page(4)
+        self.assertEqual(self.db.get_page_index_stats()['size'], 2)
+
+    def test_invalidation(self):
+        self.get_page(7)
+        self.Item.create(rank=6)
+        pq, ids = self.get_page(7)
+        self.assertEqual(ids, self.get_expected()[30:35])
+        self.assertEqual(self.db.get_page_index_stats()['invalidations'], 1)
+
+        # writes inside a transaction invalidate the index again on commit
+        with self.db.database.atomic():
+            self.Item.delete().where(self.Item.rank == 6).execute()
+            self.get_page(7)
+        pq, ids = self.get_page(7)
+        self.assertEqual(ids, self.get_expected()[30:35])
+        self.assertEqual(self.db.get_page_index_stats()['invalidations'], 3)
@@ -11,6 +11,7 @@ import unittest
 
 from flask import g
 
+from flask_peewee.counting import CappedCount
 from flask_peewee.rest import Authentication
 from flask_peewee.rest import RestAPI
 from flask_peewee.rest import RestResource
@@ -26,18 +27,15 @@ from flask_peewee.tests.test_app import Message
 from flask_peewee.tests.test_app import Note
 from flask_peewee.tests.test_app import TestModel
 from flask_peewee.tests.test_app import User
+from flask_peewee.tests.test_app import api
 from flask_peewee.utils import check_password
 from flask_peewee.utils import get_next
 from flask_peewee.utils import make_password
 
 
 class RestApiTestCase(FlaskPeeweeTestCase):
-    def setUp(self):
-        super(RestApiTestCase, self).setUp()
-        TestModel.drop_table(True)
-        APIKey.drop_table(True)
-        APIKey.create_table()
-        TestModel.create_table()
+    isolation = 'rollback'
+    models = FlaskPeeweeTestCase.models + [APIKey, TestModel]
 
     def response_json(self, response):
         return json.loads(response.data.decode('utf8'))
@@ -556,6 +554,70 @@ class RestApiBasicTestCase(RestApiTestCase):
         # verify response objects are paginated properly
         self.assertAPINotes(resp_json, notes[20:])
 
+    def test_keyset_pagination(self):
+        users, notes = self.get_users_and_notes()
+
+        resource = api._registry[Note]
+        resource.keyset_pagination = True
+        try:
+            resp = self.app.get('/api/note/?ordering=id&limit=10')
+            resp_json = self.response_json(resp)
+
+            # no pages are counted
+            meta = resp_json['meta']
+            self.assertEqual(sorted(meta), ['model', 'next', 'next_cursor', 'page', 'previous', 'previous_cursor'])
+            self.assertEqual(meta['page'], 1)
+            self.assertEqual(meta['previous'], '')
+            self.assertEqual(meta['previous_cursor'], None)
+            self.assertTrue(('cursor=%s' % meta['next_cursor']) in meta['next'])
+            self.assertAPINotes(resp_json, notes[:10])
+
+            resp_json = self.response_json(self.app.get(meta['next']))
+            self.assertAPINotes(resp_json, notes[10:20])
+            self.assertEqual(resp_json['meta']['page'], 2)
+
+            resp_json = self.response_json(self.app.get(resp_json['meta']['next']))
+            self.assertAPINotes(resp_json, notes[20:])
+            self.assertEqual(resp_json['meta']['page'], 3)
+            self.assertEqual(resp_json['meta']['next'], '')
+            self.assertEqual(resp_json['meta']['next_cursor'], None)
+
+            resp_json = self.response_json(self.app.get(resp_json['meta']['previous']))
+            self.assertAPINotes(resp_json, notes[10:20])
+            self.assertEqual(resp_json['meta']['page'], 2)
+
+            # numbered pages can be jumped to, and are left by cursor
+            resp_json = self.response_json(self.app.get('/api/note/?ordering=id&limit=10&page=2'))
+            self.assertAPINotes(resp_json, notes[10:20])
+            self.assertFalse('page=' in resp_json['meta']['next'])
+
+            resp_json = self.response_json(self.app.get(resp_json['meta']['previous']))
+            self.assertAPINotes(resp_json, notes[:10])
+            self.assertEqual(resp_json['meta']['page'], 1)
+            self.assertEqual(resp_json['meta']['previous'], '')
+        finally:
+            resource.keyset_pagination = False
+
+    def test_pagination_count_strategy(self):
+        users, notes = self.get_users_and_notes()
+
+        resource = api._registry[Note]
+        resource.count_strategy = CappedCount(10)
+        try:
+            # the count stops at the first page, but the next ones are found
+            resp_json = self.response_json(self.app.get('/api/note/?ordering=id&limit=10'))
+            self.assertTrue('page=2' in resp_json['meta']['next'])
+
+            resp_json = self.response_json(self.app.get(resp_json['meta']['next']))
+            self.assertAPINotes(resp_json, notes[10:20])
+            self.assertTrue('page=3' in resp_json['meta']['next'])
+
+            resp_json = self.response_json(self.app.get(resp_json['meta']['next']))
+            self.assertAPINotes(resp_json, notes[20:])
+            self.assertEqual(resp_json['meta']['next'], '')
+        finally:
+            resource.count_strategy = None
+
     def test_filtering(self):
         users, notes = self.get_users_and_notes()
 
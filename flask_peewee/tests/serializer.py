@@ -6,6 +6,7 @@ from flask_peewee.tests.base import FlaskPeeweeTestCase
 from flask_peewee.tests.test_app import Message
 from flask_peewee.tests.test_app import Note
 from flask_peewee.tests.test_app import User
+from flask_peewee.utils import get_dictionary_from_model
 
 
 class SerializerTestCase(FlaskPeeweeTestCase):
@@ -42,6 +43,82 @@ class SerializerTestCase(FlaskPeeweeTestCase):
             'email': '',
         })
     
+    def assertSerializedLikeDictionary(self, serializer, obj, fields=None, exclude=None):
+        expected = serializer.clean_data(get_dictionary_from_model(obj, fields, exclude))
+        self.assertEqual(serializer.serialize_object(obj, fields, exclude), expected)
+
+    def test_serialization_plans(self):
+        users = self.create_users()
+        message = Message.create(user=self.admin, content='test')
+        note = Note.create(user=self.normal, message='note')
+
+        combinations = [
+            (None, None),
+            ({Message: ['id', 'user', 'pub_date']}, None),
+            ({Message: ['content', 'user'], User: ['username', 'join_date']}, None),
+            ({Message: ['user'], User: []}, None),
+            (None, {Message: ['pub_date']}),
+            ({Note: ['user', 'created_date'], User: ['id', 'admin']}, {User: ['admin']}),
+        ]
+        for fields, exclude in combinations:
+            for obj in (message, note, self.admin):
+                self.assertSerializedLikeDictionary(self.s, obj, fields, exclude)
+
+        # compiled once per combination
+        fields = {Message: ['id', 'user'], User: ['username']}
+        first = self.s.serialize_object(message, fields)
+        plan = self.s.get_plan(Message, fields)
+        self.assertTrue(self.s.get_plan(Message, dict(fields)) is plan)
+        self.assertEqual(first, {'id': message.id, 'user': {'username': 'admin'}})
+
+        # changing the same dictionaries changes the plan
+        fields[Message].append('content')
+        fields[User] = ['id']
+        self.assertEqual(self.s.serialize_object(message, fields), {
+            'id': message.id, 'user': {'id': message.user.id},
+            'content': message.content})
+        exclude = {Message: ['user']}
+        self.assertEqual(self.s.serialize_object(message, fields, exclude), {
+            'id': message.id, 'content': message.content})
+        exclude[Message].remove('user')
+        self.assertSerializedLikeDictionary(self.s, message, fields, exclude)
+
+        # values not of the field's type are converted as before
+        message.pub_date = datetime.date(2020, 1, 2)
+        message.content = datetime.time(12, 30)
+        self.assertEqual(self.s.serialize_object(message, {Message: ['pub_date', 'content']}), {
+            'pub_date': '2020-01-02',
+            'content': '12:30:00',
+        })
+
+        # formatted as strftime() does, years before 1000 included
+        message.pub_date = datetime.datetime(999, 1, 2, 3, 4, 5, 6)
+        self.assertSerializedLikeDictionary(self.s, message, {Message: ['pub_date']}, None)
+        message.pub_date = datetime.datetime(2020, 1, 2, 3, 4, 5, 6)
+        self.assertSerializedLikeDictionary(self.s, message, {Message: ['pub_date']}, None)
+
+        class DateSerializer(Serializer):
+            date_format = '%d/%m/%Y'
+            datetime_format = '%d/%m/%Y %H:%M'
+
+        class UpperSerializer(Serializer):
+            def convert_value(self, value):
+                if isinstance(value, str):
+                    return value.upper()
+                return super(UpperSerializer, self).convert_value(value)
+
+        class PrefixSerializer(Serializer):
+            def clean_data(self, data):
+                data = super(PrefixSerializer, self).clean_data(data)
+                return dict(('x_' + key, value) for key, value in data.items())
+
+        for serializer in (DateSerializer(), UpperSerializer(), PrefixSerializer()):
+            for fields, exclude in combinations:
+                self.assertSerializedLikeDictionary(serializer, note, fields, exclude)
+        self.assertEqual(
+            UpperSerializer().serialize_object(self.admin, {User: ['username']}),
+            {'username': 'ADMIN'})
+
     def test_deserializer(self):
         users = self.create_users()
         
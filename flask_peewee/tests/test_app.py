@@ -1,4 +1,5 @@
 import datetime
+import os
 
 from flask import Flask
 from flask import Response
@@ -39,7 +40,9 @@ class TestFlask(Flask):
 
 
 app = TestFlask(__name__)
-app.config.from_object('flask_peewee.tests.test_config.Configuration')
+app.config.from_object(os.environ.get(
+    'FLASK_PEEWEE_TEST_CONFIG',
+    'flask_peewee.tests.test_config.Configuration'))
 
 db = Database(app)
 
@@ -237,6 +240,16 @@ def private_timeline():
 def secret_area():
     return Response()
 
+@app.route('/notes/')
+def note_list():
+    query = Note.select().order_by(Note.id)
+    return object_list('base.html', query, last_modified=Note.created_date)
+
+@app.route('/notes/<int:pk>/')
+def note_detail(pk):
+    note = get_object_or_404(Note, Note.id == pk, version='created_date')
+    return render_template('base.html', note=note)
+
 
 admin.setup()
 api.setup()
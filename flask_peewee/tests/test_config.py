@@ -8,3 +8,12 @@ class Configuration(object):
     DEBUG = True
     SECRET_KEY = 'shhhh'
     TESTING = True
+
+
+class MemoryConfiguration(Configuration):
+    # an in-memory database shared by every connection of the test run
+    DATABASE = {
+        'name': 'test',
+        'engine': 'peewee.SqliteDatabase',
+        'shared_cache': True,
+    }
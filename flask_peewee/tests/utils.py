@@ -36,6 +36,71 @@ class UtilsTestCase(FlaskPeeweeTestCase):
         self.assertRaises(NotFound, get_object_or_404, inactive, User.username=='test')
         self.assertEqual(user, get_object_or_404(active, User.username=='test'))
     
+    def test_object_list_conditional_get(self):
+        user = self.create_user('test', 'test')
+        created = datetime.datetime(2020, 1, 1, 12, 30, 15, 500)
+        notes = [
+            Note.create(user=user, message=str(i), created_date=created - datetime.timedelta(days=i))
+            for i in range(3)]
+
+        resp = self.app.get('/notes/')
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(resp.headers['Last-Modified'], 'Wed, 01 Jan 2020 12:30:15 GMT')
+
+        # matching validators skip the list and the template
+        flask_app._template_context.clear()
+        resp = self.app.get('/notes/', headers={'If-None-Match': etag})
+        self.assertEqual((resp.status_code, resp.data), (304, b''))
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertFalse('object_list' in flask_app._template_context)
+
+        resp = self.app.get('/notes/', headers={'If-Modified-Since': 'Wed, 01 Jan 2020 12:30:15 GMT'})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get('/notes/', headers={'If-Modified-Since': 'Wed, 01 Jan 2020 12:30:14 GMT'})
+        self.assertEqual(resp.status_code, 200)
+
+        # each page has validators of its own
+        resp = self.app.get('/notes/?page=2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+        # deleting an older row changes the count, adding one the newest date
+        notes[2].delete_instance()
+        resp = self.app.get('/notes/', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+
+        Note.create(user=user, message='new', created_date=created + datetime.timedelta(days=1))
+        resp = self.app.get('/notes/', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Last-Modified'], 'Thu, 02 Jan 2020 12:30:15 GMT')
+
+        # only reads are answered conditionally
+        self.assertEqual(self.app.post('/notes/').status_code, 405)
+
+    def test_get_object_or_404_conditional_get(self):
+        user = self.create_user('test', 'test')
+        note = Note.create(user=user, message='test', created_date=datetime.datetime(2020, 1, 1))
+
+        resp = self.app.get('/notes/%s/' % note.id)
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertEqual(resp.headers['Last-Modified'], 'Wed, 01 Jan 2020 00:00:00 GMT')
+
+        resp = self.app.get('/notes/%s/' % note.id, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.app.get('/notes/%s/' % note.id, headers={'If-None-Match': 'W/"other", %s' % etag})
+        self.assertEqual(resp.status_code, 304)
+
+        note.created_date = datetime.datetime(2020, 1, 2)
+        note.save()
+        resp = self.app.get('/notes/%s/' % note.id, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        self.assertEqual(self.app.get('/notes/0/').status_code, 404)
+
     def test_passwords(self):
         p = make_password('testing')
         self.assertTrue(check_password('testing', p))
@@ -1,39 +1,81 @@
+import base64
+import binascii
+import datetime
+import json
 import math
+import operator
 import random
 import re
 import sys
 from hashlib import sha1
 
+from flask import Response
 from flask import abort
+from flask import after_this_request
 from flask import render_template
 from flask import request
 from peewee import DoesNotExist
+from peewee import Field
 from peewee import ForeignKeyField
 from peewee import Model
+from peewee import SQL
 from peewee import SelectQuery
+from peewee import fn
 
+from flask_peewee._compat import reduce
 from flask_peewee._compat import text_type
+from flask_peewee.counting import ExactCount
 
 
-def get_object_or_404(query_or_model, *query):
+def get_object_or_404(query_or_model, *query, **kwargs):
+    version = kwargs.pop('version', None)
     if not isinstance(query_or_model, SelectQuery):
         query_or_model = query_or_model.select()
     try:
-        return query_or_model.where(*query).get()
+        obj = query_or_model.where(*query).get()
     except DoesNotExist:
         abort(404)
 
+    if version is not None:
+        # answer conditional requests before the view renders the object
+        field = get_model_field(type(obj), version)
+        value = obj._data.get(field.name)
+        check_not_modified(
+            make_etag(obj._meta.db_table, obj._get_pk_value(), value),
+            value if isinstance(value, datetime.datetime) else None)
+    return obj
+
 def object_list(template_name, qr, var_name='object_list', **kwargs):
-    pq = PaginatedQuery(qr, kwargs.pop('paginate_by', 20))
+    last_modified = kwargs.pop('last_modified', None)
+    if last_modified is not None:
+        # the newest timestamp and the number of rows change with any write
+        # to the rows listed, and are much cheaper to get than the page
+        check_not_modified(*get_list_validators(template_name, qr, last_modified))
+
+    pq = PaginatedQuery(
+        qr,
+        kwargs.pop('paginate_by', 20),
+        keyset=kwargs.pop('keyset', False),
+        count_strategy=kwargs.pop('count_strategy', None))
     kwargs[var_name] = pq.get_list()
     return render_template(template_name, pagination=pq, page=pq.get_page(), **kwargs)
 
 
 class PaginatedQuery(object):
+    """
+    Paginates a query by page number, or -- with ``keyset`` -- by cursors
+    holding the ordering values of the rows a page starts or ends with, which
+    makes every page as cheap to fetch as the first.  Keyset pagination falls
+    back to page numbers if the query is ordered by anything but non-null
+    columns of its model.  Pages are counted by the ``count_strategy``, see
+    counting.py.
+    """
     page_var = 'page'
+    cursor_var = 'cursor'
 
-    def __init__(self, query_or_model, paginate_by):
+    def __init__(self, query_or_model, paginate_by, keyset=False, count_strategy=None):
         self.paginate_by = paginate_by
+        self.count_strategy = count_strategy or ExactCount()
 
         if isinstance(query_or_model, SelectQuery):
             self.query = query_or_model
@@ -42,21 +84,288 @@ class PaginatedQuery(object):
             self.model = query_or_model
             self.query = self.model.select()
 
+        self.query = get_read_query(self.query)
+
+        self.keys = self.get_keys() if keyset else None
+        self.keyset = self.keys is not None
+
     def get_page(self):
+        if self.keyset:
+            # counted along by the cursors
+            self.get_keyset_list()
+            return self._keyset_page
+        return self.get_requested_page()
+
+    def get_requested_page(self):
         curr_page = request.args.get(self.page_var)
         if curr_page and curr_page.isdigit():
             return int(curr_page)
         return 1
 
+    def get_count(self):
+        """
+        Return the number of rows, and whether that number is exact.
+        """
+        if not hasattr(self, '_get_count'):
+            if self.keyset:
+                # the strategies take the position of the page from the query
+                # selecting it by offset, which keyset pages aren't read with
+                page_query = self.count_strategy.paginate(
+                    self.query,
+                    self.get_page(),
+                    self.paginate_by)
+            else:
+                page_query = self.get_list()
+            self._get_count = self.count_strategy.count(self.query, page_query)
+        return self._get_count
+
     def get_pages(self):
         if not hasattr(self, '_get_pages'):
             self._get_pages = int(math.ceil(
-                float(self.query.count()) / self.paginate_by))
+                float(self.get_count()[0]) / self.paginate_by))
         return self._get_pages
 
+    def has_next(self):
+        if self.keyset:
+            return self.get_next_cursor() is not None
+        if self.get_page() < self.get_pages():
+            return True
+        if self.get_count()[1]:
+            return False
+        # the count may fall short, look for the first row of the next page
+        query = self.query.limit(1).offset(self.get_page() * self.paginate_by)
+        query._select = [SQL('1')]
+        return query.scalar() is not None
+
     def get_list(self):
-        return self.query.paginate(self.get_page(), self.paginate_by)
+        if self.keyset:
+            return self.get_keyset_list()
+        if not hasattr(self, '_get_list'):
+            self._get_list = self.count_strategy.paginate(
+                self.query,
+                self.get_page(),
+                self.paginate_by)
+        return self._get_list
+
+    def get_keys(self):
+        """
+        Return the fields the query is ordered by and whether each is
+        descending, ending with the primary key, or ``None`` if the query
+        can't be paginated by key.
+        """
+        pk = self.model._meta.primary_key
+        if not isinstance(pk, Field):
+            return None
+
+        keys = []
+        for node in self.query._order_by or ():
+            if not isinstance(node, Field) or node.model_class is not self.model:
+                return None
+            field = self.model._meta.fields.get(node.name)
+            if field is None or field.null:
+                return None
+            keys.append((field, node._ordering == 'DESC'))
+
+        # rows with the same values are told apart by their primary key
+        if not any(field is pk for field, _ in keys):
+            keys.append((pk, keys[-1][1] if keys else False))
+        return keys
+
+    def get_signature(self):
+        return [
+            ('-' if desc else '') + field.name for field, desc in self.keys]
+
+    def encode_cursor(self, direction, obj, page):
+        values = [obj._data.get(field.name) for field, _ in self.keys]
+        data = json.dumps(
+            [direction, self.get_signature(), values, page],
+            default=text_type,
+            separators=(',', ':'))
+        token = base64.urlsafe_b64encode(data.encode('utf-8'))
+        return token.decode('ascii').rstrip('=')
+
+    def decode_cursor(self, token):
+        """
+        Return the direction, key values and page number of a cursor, or
+        ``None`` if the cursor is invalid or belongs to a different ordering.
+        """
+        try:
+            token = token.encode('ascii')
+            data = base64.urlsafe_b64decode(token + b'=' * (-len(token) % 4))
+            direction, signature, values, page = json.loads(data.decode('utf-8'))
+            if direction not in ('next', 'previous') or \
+                    signature != self.get_signature() or \
+                    len(values) != len(self.keys) or \
+                    not isinstance(page, int) or page < 1:
+                return None
+            return direction, [
+                field.python_value(value)
+                for (field, _), value in zip(self.keys, values)], page
+        except (binascii.Error, TypeError, UnicodeError, ValueError):
+            return None
+
+    def get_cursor(self):
+        token = request.args.get(self.cursor_var)
+        if token:
+            return self.decode_cursor(token)
+
+    def get_seek_expression(self, values, backwards):
+        # rows after the cursor: (a > x) OR (a = x AND b > y) OR ..., led by
+        # "a >= x" so that the database can seek an index on the first column
+        clauses = []
+        for i, ((field, desc), value) in enumerate(zip(self.keys, values)):
+            compare = operator.lt if desc != backwards else operator.gt
+            clauses.append(reduce(operator.and_, [
+                key == prior
+                for (key, _), prior in zip(self.keys[:i], values[:i])
+            ] + [compare(field, value)]))
+
+        field, desc = self.keys[0]
+        if len(self.keys) == 1:
+            return clauses[0]
+        compare = operator.le if desc != backwards else operator.ge
+        return compare(field, values[0]) & reduce(operator.or_, clauses)
+
+    def get_keyset_list(self):
+        if hasattr(self, '_keyset_list'):
+            return self._keyset_list
+
+        cursor = self.get_cursor()
+        backwards = cursor is not None and cursor[0] == 'previous'
+        ordering = [
+            field.desc() if desc != backwards else field.asc()
+            for field, desc in self.keys]
+
+        query = self.query.order_by(*ordering)
+        if cursor is not None:
+            page = cursor[2]
+            query = query.where(self.get_seek_expression(cursor[1], backwards))
+        else:
+            page = self.get_requested_page()
+            query = self.seek_page(query, page)
+
+        # one row more than a page tells whether there is a further page
+        rows = list(query.limit(self.paginate_by + 1))
+        more = len(rows) > self.paginate_by
+        rows = rows[:self.paginate_by]
+        if backwards:
+            rows.reverse()
+            has_previous, has_next = more, True
+            if not more:
+                page = 1
+        else:
+            has_previous, has_next = page > 1, more
+
+        self._previous_cursor = self._next_cursor = None
+        if rows and has_previous:
+            self._previous_cursor = self.encode_cursor('previous', rows[0], page - 1)
+        if rows and has_next:
+            self._next_cursor = self.encode_cursor('next', rows[-1], page + 1)
+        self._keyset_page = page
+        self._keyset_list = rows
+        return rows
+
+    def seek_page(self, query, page):
+        """
+        Restrict ``query`` to the rows from the start of page ``page`` on,
+        seeking from the nearest boundary of the database's page index when
+        it has one, see pageindex.py.
+        """
+        offset = (page - 1) * self.paginate_by
+        page_index = getattr(self.query.database, 'page_index', None)
+        if offset and page_index is not None:
+            values, offset = page_index.locate(self, offset)
+            if values is not None:
+                query = query.where(self.get_seek_expression(values, False))
+        if offset:
+            query = query.offset(offset)
+        return query
+
+    def get_previous_cursor(self):
+        self.get_keyset_list()
+        return self._previous_cursor
+
+    def get_next_cursor(self):
+        self.get_keyset_list()
+        return self._next_cursor
+
+
+def get_model_field(model, field):
+    if isinstance(field, Field):
+        return field
+    return model._meta.fields[field]
+
+def make_etag(*parts):
+    return sha1(repr(parts).encode('utf8')).hexdigest()
+
+def get_list_validators(template_name, query, last_modified):
+    """
+    Return an ETag and Last-Modified date for the list of ``query``'s rows
+    on the current page, from the newest ``last_modified`` timestamp and the
+    number of rows.
+    """
+    if not isinstance(query, SelectQuery):
+        query = query.select()
+    field = get_model_field(query.model_class, last_modified)
+
+    aggregate = get_read_query(query).order_by()
+    aggregate._select = [fn.MAX(field), fn.COUNT(SQL('*'))]
+    newest, count = aggregate.tuples().get()
+    if newest is not None and not isinstance(newest, datetime.datetime):
+        newest = field.python_value(newest)
+
+    etag = make_etag(template_name, request.full_path, newest, count)
+    return etag, newest if isinstance(newest, datetime.datetime) else None
+
+def check_not_modified(etag, last_modified=None):
+    """
+    Abort with a ``304 Not Modified`` if the request's ``If-None-Match`` or
+    ``If-Modified-Since`` header matches the given validators, otherwise
+    send them along with the response.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return
+
+    if last_modified is not None:
+        # HTTP dates have no fractions of a second
+        last_modified = last_modified.replace(microsecond=0)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        since = request.if_modified_since
+        if since.tzinfo is not None:
+            since = since.replace(tzinfo=None) - since.utcoffset()
+        not_modified = last_modified <= since
+    else:
+        not_modified = False
+
+    def set_validators(response):
+        response.set_etag(etag, weak=True)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        return response
+
+    if not_modified:
+        abort(set_validators(Response(status=304)))
+    after_this_request(set_validators)
+
+def get_read_query(query):
+    """
+    Route a SELECT to a read replica, if the query's database has any.
+    """
+    get_read_database = getattr(query.database, 'get_read_database', None)
+    if get_read_database is not None:
+        read_database = get_read_database()
+        if read_database is not query.database:
+            query = query.clone()
+            query.database = read_database
+    return query
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'CREATE', 'DROP', 'ALTER')
 
+def is_write_query(sql):
+    return sql.lstrip()[:7].upper().startswith(WRITE_STATEMENTS)
 
 def get_next():
     if not request.query_string:
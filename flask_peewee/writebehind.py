@@ -0,0 +1,341 @@
+"""
+Write-behind batching of frequent, delay-tolerant writes.
+
+Writes like last-seen timestamps, view counters or activity logs happen on
+nearly every request, and a ``save()`` each makes them expensive.  With write
+behind enabled, they are buffered in memory and written by a background
+thread in bulk, one ``UPDATE`` per model and batch of rows:
+
+    DATABASE = {
+        'name': 'example.db',
+        'engine': 'peewee.SqliteDatabase',
+        'write_behind': True,
+        'write_behind_interval': 1,    # seconds between flushes
+        'write_behind_size': 1000,     # rows buffered before flushing early
+        'write_behind_retries': 3,     # failed flushes before giving up
+    }
+
+    db.write_behind.update(user, last_seen=datetime.datetime.now())
+    db.write_behind.increment(page, views=1)
+    db.write_behind.insert(ActivityLog, user=user.id, action='login')
+
+Repeated updates of the same row are coalesced, so only the last value set and
+the sum of the increments are written.  Buffered writes are flushed when the
+process exits; ``flush()`` writes them at once and waits until they are done.
+Writes failing in the background are logged and kept for the next flush, and
+only dropped once they have failed ``retries`` more times.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from peewee import Clause
+from peewee import Param
+from peewee import SQL
+
+from flask_peewee.tenants import get_tenant_namespace
+
+
+logger = logging.getLogger('flask_peewee.writebehind')
+
+SET = 'set'
+ADD = 'add'
+
+
+class WriteBehindError(Exception):
+    pass
+
+
+class WriteBehind(object):
+    """
+    Buffer of updates and inserts, written to ``database`` by a background
+    thread every ``interval`` seconds, or as soon as ``max_size`` rows are
+    buffered.  The writes of a database failing ``retries`` times in a row
+    are dropped.
+    """
+    def __init__(self, database, interval=1.0, max_size=1000, batch_size=100,
+                 retries=3):
+        self.database = database
+        self.interval = interval
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.retries = retries
+        self.flushes = 0
+        self.written = 0
+        self.errors = 0
+        self.dropped = 0
+        self._failures = {}
+        self._error = None
+        self._updates = OrderedDict()
+        self._inserts = []
+        self._requested = 0
+        self._completed = 0
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+        self._cond = threading.Condition()
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._updates) + len(self._inserts)
+
+    def get_namespace(self):
+        # rows are written to the database of the tenant buffering them
+        return get_tenant_namespace(self.database)
+
+    def update(self, instance, **fields):
+        """
+        Set ``fields`` of ``instance``, and write them later.
+        """
+        for name, value in fields.items():
+            setattr(instance, name, value)
+        self._buffer_update(instance, [(name, SET, value) for name, value in fields.items()])
+
+    def increment(self, instance, **amounts):
+        """
+        Add ``amounts`` to fields of ``instance``, and write them later.
+        """
+        for name, amount in amounts.items():
+            value = getattr(instance, name)
+            if value is not None:
+                setattr(instance, name, value + amount)
+        self._buffer_update(instance, [(name, ADD, amount) for name, amount in amounts.items()])
+
+    def insert(self, model_class, **row):
+        """
+        Insert ``row`` into the table of ``model_class`` later.
+        """
+        with self._cond:
+            self._start()
+            self._inserts.append((self.get_namespace(), model_class, row))
+            self._buffered()
+
+    def _buffer_update(self, instance, changes):
+        model_class = type(instance)
+        for name, op, value in changes:
+            if name not in model_class._meta.fields:
+                raise AttributeError('%s has no field "%s"' % (model_class.__name__, name))
+
+        pk = instance._get_pk_value()
+        if pk is None:
+            raise ValueError('Only saved instances can be updated later.')
+
+        key = (self.get_namespace(), model_class, pk)
+        with self._cond:
+            self._start()
+            self._merge(self._updates.setdefault(key, {}), changes)
+            self._buffered()
+
+    def _merge(self, pending, changes):
+        for name, op, value in changes:
+            previous = pending.get(name)
+            if op == ADD and previous is not None:
+                # set-then-increment is a set, increments add up
+                op, value = previous[0], previous[1] + value
+            pending[name] = (op, value)
+
+    def _requeue(self, updates, inserts):
+        # called with the lock held: the failed writes go ahead of the ones
+        # buffered in the meantime, which are applied on top of them
+        for key, changes in self._updates.items():
+            self._merge(updates.setdefault(key, {}), [
+                (name, op, value) for name, (op, value) in changes.items()])
+        self._updates = updates
+        self._inserts = inserts + self._inserts
+
+    def _start(self):
+        # called with the lock held
+        if self._pid == os.getpid():
+            return
+        if self._pid is not None:
+            # forked: the parent writes what it buffered, and the thread
+            # writing it didn't survive the fork
+            self._updates = OrderedDict()
+            self._inserts = []
+            self._failures = {}
+            self._error = None
+            self._requested = self._completed = 0
+        self._thread = threading.Thread(target=self._run, name='flask-peewee-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _buffered(self):
+        if len(self) >= self.max_size:
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Write everything buffered so far and wait until it has been written.
+        Returns ``False`` if that took longer than ``timeout`` seconds, and
+        raises ``WriteBehindError`` if some of it couldn't be written.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                # nothing was buffered by this process
+                return True
+            self._requested += 1
+            target = self._requested
+            self._cond.notify_all()
+
+            deadline = None if timeout is None else time.time() + timeout
+            while self._completed < target:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if self._error is not None:
+                raise WriteBehindError('Unable to write buffered rows: %s' % self._error)
+            return True
+
+    def close(self):
+        """
+        Write everything buffered and stop the background thread.
+        """
+        with self._cond:
+            if self._pid != os.getpid() or self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        failed = False
+        while True:
+            with self._cond:
+                # after a failure, wait for the interval before trying again
+                if not self._stopped and self._requested == self._completed and \
+                        (failed or len(self) < self.max_size):
+                    self._cond.wait(self.interval)
+                target = self._requested
+                stopped = self._stopped
+                updates, self._updates = self._updates, OrderedDict()
+                inserts, self._inserts = self._inserts, []
+
+            error = None
+            if updates or inserts:
+                error = self.write(updates, inserts, stopped)
+            failed = error is not None
+
+            with self._cond:
+                if failed:
+                    self._requeue(updates, inserts)
+                self._error = error
+                self._completed = target
+                self._cond.notify_all()
+            if stopped:
+                return
+
+    def write(self, updates, inserts, final=False):
+        """
+        Write buffered ``updates`` and ``inserts``, grouped by namespace.  The
+        writes of the namespaces which failed are left in ``updates`` and
+        ``inserts`` to be retried, and the last error is returned.
+        """
+        namespaces = OrderedDict()
+        for entry in inserts:
+            namespaces.setdefault(entry[0], ([], OrderedDict()))[0].append(entry)
+        for key, changes in updates.items():
+            namespaces.setdefault(key[0], ([], OrderedDict()))[1][key] = changes
+
+        updates.clear()
+        del inserts[:]
+        error = None
+        for namespace, (ns_inserts, ns_updates) in namespaces.items():
+            self.flushes += 1
+            try:
+                self.write_namespace(namespace, ns_inserts, ns_updates)
+            except Exception as exc:
+                error = exc
+                self.errors += 1
+                rows = len(ns_inserts) + len(ns_updates)
+                failures = self._failures[namespace] = self._failures.get(namespace, 0) + 1
+                if final or failures > self.retries:
+                    logger.exception('Unable to write %s buffered rows, dropping them.', rows)
+                    self.dropped += rows
+                    del self._failures[namespace]
+                else:
+                    logger.exception('Unable to write %s buffered rows, will retry.', rows)
+                    inserts.extend(ns_inserts)
+                    updates.update(ns_updates)
+            else:
+                self._failures.pop(namespace, None)
+        return error
+
+    def write_namespace(self, namespace, inserts, updates):
+        use_tenant = getattr(self.database, 'use_tenant', None)
+        if namespace is not None and use_tenant is not None:
+            with use_tenant(namespace):
+                return self._write(inserts, updates)
+        return self._write(inserts, updates)
+
+    def _write(self, inserts, updates):
+        grouped_inserts = OrderedDict()
+        for _, model_class, row in inserts:
+            grouped_inserts.setdefault((model_class, tuple(sorted(row))), []).append(row)
+        grouped_updates = OrderedDict()
+        for (_, model_class, pk), changes in updates.items():
+            grouped_updates.setdefault(model_class, []).append((pk, changes))
+
+        written = 0
+        try:
+            with self.database.atomic():
+                for (model_class, _), rows in grouped_inserts.items():
+                    for i in range(0, len(rows), self.batch_size):
+                        model_class.insert_many(rows[i:i + self.batch_size]).execute()
+                    written += len(rows)
+
+                for model_class, rows in grouped_updates.items():
+                    for i in range(0, len(rows), self.batch_size):
+                        self.write_updates(model_class, rows[i:i + self.batch_size])
+                    written += len(rows)
+            self.written += written
+        finally:
+            # the connection belongs to this thread, and to the tenant
+            if not self.database.is_closed():
+                self.database.close()
+
+    def write_updates(self, model_class, rows):
+        """
+        Update ``rows`` -- a list of primary keys and their changes -- in a
+        single statement, setting each field with a CASE on the primary key.
+        """
+        pk_field = model_class._meta.primary_key
+        names = []
+        for pk, changes in rows:
+            names.extend(name for name in changes if name not in names)
+
+        update = {}
+        for name in names:
+            field = model_class._meta.fields[name]
+            clauses = [SQL('CASE'), pk_field]
+            for pk, changes in rows:
+                if name in changes:
+                    op, value = changes[name]
+                    if op == ADD:
+                        value = field + value
+                    else:
+                        value = Param(field.db_value(value))
+                    clauses.extend([
+                        SQL('WHEN'),
+                        Param(pk_field.db_value(pk)),
+                        SQL('THEN'),
+                        value])
+            clauses.extend([SQL('ELSE'), field, SQL('END')])
+            update[field] = Clause(*clauses)
+
+        pks = [pk for pk, changes in rows]
+        model_class.update(update).where(pk_field << pks).execute()
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                'buffered': len(self),
+                'flushes': self.flushes,
+                'written': self.written,
+                'errors': self.errors,
+                'dropped': self.dropped,
+            }